@@ -37,7 +37,8 @@ from openquake.hazardlib.calc.filters import RtreeFilter
 from openquake.risklib import riskinput, __version__ as engine_version
 from openquake.commonlib import readinput, riskmodels, datastore, source
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.commonlib.parallel import starmap, executor, wakeup_pool
+from openquake.commonlib.parallel import (
+    starmap, executor, wakeup_pool, SharedRegistry)
 from openquake.baselib.python3compat import with_metaclass
 from openquake.commonlib.export import export as exp
 
@@ -147,6 +148,8 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
         self.monitor.hdf5path = self.datastore.hdf5path
         self.datastore.export_dir = oqparam.export_dir
         self.oqparam = oqparam
+        # large objects sent to all the tasks
+        self.shared = SharedRegistry(self.datastore.calc_dir + '_shared')
 
     def save_params(self, **kw):
         """
@@ -208,6 +211,7 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
                 logging.critical('', exc_info=True)
                 raise
         finally:
+            self.shared.clear()
             if concurrent_tasks == 0:  # restore OQ_DISTRIBUTE
                 if oq_distribute is None:  # was not set
                     del os.environ['OQ_DISTRIBUTE']
@@ -268,6 +272,8 @@ class BaseCalculator(with_metaclass(abc.ABCMeta)):
             for key in sorted(keys):  # top level keys
                 if 'rlzs' in key and not individual_curves:
                     continue  # skip individual curves
+                if key == 'hmaps':
+                    continue  # exported below only if hazard_maps is set
                 self._export((key, fmt), exported)
             if has_hcurves and self.oqparam.hazard_maps:
                 self._export(('hmaps', fmt), exported)
@@ -548,6 +554,9 @@ class HazardCalculator(BaseCalculator):
                 self.assets_by_site, self.cost_calculator, oq.time_event,
                 time_events=hdf5.array_of_vstr(
                     sorted(self.exposure.time_events)))
+            # views over the final collection, with the right ordinals
+            self.assets_by_site = self.assetcol.assets_by_site(
+                len(self.assets_by_site))
         elif hasattr(self, '_assetcol'):
             self.assets_by_site = self.assetcol.assets_by_site()
 
@@ -569,7 +578,15 @@ class HazardCalculator(BaseCalculator):
                 tname + '_sent': iter_result.sent,
                 tname + '_max_received_per_task': max(iter_result.received),
                 tname + '_tot_received': sum(iter_result.received),
-                tname + '_num_tasks': len(iter_result.received)})
+                tname + '_num_tasks': len(iter_result.received),
+                tname + '_shared': self.shared.nbytes})
+        if getattr(iter_result, 'reduce_lags', None):  # bounded mode
+            tname = iter_result.name
+            self.datastore.save('job_info', {
+                tname + '_max_queue_depth': max(iter_result.queue_depths),
+                tname + '_mean_reduce_lag': numpy.mean(
+                    iter_result.reduce_lags),
+                tname + '_max_reduce_lag': max(iter_result.reduce_lags)})
 
     def post_process(self):
         """For compatibility with the engine"""
@@ -657,7 +674,9 @@ class RiskCalculator(HazardCalculator):
         rlz_ids = getattr(self.oqparam, 'rlz_ids', ())
         if rlz_ids:
             self.rlzs_assoc = self.rlzs_assoc.extract(rlz_ids)
-        all_args = ((riskinput, self.riskmodel, self.rlzs_assoc) +
+        riskmodel = self.shared.share(self.riskmodel)
+        rlzs_assoc = self.shared.share(self.rlzs_assoc)
+        all_args = ((riskinput, riskmodel, rlzs_assoc) +
                     self.extra_args + (self.monitor,)
                     for riskinput in self.riskinputs)
         res = starmap(self.core_task.__func__, all_args).reduce()
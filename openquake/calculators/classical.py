@@ -30,7 +30,6 @@ from openquake.hazardlib.geo.utils import get_longitudinal_extent
 from openquake.hazardlib.geo.geodetic import npoints_between
 from openquake.hazardlib.calc.hazard_curve import (
     pmap_from_grp, ProbabilityMap)
-from openquake.hazardlib.probability_map import PmapStats
 from openquake.commonlib import (
     parallel, datastore, source, calc, sourceconverter)
 from openquake.calculators import base
@@ -40,6 +39,7 @@ F32 = numpy.float32
 F64 = numpy.float64
 
 HazardCurve = collections.namedtuple('HazardCurve', 'location poes')
+PmapBlock = collections.namedtuple('PmapBlock', 'sids array nbytes')
 
 
 def split_filter_source(src, sites, ss_filter, random_seed):
@@ -414,30 +414,42 @@ class PSHACalculator(base.HazardCalculator):
                 self.datastore.set_nbytes('poes')
 
 
-def build_hcurves_and_stats(pmap_by_grp, sids, pstats, rlzs_assoc, monitor):
+def build_hcurves_and_stats(pmap_by_grp, sids, hstats, rlzs_assoc, monitor):
     """
     :param pmap_by_grp: dictionary of probability maps by source group ID
     :param sids: array of site IDs
-    :param pstats: instance of PmapStats
+    :param hstats: instance of :class:`openquake.commonlib.calc.HazardStats`
     :param rlzs_assoc: instance of RlzsAssoc
     :param monitor: instance of Monitor
-    :returns: a dictionary kind -> ProbabilityMap
+    :returns: a dictionary key -> PmapBlock
 
-    The "kind" is a string of the form 'rlz-XXX' or 'mean' of 'quantile-XXX'
-    used to specify the kind of output.
+    The keys are of the form 'hcurves/<kind>' and, if there are PoEs in the
+    job.ini, 'hmaps/<kind>'. The "kind" is a string of the form 'rlz-XXX'
+    or 'mean' of 'quantile-XXX' used to specify the kind of output.
     """
     if sum(len(pmap) for pmap in pmap_by_grp.values()) == 0:  # all empty
         return {}
-    rlzs = rlzs_assoc.realizations
-    with monitor('combine pmaps'):
-        pmap_by_rlz = calc.combine_pmaps(rlzs_assoc, pmap_by_grp)
     with monitor('compute stats'):
-        pmap_by_kind = dict(
-            pstats.compute(sids, [pmap_by_rlz[rlz] for rlz in rlzs]))
-    if monitor.individual_curves:
-        for rlz in rlzs:
-            pmap_by_kind['rlz-%03d' % rlz.ordinal] = pmap_by_rlz[rlz]
-    return pmap_by_kind
+        array_by_kind = hstats.compute(
+            rlzs_assoc, pmap_by_grp, sids, monitor.individual_curves)
+    with monitor('building blocks'):
+        # the number of bytes is the one of the ProbabilityMaps of the
+        # curves, i.e. 8 bytes per level for each site with data
+        nsites = len(set().union(*pmap_by_grp.values()))
+        blocks = {}
+        for kind, array in array_by_kind.items():
+            block = numpy.array(array[:, :, numpy.newaxis], F32)
+            nbytes = 8 * nsites * block.shape[1]
+            blocks['hcurves/' + kind] = PmapBlock(sids, block, nbytes)
+    if monitor.poes:
+        with monitor('building hazard maps'):
+            for kind, array in array_by_kind.items():
+                # the maps are computed from the curves as they are stored
+                curves = blocks['hcurves/' + kind].array[:, :, 0]
+                hmap = calc.make_hmap_array(
+                    curves, monitor.imtls, monitor.poes)[:, :, numpy.newaxis]
+                blocks['hmaps/' + kind] = PmapBlock(sids, hmap, hmap.nbytes)
+    return blocks
 
 
 @base.calculators.add('classical')
@@ -463,17 +475,19 @@ class ClassicalCalculator(PSHACalculator):
         attrs = dict(
             __pyclass__='openquake.hazardlib.probability_map.ProbabilityMap',
             sids=numpy.arange(N, dtype=numpy.uint32))
+        kinds = []
         if oq.individual_curves:
-            for rlz in rlzs:
-                self.datastore.create_dset(
-                    'hcurves/rlz-%03d' % rlz.ordinal, F32,
-                    (N, L, 1),  attrs=attrs)
+            kinds.extend('rlz-%03d' % rlz.ordinal for rlz in rlzs)
         if oq.mean_hazard_curves:
+            kinds.append('mean')
+        kinds.extend('quantile-%s' % q for q in oq.quantile_hazard_curves)
+        for kind in kinds:
             self.datastore.create_dset(
-                'hcurves/mean', F32, (N, L, 1), attrs=attrs)
-        for q in oq.quantile_hazard_curves:
-            self.datastore.create_dset(
-                'hcurves/quantile-%s' % q, F32, (N, L, 1), attrs=attrs)
+                'hcurves/' + kind, F32, (N, L, 1), attrs=attrs)
+            if oq.poes:  # the hazard maps are built together with the curves
+                self.datastore.create_dset(
+                    'hmaps/' + kind, F64, (N, len(oq.imtls) * len(oq.poes), 1),
+                    attrs=attrs)
         self.datastore.flush()
 
         logging.info('Building hazard curves')
@@ -496,39 +510,41 @@ class ClassicalCalculator(PSHACalculator):
         """
         monitor = self.monitor.new(
             'build_hcurves_and_stats',
-            individual_curves=self.oqparam.individual_curves)
+            individual_curves=self.oqparam.individual_curves,
+            imtls=self.oqparam.imtls, poes=self.oqparam.poes)
         weights = (None if self.oqparam.number_of_logic_tree_samples
                    else [rlz.weight for rlz in self.rlzs_assoc.realizations])
-        pstats = PmapStats(self.oqparam.quantile_hazard_curves, weights)
+        hstats = calc.HazardStats(self.oqparam.quantile_hazard_curves, weights)
         num_rlzs = len(self.rlzs_assoc.realizations)
         for block in self.sitecol.split_in_tiles(num_rlzs):
             pg = {grp_id: pmap_by_grp[grp_id].filter(block.sids)
                   for grp_id in pmap_by_grp}
-            yield pg, block.sids, pstats, self.rlzs_assoc, monitor
+            yield pg, block.sids, hstats, self.rlzs_assoc, monitor
 
-    def save_hcurves(self, acc, pmap_by_kind):
+    def save_hcurves(self, acc, block_by_kind):
         """
-        Works by side effect by saving hcurves and statistics on the
-        datastore; the accumulator stores the number of bytes saved.
+        Works by side effect by saving hcurves, hazard maps and statistics
+        on the datastore; the accumulator stores the number of bytes saved.
 
-        :param acc: dictionary kind -> nbytes
-        :param pmap_by_kind: a dictionary of ProbabilityMaps
+        :param acc: dictionary key -> nbytes
+        :param block_by_kind: a dictionary of PmapBlocks
         """
         oq = self.oqparam
-        for kind in pmap_by_kind:
-            if kind == 'mean' and not oq.mean_hazard_curves:
+        for key in block_by_kind:
+            if key.endswith('/mean') and not oq.mean_hazard_curves:
                 continue  # do not save the mean curves
-            pmap = pmap_by_kind[kind]
-            if pmap:
-                key = 'hcurves/' + kind
+            sids, array, nbytes = block_by_kind[key]
+            if len(sids):
                 dset = self.datastore.getitem(key)
-                for sid in pmap:
-                    dset[sid] = pmap[sid].array
-                acc += {kind: pmap.nbytes}
+                if sids[-1] - sids[0] + 1 == len(sids):  # contiguous sites
+                    dset[sids[0]:sids[-1] + 1] = array
+                else:  # h5py fancy indexing on sorted site IDs
+                    dset[sids] = array
+                acc += {key: nbytes}
         self.datastore.flush()
         return acc
 
     def post_execute(self, acc):
         """Save the number of bytes per each dataset"""
-        for kind, nbytes in acc.items():
-            self.datastore.getitem('hcurves/' + kind).attrs['nbytes'] = nbytes
+        for key, nbytes in acc.items():
+            self.datastore.getitem(key).attrs['nbytes'] = nbytes
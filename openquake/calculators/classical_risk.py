@@ -118,6 +118,8 @@ class ClassicalRiskCalculator(base.RiskCalculator):
             self.assetcol = riskinput.AssetCollection(
                 self.assets_by_site, self.cost_calculator,
                 self.oqparam.time_event)
+            self.assets_by_site = self.assetcol.assets_by_site(
+                len(self.assets_by_site))
             self.sitecol, self.assets_by_site = self.assoc_assets_sites(
                 haz_sitecol)
             curves_by_trt_gsim = {(0, 'FromFile'): haz_curves}
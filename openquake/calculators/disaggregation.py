@@ -27,13 +27,167 @@ import numpy
 from openquake.baselib import hdf5
 from openquake.baselib.general import split_in_blocks
 from openquake.hazardlib.calc import disagg
-from openquake.hazardlib.site import SiteCollection
+from openquake.hazardlib.imt import from_string
+from openquake.hazardlib.gsim.base import ContextMaker
 from openquake.hazardlib.calc.filters import SourceSitesFilter
 from openquake.commonlib import parallel, sourceconverter
 from openquake.calculators import base, classical
 
 DISAGG_RES_FMT = 'disagg/poe-%(poe)s-rlz-%(rlz)s-%(imt)s-%(lon)s-%(lat)s'
 
+# maximum size of the disaggregation matrices of a block of sites and of
+# the rupture contributions kept in memory before binning them
+MAXBYTES = 100 * 1024 ** 2
+
+
+def _iml(curves, rlzi, imt, poe, imls):
+    # the intensity level corresponding to the given PoE on the curve;
+    # NaN if the curve is missing (i.e. it has all zero probabilities)
+    try:
+        curve = curves[rlzi, imt]
+    except KeyError:
+        return numpy.nan
+    return numpy.interp(poe, curve[::-1], imls[::-1])
+
+
+def _arrange_bins(matrices, bin_edges, sids, chunks):
+    """
+    Multiply the probabilities of no exceedance stored in the chunks into
+    the 6D matrices of the affected sites.
+
+    :param matrices: a dictionary sid -> array of shape (K, M*D*Lo*La*T, E)
+    :param bin_edges: a dictionary sid -> (mag, dist, lon, lat, eps) edges
+    :param sids: the site IDs of the block
+    :param chunks: a list of tuples (pos, mags, dists, lons, lats, trts, pnes)
+    """
+    pos, mags, dists, lons, lats, trts = [
+        numpy.concatenate([chunk[i] for chunk in chunks]) for i in range(6)]
+    pnes = numpy.concatenate([chunk[6] for chunk in chunks], axis=1)
+    order = pos.argsort(kind='mergesort')
+    pos = pos[order]
+    starts = numpy.searchsorted(pos, numpy.arange(len(sids) + 1))
+    for i, sid in enumerate(sids):
+        idx = order[starts[i]:starts[i + 1]]
+        if len(idx) == 0:
+            continue
+        mag_edges, dist_edges, lon_edges, lat_edges, eps_edges = bin_edges[sid]
+        dims = (len(mag_edges) - 1, len(dist_edges) - 1,
+                len(lon_edges) - 1, len(lat_edges) - 1)
+        # bins are closed on the lower bound and open on the upper bound;
+        # values equal to the last edge are assumed to fall in the last bin
+        indices = [numpy.digitize(mags[idx], mag_edges) - 1,
+                   numpy.digitize(dists[idx], dist_edges) - 1,
+                   disagg._digitize_lons(lons[idx], lon_edges),
+                   numpy.digitize(lats[idx], lat_edges) - 1]
+        indices = [numpy.clip(ix, 0, dim - 1)
+                   for ix, dim in zip(indices, dims)]
+        num_trts = matrices[sid].shape[1] // numpy.prod(dims)
+        flat = numpy.ravel_multi_index(
+            indices + [trts[idx]], dims + (num_trts,))
+        for k, mat in enumerate(matrices[sid]):
+            numpy.multiply.at(mat, flat, pnes[k, idx])
+
+
+def _matrix_shape(edges, num_trts):
+    # the shape (M*D*Lo*La*T, E) of the disaggregation matrix of a site
+    mag_edges, dist_edges, lon_edges, lat_edges, eps_edges = edges
+    size = ((len(mag_edges) - 1) * (len(dist_edges) - 1) *
+            (len(lon_edges) - 1) * (len(lat_edges) - 1) * num_trts)
+    return size, len(eps_edges) - 1
+
+
+def _disagg_block(sites, sources, max_dist, trt_num, trt_names, cmaker,
+                  keys, imls, imts, bin_edges, oqparam, monitor):
+    # disaggregate the given sources on a block of sites; imls has shape
+    # (K, N), with N the number of sites in the block
+    collecting_mon = monitor('collecting bins')
+    arranging_mon = monitor('arranging bins')
+    sids = sites.sids
+    result = {}
+    matrices = {}  # sid -> array of shape (K, M*D*Lo*La*T, E)
+    for sid in sids:
+        matrices[sid] = numpy.ones(
+            (len(keys),) + _matrix_shape(bin_edges[sid], len(trt_names)))
+    contributing = set()
+    for src in sources:
+        s_sites = src.filter_sites_by_distance_to_source(max_dist, sites)
+        if s_sites is None:
+            continue
+        chunks = []
+        chunks_nbytes = 0
+        tect_reg = trt_num[src.tectonic_region_type]
+        for rupture in src.iter_ruptures():
+            with collecting_mon:
+                sctx, rctx, dctx = cmaker.make_contexts(s_sites, rupture)
+                r_sids = sctx.sites.sids
+                pos = numpy.searchsorted(sids, r_sids)
+                closest_points = rupture.surface.get_closest_points(
+                    sctx.sites.mesh)
+                pnes = numpy.ones((len(keys), len(pos),
+                                   oqparam.num_epsilon_bins))
+                for k, (gsim, rlzi, poe, imt) in enumerate(keys):
+                    poes = gsim.disaggregate_poe(
+                        sctx, rctx, dctx, imts[imt], imls[k, pos],
+                        oqparam.truncation_level, oqparam.num_epsilon_bins)
+                    pnes[k] = rupture.get_probability_no_exceedance(poes)
+                chunks.append((pos, numpy.repeat(rupture.mag, len(pos)),
+                               dctx.rjb, closest_points.lons,
+                               closest_points.lats,
+                               numpy.repeat(tect_reg, len(pos)), pnes))
+                chunks_nbytes += pnes.nbytes
+                contributing.update(r_sids)
+            if chunks_nbytes > MAXBYTES:  # do not keep too many chunks
+                with arranging_mon:
+                    _arrange_bins(matrices, bin_edges, sids, chunks)
+                chunks = []
+                chunks_nbytes = 0
+        if chunks:
+            with arranging_mon:
+                _arrange_bins(matrices, bin_edges, sids, chunks)
+
+    with arranging_mon:
+        for i, sid in enumerate(sids):
+            if sid not in contributing:  # no contributions for this site
+                del matrices[sid]
+                continue
+            edges = bin_edges[sid]
+            shape = tuple(len(e) - 1 for e in edges[:4]) + (
+                len(trt_names), len(edges[4]) - 1)
+            for k, (gsim, rlzi, poe, imt) in enumerate(keys):
+                iml = imls[k, i]
+                if numpy.isnan(iml):
+                    continue
+                # move the epsilon dimension before the TRT dimension
+                matrix = 1. - matrices[sid][k].reshape(shape).swapaxes(4, 5)
+                key = (sid, rlzi, poe, imt, iml, trt_names)
+                result[key] = numpy.array(
+                    [fn(matrix) for fn in disagg.pmf_map.values()])
+            del matrices[sid]  # release the memory as soon as possible
+    return result
+
+
+def _split_sites(nbytes, maxbytes):
+    """
+    Split the site indices in consecutive blocks, so that the sum of the
+    bytes in each block does not exceed maxbytes, unless the block
+    contains a single site.
+
+    >>> _split_sites([40, 40, 40, 100, 10], 100)
+    [array([0, 1]), array([2]), array([3]), array([4])]
+    """
+    blocks = []
+    start = 0
+    tot = 0
+    for i, n in enumerate(nbytes):
+        if i > start and tot + n > maxbytes:
+            blocks.append(numpy.arange(start, i))
+            start = i
+            tot = 0
+        tot += n
+    if len(nbytes):
+        blocks.append(numpy.arange(start, len(nbytes)))
+    return blocks
+
 
 def compute_disagg(sitecol, sources, src_group_id, rlzs_assoc,
                    trt_names, curves_dict, bin_edges, oqparam, monitor):
@@ -61,6 +215,12 @@ def compute_disagg(sitecol, sources, src_group_id, rlzs_assoc,
     :returns:
         a dictionary of probability arrays, with composite key
         (sid, rlz.id, poe, imt, iml, trt_names).
+
+    The sites are processed in blocks, so that the disaggregation matrices
+    of a block stay under MAXBYTES. For each block every rupture is
+    generated once and its contexts are computed for all the sites within
+    the maximum distance from its source; the contributions are then
+    binned per site. Usually all the sites of a task fit in a single block.
     """
     trt = sources[0].tectonic_region_type
     try:
@@ -71,58 +231,36 @@ def compute_disagg(sitecol, sources, src_group_id, rlzs_assoc,
     gsims = rlzs_assoc.gsims_by_grp_id[src_group_id]
     result = {}  # sid, rlz.id, poe, imt, iml, trt_names -> array
 
-    collecting_mon = monitor('collecting bins')
-    arranging_mon = monitor('arranging bins')
+    # bin_edges for a given site are missing if the site is far away
+    mask = numpy.array([sid in bin_edges and sid in curves_dict
+                        for sid in sitecol.sids])
+    sites = sitecol.filter(mask)
+    if sites is None:
+        return result
+    sids = sites.sids
 
-    for site, sid in zip(sitecol, sitecol.sids):
-        # edges as wanted by disagg._arrange_data_in_bins
-        try:
-            edges = bin_edges[sid]
-        except KeyError:
-            # bin_edges for a given site are missing if the site is far away
-            continue
+    # the intensity levels to disaggregate, one per key and site
+    keys = []  # (gsim, rlzi, poe, imt)
+    imls = []
+    for gsim in gsims:
+        for rlz in rlzs_assoc[src_group_id, gsim]:
+            for poe in oqparam.poes_disagg:
+                for imt in oqparam.imtls:
+                    keys.append((gsim, rlz.ordinal, poe, imt))
+                    imls.append([_iml(curves_dict[sid], rlz.ordinal, imt, poe,
+                                      oqparam.imtls[imt]) for sid in sids])
+    imls = numpy.array(imls)  # shape (K, N)
+    imts = {imt: from_string(imt) for imt in oqparam.imtls}
 
-        # generate source, rupture, sites once per site
-        sitecol = SiteCollection([site])
-        source_ruptures = [(src, src.iter_ruptures()) for src in sources
-                           if src.filter_sites_by_distance_to_source(
-                                   max_dist, sitecol)]
-        if not source_ruptures:
-            continue
-        with collecting_mon:
-            bdata = disagg._collect_bins_data(
-                trt_num, source_ruptures, site, curves_dict[sid],
-                src_group_id, rlzs_assoc, gsims, oqparam.imtls,
-                oqparam.poes_disagg, oqparam.truncation_level,
-                oqparam.num_epsilon_bins, monitor)
-
-        if not bdata.pnes:  # no contributions for this site
-            continue
-
-        for poe in oqparam.poes_disagg:
-            for imt in oqparam.imtls:
-                for gsim in gsims:
-                    for rlz in rlzs_assoc[src_group_id, gsim]:
-                        rlzi = rlz.ordinal
-                        # extract the probabilities of non-exceedance for the
-                        # given realization, disaggregation PoE, and IMT
-                        iml_pne_pairs = [pne[rlzi, poe, imt]
-                                         for pne in bdata.pnes]
-                        iml = iml_pne_pairs[0][0]
-                        probs = numpy.array(
-                            [p for (i, p) in iml_pne_pairs], float)
-                        # bins in a format handy for hazardlib
-                        bins = [bdata.mags, bdata.dists,
-                                bdata.lons, bdata.lats,
-                                bdata.trts, None, probs]
-
-                        # call disagg._arrange_data_in_bins
-                        with arranging_mon:
-                            key = (sid, rlzi, poe, imt, iml, trt_names)
-                            matrix = disagg._arrange_data_in_bins(
-                                bins, edges + (trt_names,))
-                            result[key] = numpy.array(
-                                [fn(matrix) for fn in disagg.pmf_map.values()])
+    # the 6D matrices of a block of sites must stay under MAXBYTES
+    nbytes = [len(keys) * numpy.prod(
+        _matrix_shape(bin_edges[sid], len(trt_names))) * 8 for sid in sids]
+    cmaker = ContextMaker(gsims)
+    for idxs in _split_sites(nbytes, MAXBYTES):
+        block = sites.filter(numpy.in1d(sites.sids, sids[idxs]))
+        result.update(_disagg_block(
+            block, sources, max_dist, trt_num, trt_names, cmaker, keys,
+            imls[:, idxs], imts, bin_edges, oqparam, monitor))
     return result
 
 
@@ -236,6 +374,16 @@ class DisaggregationCalculator(classical.ClassicalCalculator):
                     if (sm_id, sid) in self.bin_edges:
                         bin_edges[sid] = self.bin_edges[sm_id, sid]
 
+                # send only the curves of the sites and realizations
+                # relevant for the source group
+                rlzis = set(rlz.ordinal for gsim in
+                            self.rlzs_assoc.gsims_by_grp_id[src_group.id]
+                            for rlz in self.rlzs_assoc[src_group.id, gsim])
+                curves = {sid: {key: curve for key, curve
+                                in curves_dict[sid].items()
+                                if key[0] in rlzis}
+                          for sid in bin_edges}
+
                 ss_filter = SourceSitesFilter(oq.maximum_distance)
                 split_sources = []
                 for src in src_group:
@@ -245,7 +393,7 @@ class DisaggregationCalculator(classical.ClassicalCalculator):
                 for srcs in split_in_blocks(split_sources, nblocks):
                     all_args.append(
                         (sitecol, srcs, src_group.id, self.rlzs_assoc,
-                         trt_names, curves_dict, bin_edges, oq, self.monitor))
+                         trt_names, curves, bin_edges, oq, self.monitor))
 
         results = parallel.starmap(compute_disagg, all_args).reduce(
             self.agg_result)
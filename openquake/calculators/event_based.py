@@ -25,17 +25,19 @@ import collections
 
 import numpy
 
-from openquake.baselib.python3compat import encode
+from openquake.baselib.python3compat import encode, decode, pickle
 from openquake.baselib.general import AccumDict, split_in_blocks
 from openquake.hazardlib.calc.filters import \
     filter_sites_by_distance_to_rupture
 from openquake.hazardlib.calc.hazard_curve import ProbabilityMap
 from openquake.hazardlib.probability_map import PmapStats
-from openquake.hazardlib import geo
+from openquake.hazardlib import geo, source
+from openquake.hazardlib.source.rupture import ParametricProbabilisticRupture
+from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.gsim.base import ContextMaker
 from openquake.commonlib import parallel, calc
 from openquake.commonlib.util import max_rel_diff_index, Rupture
-from openquake.risklib.riskinput import GmfGetter, str2rsi, rsi2str
+from openquake.risklib.riskinput import GmfGetter
 from openquake.calculators import base
 from openquake.calculators.classical import ClassicalCalculator, PSHACalculator
 
@@ -44,6 +46,7 @@ from openquake.calculators.classical import ClassicalCalculator, PSHACalculator
 U8 = numpy.uint8
 U16 = numpy.uint16
 U32 = numpy.uint32
+U64 = numpy.uint64
 F32 = numpy.float32
 F64 = numpy.float64
 
@@ -206,6 +209,192 @@ class EBRupture(object):
         return '<%s #%d, grp_id=%d>' % (self.__class__.__name__,
                                         self.serial, self.grp_id)
 
+# ######################## columnar rupture store ######################## #
+
+# the ruptures are stored in the array `sescollection` (one record per
+# rupture) and in flat datasets, sliced by the indices in the records
+RUPTURE_KEYS = ('sescollection', 'rupture_events', 'rupture_sids',
+                'rupture_geoms', 'rupture_blobs')
+rupture_dt = numpy.dtype([
+    ('serial', U32), ('grp_id', U16), ('source_id', 'S30'), ('code', U8),
+    ('seed', U32), ('mag', F64), ('rake', F64), ('occurrence_rate', F64),
+    ('hypo', (F64, 3)), ('strike', F64), ('dip', F64),
+    ('mesh_spacing', F64), ('time_span', F64), ('typology', 'S32'),
+    ('sx', U16), ('sy', U16),
+    ('eidx1', U64), ('eidx2', U64), ('sidx1', U64), ('sidx2', U64),
+    ('gidx1', U64), ('gidx2', U64), ('bidx1', U64), ('bidx2', U64)])
+
+point3d = numpy.dtype([('lon', F64), ('lat', F64), ('depth', F64)])
+
+# ruptures with a surface not in this dictionary, or which are not
+# parametric, are stored pickled in `rupture_blobs` with code 0
+SURFACE_CODE = {geo.PlanarSurface: 1,
+                geo.SimpleFaultSurface: 2,
+                geo.ComplexFaultSurface: 3}
+SURFACE_CLASS = {code: cls for cls, code in SURFACE_CODE.items()}
+
+
+def get_code(rupture):
+    """
+    :param rupture: a hazardlib rupture
+    :returns: the code of the rupture surface, or 0 if it must be pickled
+    """
+    if (type(rupture) is not ParametricProbabilisticRupture or
+            type(rupture.temporal_occurrence_model) is not PoissonTOM or
+            getattr(source, rupture.source_typology.__name__, None)
+            is not rupture.source_typology):
+        return 0
+    return SURFACE_CODE.get(type(rupture.surface), 0)
+
+
+def store_ruptures(dstore, ebruptures):
+    """
+    Append the given EBRuptures to the columnar rupture store.
+
+    :param dstore: a DataStore instance
+    :param ebruptures: a list of EBRuptures with the final event IDs
+    """
+    hdf5 = dstore.hdf5  # the ruptures of the parent must be ignored
+    offset = {key: len(hdf5[key]) if key in hdf5 else 0
+              for key in RUPTURE_KEYS}
+    records, geoms, blobs = [], [], []
+    for ebr in ebruptures:
+        rup = ebr.rupture
+        code = get_code(rup)
+        e1, s1, g1, b1 = (offset['rupture_events'], offset['rupture_sids'],
+                          offset['rupture_geoms'], offset['rupture_blobs'])
+        offset['rupture_events'] += len(ebr.events)
+        offset['rupture_sids'] += len(ebr.indices)
+        sx = sy = strike = dip = mesh_spacing = 0
+        if code == 0:
+            mag = rake = rate = time_span = 0
+            hypo = (0, 0, 0)
+            typology = ''
+            blob = numpy.frombuffer(
+                pickle.dumps(rup, pickle.HIGHEST_PROTOCOL), U8)
+            blobs.append(blob)
+            offset['rupture_blobs'] += len(blob)
+        else:
+            mag, rake = rup.mag, rup.rake
+            rate = rup.occurrence_rate
+            time_span = rup.temporal_occurrence_model.time_span
+            hypo = (rup.hypocenter.longitude, rup.hypocenter.latitude,
+                    rup.hypocenter.depth)
+            typology = rup.source_typology.__name__
+            surface = rup.surface
+            if code == 1:  # planar surface, stored with its four corners
+                strike, dip = surface.strike, surface.dip
+                mesh_spacing = surface.mesh_spacing
+                geom = numpy.array(
+                    [(p.longitude, p.latitude, p.depth)
+                     for p in (surface.top_left, surface.top_right,
+                               surface.bottom_right, surface.bottom_left)],
+                    point3d)
+            else:  # fault surface, stored with its rectangular mesh
+                mesh = surface.mesh
+                sx, sy = mesh.shape
+                geom = numpy.zeros(sx * sy, point3d)
+                geom['lon'] = mesh.lons.flat
+                geom['lat'] = mesh.lats.flat
+                geom['depth'] = mesh.depths.flat
+            geoms.append(geom)
+            offset['rupture_geoms'] += len(geom)
+        records.append(
+            (ebr.serial, ebr.grp_id, ebr.source_id, code, rup.seed,
+             mag, rake, rate, hypo, strike, dip, mesh_spacing, time_span,
+             typology, sx, sy, e1, offset['rupture_events'],
+             s1, offset['rupture_sids'], g1, offset['rupture_geoms'],
+             b1, offset['rupture_blobs']))
+    if not records:
+        return
+    dstore.extend('sescollection', numpy.array(records, rupture_dt))
+    dstore.extend('rupture_events',
+                  numpy.concatenate([ebr.events for ebr in ebruptures]))
+    dstore.extend('rupture_sids', numpy.concatenate(
+        [ebr.indices for ebr in ebruptures]).astype(U32))
+    if geoms:
+        dstore.extend('rupture_geoms', numpy.concatenate(geoms))
+    if blobs:
+        dstore.extend('rupture_blobs', numpy.concatenate(blobs))
+
+
+def _read(dstore, key, recs, idx):
+    # read the portion of the flat dataset `key` spanned by the records;
+    # returns the offset of the portion and the portion itself
+    start, stop = int(recs[idx + '1'].min()), int(recs[idx + '2'].max())
+    if start == stop:  # nothing to read
+        return start, ()
+    return start, dstore[key][start:stop]
+
+
+def build_rupture(rec, trt, geom):
+    """
+    Rebuild a hazardlib rupture from its record in the `sescollection`
+    array and its geometry, as stored by :func:`store_ruptures`.
+
+    :param rec: a record of dtype `rupture_dt` with nonzero code
+    :param trt: the tectonic region type of the rupture
+    :param geom: an array of dtype `point3d`
+    """
+    code = rec['code']
+    if code == 1:
+        top_left, top_right, bottom_right, bottom_left = [
+            geo.Point(p['lon'], p['lat'], p['depth']) for p in geom]
+        surface = geo.PlanarSurface(
+            rec['mesh_spacing'], rec['strike'], rec['dip'],
+            top_left, top_right, bottom_right, bottom_left)
+    else:
+        shape = (rec['sx'], rec['sy'])
+        surface = SURFACE_CLASS[code](geo.RectangularMesh(
+            geom['lon'].reshape(shape), geom['lat'].reshape(shape),
+            geom['depth'].reshape(shape)))
+    lon, lat, depth = rec['hypo']
+    rupture = ParametricProbabilisticRupture(
+        rec['mag'], rec['rake'], trt, geo.Point(lon, lat, depth), surface,
+        getattr(source, decode(rec['typology'])), rec['occurrence_rate'],
+        PoissonTOM(rec['time_span']))
+    rupture.seed = int(rec['seed'])
+    return rupture
+
+
+def get_ruptures(dstore, slc=slice(None), trt_by_grp=None):
+    """
+    Read a slice of the columnar rupture store with a single read
+    per dataset.
+
+    :param dstore: a DataStore instance
+    :param slc: a slice over the records in the `sescollection` array
+    :param trt_by_grp: a dictionary grp_id -> trt (if None, use csm_info)
+    :returns: a list of EBRuptures
+    """
+    recs = dstore['sescollection'][slc]
+    if len(recs) == 0:
+        return []
+    if trt_by_grp is None:
+        trt_by_grp = {sg.id: sg.trt
+                      for sm in dstore['csm_info'].source_models
+                      for sg in sm.src_groups}
+    e0, events = _read(dstore, 'rupture_events', recs, 'eidx')
+    s0, sids = _read(dstore, 'rupture_sids', recs, 'sidx')
+    g0, geoms = _read(dstore, 'rupture_geoms', recs, 'gidx')
+    b0, blobs = _read(dstore, 'rupture_blobs', recs, 'bidx')
+    ebruptures = []
+    for rec in recs:
+        # NB: the indices are converted to int, since with numpy < 2
+        # uint64 - int gives a float64, which is not a valid slice bound
+        if rec['code'] == 0:
+            blob = blobs[int(rec['bidx1']) - b0:int(rec['bidx2']) - b0]
+            rupture = pickle.loads(blob.tobytes())
+        else:
+            geom = geoms[int(rec['gidx1']) - g0:int(rec['gidx2']) - g0]
+            rupture = build_rupture(rec, trt_by_grp[rec['grp_id']], geom)
+        ebruptures.append(EBRupture(
+            rupture, sids[int(rec['sidx1']) - s0:int(rec['sidx2']) - s0],
+            events[int(rec['eidx1']) - e0:int(rec['eidx2']) - e0],
+            decode(rec['source_id']), int(rec['grp_id']),
+            int(rec['serial'])))
+    return ebruptures
+
 
 def compute_ruptures(sources, sitecol, gsims, monitor):
     """
@@ -276,6 +465,30 @@ def compute_ruptures(sources, sitecol, gsims, monitor):
     return res
 
 
+def sample_occurrences(rup, num_samples, num_ses):
+    """
+    Sample the number of occurrences of the given rupture for all the
+    samples and stochastic event sets at once. The random generator must
+    have been seeded before; the generated numbers are the same as the
+    ones obtained by calling `rup.sample_number_of_occurrences()` in a
+    loop over samples and SES.
+
+    :param rup: a hazardlib rupture object
+    :param num_samples: how many samples for the rupture source
+    :param num_ses: the number of Stochastic Event Sets to generate
+    :returns: an integer array of shape (num_samples, num_ses)
+    """
+    shape = (num_samples, num_ses)
+    try:
+        rate = rup.occurrence_rate
+        tom = rup.temporal_occurrence_model
+    except AttributeError:  # for nonparametric ruptures
+        occ = [rup.sample_number_of_occurrences()
+               for _ in range(num_samples * num_ses)]
+        return numpy.array(occ, U32).reshape(shape)
+    return tom.sample_number_of_occurrences(numpy.ones(shape) * rate)
+
+
 def sample_ruptures(src, num_ses, num_samples, seed):
     """
     Sample the ruptures contained in the given source.
@@ -287,19 +500,19 @@ def sample_ruptures(src, num_ses, num_samples, seed):
     :returns: a dictionary of dictionaries rupture -> {ses_id: num_occurrences}
     """
     # the dictionary `num_occ_by_rup` contains a dictionary
-    # ses_id -> num_occurrences for each occurring rupture
-    num_occ_by_rup = collections.defaultdict(AccumDict)
+    # (sampleid, ses_id) -> num_occurrences for each occurring rupture
+    num_occ_by_rup = {}
     # generating ruptures for the given source
     for rup_no, rup in enumerate(src.iter_ruptures()):
         rup.seed = src.serial[rup_no] + seed
-        numpy.random.seed(rup.seed)
-        for sampleid in range(num_samples):
-            for ses_idx in range(1, num_ses + 1):
-                num_occurrences = rup.sample_number_of_occurrences()
-                if num_occurrences:
-                    num_occ_by_rup[rup] += {
-                        (sampleid, ses_idx): num_occurrences}
         rup.rup_no = rup_no + 1
+        numpy.random.seed(rup.seed)
+        num_occ = sample_occurrences(rup, num_samples, num_ses)
+        sampleids, ses_idxs = num_occ.nonzero()
+        if len(sampleids):  # store only the occurring ruptures
+            keys = zip(sampleids.tolist(), (ses_idxs + 1).tolist())
+            num_occ_by_rup[rup] = AccumDict(
+                zip(keys, num_occ[sampleids, ses_idxs].tolist()))
     return num_occ_by_rup
 
 
@@ -394,7 +607,10 @@ class EventBasedRuptureCalculator(PSHACalculator):
         return acc
 
     def save_ruptures(self, ruptures_by_grp_id):
-        """Extend the 'events' dataset with the given ruptures"""
+        """
+        Extend the 'events' dataset and, if `save_ruptures` is set,
+        the rupture store with the given ruptures
+        """
         with self.monitor('saving ruptures', autoflush=True):
             for grp_id, ebrs in ruptures_by_grp_id.items():
                 events = []
@@ -412,8 +628,8 @@ class EventBasedRuptureCalculator(PSHACalculator):
                         events.append(rec)
                         self.eid[sm_id] += 1
                         i += 1
-                    if self.oqparam.save_ruptures:
-                        self.datastore['sescollection/%s' % ebr.serial] = ebr
+                if self.oqparam.save_ruptures:
+                    store_ruptures(self.datastore, ebrs)
                 if events:
                     ev = 'events/sm-%04d' % sm_id
                     self.datastore.extend(
@@ -432,8 +648,9 @@ class EventBasedRuptureCalculator(PSHACalculator):
         nr = sum(len(result[grp_id]) for grp_id in result)
         logging.info('Saved %d ruptures, %d events',
                      nr, sum(self.eid.values()))
-        if 'sescollection' in self.datastore:
-            self.datastore.set_nbytes('sescollection')
+        for key in RUPTURE_KEYS:
+            if key in self.datastore:
+                self.datastore.set_nbytes(key)
         self.datastore.set_nbytes('events')
 
         for dset in self.rup_data.values():
@@ -450,9 +667,6 @@ class EventBasedRuptureCalculator(PSHACalculator):
 
 # ######################## GMF calculator ############################ #
 
-gmv_dt = numpy.dtype([('sid', U32), ('eid', U32), ('imti', U8), ('gmv', F32)])
-
-
 def compute_gmfs_and_curves(getter, rlzs, monitor):
     """
     :param eb_ruptures:
@@ -466,36 +680,23 @@ def compute_gmfs_and_curves(getter, rlzs, monitor):
     :param monitor:
         a Monitor instance
     :returns:
-        a dictionary with keys gmfcoll and hcurves
+        a dictionary with keys gmfcoll, hcurves and sids; hcurves is
+        a dictionary rlzi -> (array (N, L) of exceedance counts, IDs of
+        the sites with ground motion values)
    """
     oq = monitor.oqparam
-    haz = {sid: {} for sid in getter.sids}
     gmfcoll = {}  # rlz -> gmfa
+    hcurves = {}  # rlzi -> counts
     for rlz in rlzs:
-        gmfcoll[rlz] = []
-        for sid, gmvdict in zip(getter.sids, getter(rlz)):
-            if gmvdict:
-                for imti, imt in enumerate(getter.imts):
-                    if oq.hazard_curves_from_gmfs:
-                        haz[sid][imt, rlz] = gmvdict[imt]
-                    for rec in gmvdict[imt]:
-                        gmfcoll[rlz].append(
-                            (sid, rec['eid'], imti, rec['gmv']))
-    for rlz in gmfcoll:
-        gmfcoll[rlz] = numpy.array(gmfcoll[rlz], gmv_dt)
-    result = dict(gmfcoll=gmfcoll if oq.ground_motion_fields else None,
-                  hcurves={})
-    if oq.hazard_curves_from_gmfs:
-        with monitor('building hazard curves', measuremem=False):
-            duration = oq.investigation_time * oq.ses_per_logic_tree_path
-            for sid, haz_by_imt_rlz in haz.items():
-                for imt, rlz in haz_by_imt_rlz:
-                    gmvs = haz_by_imt_rlz[imt, rlz]['gmv']
-                    poes = calc._gmvs_to_haz_curve(
-                        gmvs, oq.imtls[imt], oq.investigation_time, duration)
-                    key = rsi2str(rlz.ordinal, sid, imt)
-                    result['hcurves'][key] = poes
-    return result
+        gmfa = getter(rlz)
+        gmfcoll[rlz] = gmfa.array
+        if oq.hazard_curves_from_gmfs:
+            with monitor('building hazard curves', measuremem=False):
+                hcurves[rlz.ordinal] = (
+                    calc.gmvs_to_counts(gmfa.array, getter.sids, oq.imtls),
+                    numpy.unique(gmfa.array['sid']))
+    return dict(gmfcoll=gmfcoll if oq.ground_motion_fields else None,
+                hcurves=hcurves, sids=getter.sids)
 
 
 @base.calculators.add('event_based')
@@ -515,8 +716,9 @@ class EventBasedCalculator(ClassicalCalculator):
         sequentially; notice that the gmfs may come from
         different tasks in any order.
 
-        :param acc: an accumulator for the hazard curves
-        :param res: a dictionary rlzi, imt -> [gmf_array, curves_by_imt]
+        :param acc: a dictionary rlzi -> (array (N, L) of exceedance
+                    counts, boolean array (N,) of the sites with data)
+        :param res: a dictionary with keys gmfcoll, hcurves and sids
         :returns: a new accumulator
         """
         sav_mon = self.monitor('saving gmfs')
@@ -527,12 +729,15 @@ class EventBasedCalculator(ClassicalCalculator):
                     if len(array):
                         key = 'gmf_data/%04d' % rlz.ordinal
                         self.datastore.extend(key, array)
-        slicedic = self.oqparam.imtls.slicedic
         with agg_mon:
-            for key, poes in res['hcurves'].items():
-                rlzi, sid, imt = str2rsi(key)
-                array = acc[rlzi].setdefault(sid, 0).array[slicedic[imt], 0]
-                array[:] = 1. - (1. - array) * (1. - poes)
+            # the counts are summed, so the order of the tasks does not matter
+            shape = (len(self.sitecol.complete), len(self.oqparam.imtls.array))
+            for rlzi, (counts, sids) in res['hcurves'].items():
+                if rlzi not in acc:
+                    acc[rlzi] = (numpy.zeros(shape, U32),
+                                 numpy.zeros(shape[0], bool))
+                acc[rlzi][0][res['sids']] += counts
+                acc[rlzi][1][sids] = True
         sav_mon.flush()
         agg_mon.flush()
         self.datastore.flush()
@@ -541,6 +746,30 @@ class EventBasedCalculator(ClassicalCalculator):
                 self, res['ruptures'])
         return acc
 
+    def build_pmaps(self, counts_by_rlz):
+        """
+        Convert the exceedance counts into hazard curves; the sites with
+        ground motion values but no exceedances get zero curves.
+
+        :param counts_by_rlz:
+            a dictionary rlzi -> (array (N, L) of counts, boolean array (N,)
+            of the sites with data)
+        :returns: a dictionary rlzi -> ProbabilityMap
+        """
+        oq = self.oqparam
+        duration = oq.investigation_time * oq.ses_per_logic_tree_path
+        L = len(oq.imtls.array)
+        pmaps = {}
+        for rlz in self.rlzs_assoc.realizations:
+            pmap = pmaps[rlz.ordinal] = ProbabilityMap(L, 1)
+            if rlz.ordinal not in counts_by_rlz:
+                continue
+            counts, with_data = counts_by_rlz[rlz.ordinal]
+            poes = calc.counts_to_poes(counts, oq.investigation_time, duration)
+            for sid in with_data.nonzero()[0]:
+                pmap.setdefault(sid, 0).array[:, 0] = poes[sid]
+        return pmaps
+
     def gen_args(self, ebruptures):
         """
         :param ebruptures: a list of EBRupture objects to be split
@@ -560,7 +789,7 @@ class EventBasedCalculator(ClassicalCalculator):
                 key=operator.attrgetter('grp_id')):
             grp_id = block[0].grp_id
             trt = grp_trt[grp_id]
-            gsims = [dic[trt] for dic in self.rlzs_assoc.gsim_by_trt]
+            gsims = self.rlzs_assoc.get_gsims(trt)
             samples = self.rlzs_assoc.samples[grp_id]
             getter = GmfGetter(gsims, block, self.sitecol,
                                imts, min_iml, oq.truncation_level,
@@ -582,22 +811,17 @@ class EventBasedCalculator(ClassicalCalculator):
                 for sr in sesruptures:
                     self.sesruptures.append(sr)
         else:  # read the ruptures from the datastore
-            for serial in self.datastore['sescollection']:
-                sr = self.datastore['sescollection/' + serial]
-                self.sesruptures.append(sr)
+            self.sesruptures.extend(get_ruptures(self.datastore))
         self.sesruptures.sort(key=operator.attrgetter('serial'))
         if self.oqparam.ground_motion_fields:
             calc.check_overflow(self)
 
-        L = len(oq.imtls.array)
         res = parallel.starmap(
             self.core_task.__func__, self.gen_args(self.sesruptures)
         ).submit_all()
-        acc = functools.reduce(self.combine_pmaps_and_save_gmfs, res, {
-            rlz.ordinal: ProbabilityMap(L, 1)
-            for rlz in self.rlzs_assoc.realizations})
+        acc = functools.reduce(self.combine_pmaps_and_save_gmfs, res, {})
         self.save_data_transfer(res)
-        return acc
+        return self.build_pmaps(acc)
 
     def post_execute(self, result):
         """
@@ -122,13 +122,15 @@ def _old_loss_curves(asset_values, rcurves, ratios):
                         for avalue, poes in zip(asset_values, rcurves)])
 
 
-def _aggregate(outputs, compositemodel, agg, ass, idx, result, monitor):
+def _aggregate(outputs, compositemodel, assetcol, agg, ass, eids, result,
+               monitor):
     # update the result dictionary and the agg array with each output
+    sorter = numpy.argsort(eids)
     for out in outputs:
         l, r = out.lr
-        asset_ids = [a.ordinal for a in out.assets]
+        asset_ids = numpy.array([a.ordinal for a in out.assets])
         loss_type = compositemodel.loss_types[l]
-        indices = numpy.array([idx[eid] for eid in out.eids])
+        indices = sorter[numpy.searchsorted(eids, out.eids, sorter=sorter)]
 
         cb = compositemodel.curve_builders[l]
         if cb.user_provided:
@@ -138,26 +140,27 @@ def _aggregate(outputs, compositemodel, agg, ass, idx, result, monitor):
                 result['IC'][l, r] += dict(
                     zip(asset_ids, cb.build_counts(out.loss_ratios[:, :, 1])))
 
-        for i, asset in enumerate(out.assets):
-            aid = asset.ordinal
-            loss_ratios = out.loss_ratios[i]
-            losses = loss_ratios * asset.value(loss_type)
+        # shape (N, E, I)
+        values = assetcol.get_costs(loss_type, asset_ids)
+        losses = out.loss_ratios * values[:, None, None]
 
-            # average losses
-            if monitor.avg_losses:
-                result['AVGLOSS'][l, r][aid] += (
-                    loss_ratios.sum(axis=0) * monitor.ses_ratio)
+        # average losses
+        if monitor.avg_losses:
+            numpy.add.at(result['AVGLOSS'][l, r], asset_ids,
+                         out.loss_ratios.sum(axis=1) * monitor.ses_ratio)
 
-            # asset losses
-            if monitor.asset_loss_table:
-                data = [(eid, aid, loss)
-                        for eid, loss in zip(out.eids, losses)
-                        if loss.sum() > 0]
-                if data:
-                    ass[l, r].append(numpy.array(data, monitor.ela_dt))
+        # asset losses
+        if monitor.asset_loss_table:
+            aidxs, eidxs = (losses.sum(axis=2) > 0).nonzero()
+            if len(aidxs):
+                data = numpy.zeros(len(aidxs), monitor.ela_dt)
+                data['eid'] = out.eids[eidxs]
+                data['ass_id'] = asset_ids[aidxs]
+                data['loss'] = losses[aidxs, eidxs]
+                ass[l, r].append(data)
 
-            # agglosses
-            agg[indices, l, r] += losses
+        # agglosses
+        agg[indices, l, r] += losses.sum(axis=0)
 
 
 def event_based_risk(riskinput, riskmodel, rlzs_assoc, assetcol, monitor):
@@ -180,7 +183,6 @@ def event_based_risk(riskinput, riskmodel, rlzs_assoc, assetcol, monitor):
     I = monitor.insured_losses + 1
     eids = riskinput.eids
     E = len(eids)
-    idx = dict(zip(eids, range(E)))
     agg = numpy.zeros((E, L, R, I), F32)
     ass = collections.defaultdict(list)
 
@@ -192,12 +194,15 @@ def event_based_risk(riskinput, riskmodel, rlzs_assoc, assetcol, monitor):
         result['AVGLOSS'] = square(L, R, zeroN)
 
     outputs = riskmodel.gen_outputs(riskinput, rlzs_assoc, monitor, assetcol)
-    _aggregate(outputs, riskmodel, agg, ass, idx, result, monitor)
+    _aggregate(outputs, riskmodel, assetcol, agg, ass, eids, result, monitor)
     for (l, r) in itertools.product(range(L), range(R)):
-        records = [(eids[i], loss) for i, loss in enumerate(agg[:, l, r])
-                   if loss.sum() > 0]
-        if records:
-            result['AGGLOSS'][l, r] = numpy.array(records, monitor.elt_dt)
+        losses = agg[:, l, r]
+        ok = losses.sum(axis=1) > 0
+        if ok.any():
+            records = numpy.zeros(ok.sum(), monitor.elt_dt)
+            records['eid'] = eids[ok]
+            records['loss'] = losses[ok]
+            result['AGGLOSS'][l, r] = records
     for lr in ass:
         if ass[lr]:
             result['ASSLOSS'][lr] = numpy.concatenate(ass[lr])
@@ -244,9 +249,7 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                 for sr in sesruptures:
                     all_ruptures.append(sr)
         else:  # read the ruptures from the datastore
-            for serial in self.datastore['sescollection']:
-                rup = self.datastore['sescollection/' + serial]
-                all_ruptures.append(rup)
+            all_ruptures.extend(event_based.get_ruptures(self.datastore))
         all_ruptures.sort(key=operator.attrgetter('serial'))
         if not self.riskmodel.covs:
             # do not generate epsilons
@@ -321,10 +324,13 @@ class EventBasedRiskCalculator(base.RiskCalculator):
                 oq.concurrent_tasks or 1)
             # NB: I am using generators so that the tasks are submitted one at
             # the time, without keeping all of the arguments in memory
+            riskmodel = self.shared.share(self.riskmodel)
+            rlzs_assoc = self.shared.share(self.rlzs_assoc)
+            assetcol = self.shared.share(self.assetcol)
             res = starmap(
                 self.core_task.__func__,
-                ((riskinput, self.riskmodel, self.rlzs_assoc,
-                  self.assetcol, self.monitor.new('task'))
+                ((riskinput, riskmodel, rlzs_assoc,
+                  assetcol, self.monitor.new('task'))
                  for riskinput in riskinputs)).submit_all()
         acc = functools.reduce(self.agg, res, AccumDict())
         self.save_data_transfer(res)
@@ -388,12 +394,7 @@ class EventBasedRiskCalculator(base.RiskCalculator):
 
         self.vals = {}  # asset values by loss_type
         for ltype in ltypes:
-            asset_values = []
-            for assets in self.assets_by_site:
-                for asset in assets:
-                    asset_values.append(asset.value(
-                        ltype, self.oqparam.time_event))
-            self.vals[ltype] = numpy.array(asset_values)
+            self.vals[ltype] = self.assetcol.get_costs(ltype)
 
         # loss curves
         multi_lr_dt = numpy.dtype(
@@ -734,6 +735,8 @@ class EbriskCalculator(base.RiskCalculator):
         rlzs_assoc = ssm.info.get_rlzs_assoc(
             count_ruptures=lambda grp: len(ruptures_by_grp.get(grp.id, 0)))
         allargs = []
+        shared = (self.shared.share(riskmodel), self.shared.share(rlzs_assoc),
+                  self.shared.share(assetcol))
         # prepare the risk inputs
         ruptures_per_block = self.oqparam.ruptures_per_block
         for src_group in ssm.src_groups:
@@ -743,7 +746,7 @@ class EbriskCalculator(base.RiskCalculator):
                 ri = riskinput.RiskInputFromRuptures(
                     trt, imts, sitecol, rupts, trunc_level,
                     correl_model, min_iml)
-                allargs.append((ri, riskmodel, rlzs_assoc, assetcol, monitor))
+                allargs.append((ri,) + shared + (monitor,))
         taskname = '%s#%d' % (losses_by_taxonomy.__name__, ssm.sm_id + 1)
         smap = starmap(losses_by_taxonomy, allargs, name=taskname)
         attrs = dict(num_ruptures={
@@ -18,6 +18,7 @@
 
 import unittest
 import numpy
+from openquake.baselib.general import DictArray
 from openquake.commonlib import calc
 
 aaae = numpy.testing.assert_array_almost_equal
@@ -56,3 +57,32 @@ class HazardMapsTestCase(unittest.TestCase):
         ]
         actual = calc.compute_hazard_maps(numpy.array(curves), imls, poes)
         aaae(expected, actual.T)
+
+    def test_make_hmap_array(self):
+        imls = [0.005, 0.007, 0.0098]
+        imtls = DictArray({'PGA': imls, 'PGV': imls})
+        curves = numpy.array([
+            [0.8, 0.5, 0.1, 0.98, 0.15, 0.05],
+            [0.6, 0.5, 0.4, 0.1, 0.01, 0.001],
+        ])
+        poes = [0.1, 0.2]
+        expected = [[0.0098, 0.00847798, 0.00792555, 0.00664814],
+                    [0.0098, 0.0098, 0.005, 0]]
+        aaae(expected, calc.make_hmap_array(curves, imtls, poes))
+
+
+class GmvsToCountsTestCase(unittest.TestCase):
+
+    def test_gmvs_to_counts(self):
+        imtls = DictArray({'PGA': [0.01, 0.1, 0.5], 'PGV': [0.05, 0.2]})
+        gmv_dt = numpy.dtype([('sid', numpy.uint32), ('eid', numpy.uint32),
+                              ('imti', numpy.uint8), ('gmv', numpy.float32)])
+        gmfa = numpy.array([(2, 0, 0, 0.05), (2, 1, 0, 0.6), (2, 0, 1, 0.1),
+                            (7, 0, 0, 0.2), (7, 1, 1, 0.3)], gmv_dt)
+        counts = calc.gmvs_to_counts(gmfa, numpy.array([2, 5, 7]), imtls)
+        numpy.testing.assert_equal(counts, [[2, 1, 1, 1, 0],
+                                            [0, 0, 0, 0, 0],
+                                            [1, 1, 0, 1, 1]])
+        poes = calc.counts_to_poes(counts, 50., 500.)
+        aaae(poes[0, :3], calc._gmvs_to_haz_curve(
+            [0.05, 0.6], [0.01, 0.1, 0.5], 50., 500.))
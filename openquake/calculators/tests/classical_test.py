@@ -54,6 +54,11 @@ class ClassicalTestCase(CalculatorTestCase):
         # there is a single source
         self.assertEqual(len(self.calc.datastore['source_info']), 1)
 
+        # the nbytes attribute is the size of the ProbabilityMap,
+        # 8 bytes x 1 site x 6 levels
+        self.assertEqual(self.calc.datastore.getitem(
+            'hcurves/rlz-000').attrs['nbytes'], 48)
+
     @attr('qa', 'hazard', 'classical')
     def test_sa_period_too_big(self):
         imtls = '{"SA(4.1)": [0.1, 0.4, 0.6]}'
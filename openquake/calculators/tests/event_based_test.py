@@ -20,15 +20,23 @@ from __future__ import division
 import os
 import re
 import math
+import shutil
+import tempfile
+import unittest
 from nose.plugins.attrib import attr
 
 import numpy.testing
 
 from openquake.baselib.general import group_array
-from openquake.commonlib.datastore import read
+from openquake.hazardlib import geo, source
+from openquake.hazardlib.source.rupture import ParametricProbabilisticRupture
+from openquake.hazardlib.tom import PoissonTOM
+from openquake.commonlib.datastore import read, DataStore
 from openquake.commonlib.util import max_rel_diff_index
 from openquake.commonlib.export import export
-from openquake.calculators.event_based import get_mean_curves
+from openquake.calculators.event_based import (
+    get_mean_curves, get_geom, get_code, store_ruptures, get_ruptures,
+    EBRupture, event_dt)
 from openquake.calculators.tests import CalculatorTestCase
 from openquake.qa_tests_data.event_based import (
     blocksize, case_1, case_2, case_4, case_5, case_6, case_7, case_12,
@@ -294,3 +302,117 @@ gmf-smltp_b3-gsimltp_@_@_@_b4_1.txt'''.split()
         self.assertEqual(str(ctx.exception),
                          'The event based calculator is restricted '
                          'to 256 imts, got 900')
+
+
+def make_planar(strike, dip, top_left, top_right, bottom_right, bottom_left):
+    return geo.PlanarSurface(
+        2., strike, dip, geo.Point(*top_left), geo.Point(*top_right),
+        geo.Point(*bottom_right), geo.Point(*bottom_left))
+
+
+def make_rupture(code):
+    # a rupture for each code of the columnar store
+    if code == 1:
+        surface = make_planar(0., 90., (0, 0, 1), (0, .1, 1),
+                              (0, .1, 11), (0, 0, 11))
+        typology = source.PointSource
+    elif code == 2:
+        surface = geo.SimpleFaultSurface.from_fault_data(
+            geo.Line([geo.Point(0, 0), geo.Point(.2, .1)]),
+            upper_seismogenic_depth=2., lower_seismogenic_depth=12.,
+            dip=45., mesh_spacing=2.)
+        typology = source.SimpleFaultSource
+    elif code == 3:
+        surface = geo.ComplexFaultSurface.from_fault_data(
+            [geo.Line([geo.Point(0, 0, 1), geo.Point(.2, 0, 1)]),
+             geo.Line([geo.Point(0, .1, 10), geo.Point(.2, .1, 12)])],
+            mesh_spacing=2.)
+        typology = source.ComplexFaultSource
+    else:  # a multi surface is stored pickled
+        surface = geo.MultiSurface([
+            make_planar(0., 90., (0, 0, 1), (0, .1, 1),
+                        (0, .1, 11), (0, 0, 11)),
+            make_planar(0., 90., (0, .1, 1), (0, .2, 1),
+                        (0, .2, 11), (0, .1, 11))])
+        typology = source.CharacteristicFaultSource
+    rup = ParametricProbabilisticRupture(
+        5. + code / 10., 10. * code, 'Active Shallow Crust',
+        geo.Point(0, .05, 6.), surface, typology, .01, PoissonTOM(50.))
+    rup.seed = 42 + code
+    return rup
+
+
+class RuptureStoreTestCase(unittest.TestCase):
+    codes = [1, 2, 3, 0]
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.dstore = DataStore(datadir=self.datadir)
+        self.ebruptures = []
+        eid = 0
+        for serial, code in enumerate(self.codes):
+            rup = make_rupture(code)
+            self.assertEqual(get_code(rup), code)
+            num_events = code + 1
+            events = numpy.zeros(num_events, event_dt)
+            events['eid'] = numpy.arange(eid, eid + num_events)
+            events['ses'] = 1
+            events['occ'] = numpy.arange(num_events)
+            eid += num_events
+            sids = numpy.arange(code, code + 3, dtype=numpy.uint32)
+            self.ebruptures.append(EBRupture(
+                rup, sids, events, 'src%d' % code, code % 2, serial))
+        # two calls, to check the offsets of the appended ruptures
+        store_ruptures(self.dstore, self.ebruptures[:2])
+        store_ruptures(self.dstore, self.ebruptures[2:])
+        self.trt_by_grp = {0: 'Active Shallow Crust',
+                           1: 'Active Shallow Crust'}
+
+    def tearDown(self):
+        self.dstore.close()
+        shutil.rmtree(self.datadir)
+
+    def assert_same(self, ebr, exp):
+        rup, expected = ebr.rupture, exp.rupture
+        self.assertEqual(ebr.serial, exp.serial)
+        self.assertEqual(ebr.grp_id, exp.grp_id)
+        self.assertEqual(ebr.source_id, exp.source_id)
+        self.assertEqual(rup.mag, expected.mag)
+        self.assertEqual(rup.rake, expected.rake)
+        self.assertEqual(rup.seed, expected.seed)
+        self.assertEqual(rup.tectonic_region_type,
+                         expected.tectonic_region_type)
+        self.assertEqual(rup.hypocenter, expected.hypocenter)
+        numpy.testing.assert_equal(ebr.events, exp.events)
+        numpy.testing.assert_equal(ebr.indices, exp.indices)
+        if isinstance(expected.surface, geo.MultiSurface):
+            self.assertIsInstance(rup.surface, geo.MultiSurface)
+            numpy.testing.assert_allclose(
+                get_geom(rup.surface, False, True),
+                get_geom(expected.surface, False, True))
+        else:
+            self.assertIs(type(rup.surface), type(expected.surface))
+            mesh, exp_mesh = (rup.surface.get_mesh(),
+                              expected.surface.get_mesh())
+            numpy.testing.assert_allclose(mesh.lons, exp_mesh.lons)
+            numpy.testing.assert_allclose(mesh.lats, exp_mesh.lats)
+            numpy.testing.assert_allclose(mesh.depths, exp_mesh.depths)
+
+    def test_round_trip(self):
+        ebruptures = get_ruptures(self.dstore, trt_by_grp=self.trt_by_grp)
+        self.assertEqual(len(ebruptures), len(self.codes))
+        for ebr, exp in zip(ebruptures, self.ebruptures):
+            self.assert_same(ebr, exp)
+
+    def test_partial_slice(self):
+        # the simple fault, the complex fault and the pickled rupture
+        ebruptures = get_ruptures(
+            self.dstore, slice(1, 4), trt_by_grp=self.trt_by_grp)
+        self.assertEqual(len(ebruptures), 3)
+        for ebr, exp in zip(ebruptures, self.ebruptures[1:]):
+            self.assert_same(ebr, exp)
+        # a single rupture in the middle
+        [ebr] = get_ruptures(
+            self.dstore, slice(2, 3), trt_by_grp=self.trt_by_grp)
+        self.assert_same(ebr, self.ebruptures[2])
+        self.assertEqual(get_ruptures(self.dstore, slice(4, 4)), [])
@@ -31,7 +31,6 @@ import numpy
 
 from openquake.baselib.general import AccumDict
 from openquake.baselib.python3compat import zip
-from openquake.hazardlib.probability_map import ProbabilityMap
 from openquake.risklib import valid, riskinput
 from openquake.commonlib import readinput, parallel, source, calc
 from openquake.calculators import base, event_based
@@ -712,7 +711,7 @@ def compute_ruptures_gmfs_curves(
                     serial += 1
                     rupdic.num_events += len(events)
         res['ruptures'][grp_id] = ses_ruptures
-        gsims = [dic[DEFAULT_TRT] for dic in rlzs_assoc.gsim_by_trt]
+        gsims = rlzs_assoc.get_gsims(DEFAULT_TRT)
         gg = riskinput.GmfGetter(gsims, ses_ruptures, sitecol,
                                  imts, min_iml, oq.truncation_level,
                                  correl_model, rlzs_assoc.samples[grp_id])
@@ -786,15 +785,12 @@ class UCERFEventBasedCalculator(event_based.EventBasedCalculator):
             compute_ruptures_gmfs_curves,
             (self.csm.source_models, self.sitecol, self.rlzs_assoc, monitor),
             concurrent_tasks=self.oqparam.concurrent_tasks).submit_all()
-        L = len(self.oqparam.imtls.array)
-        acc = {rlz.ordinal: ProbabilityMap(L, 1)
-               for rlz in self.rlzs_assoc.realizations}
-        data = functools.reduce(
-            self.combine_pmaps_and_save_gmfs, res, AccumDict(acc))
+        acc = functools.reduce(
+            self.combine_pmaps_and_save_gmfs, res, AccumDict())
         self.save_data_transfer(res)
         self.datastore['csm_info'] = self.csm.info
         self.datastore['source_info'] = numpy.array(
             self.infos, source.SourceInfo.dt)
         if 'gmf_data' in self.datastore:
             self.datastore.set_nbytes('gmf_data')
-        return data
+        return self.build_pmaps(acc)
@@ -524,13 +524,16 @@ def get_max_gmf_size(dstore):
     rlzs_by_grp_id = dstore['csm_info'].get_rlzs_assoc().get_rlzs_by_grp_id()
     n_ruptures = collections.Counter()
     size = collections.Counter()  # by grp_id
-    for serial in dstore['sescollection']:
-        ebr = dstore['sescollection/' + serial]
-        grp_id = ebr.grp_id
-        n_ruptures[grp_id] += 1
+    ruptures = dstore['sescollection'].value
+    num_sites = ruptures['sidx2'] - ruptures['sidx1']
+    multiplicity = ruptures['eidx2'] - ruptures['eidx1']
+    for grp_id in numpy.unique(ruptures['grp_id']):
+        grp_id = int(grp_id)
+        ok = ruptures['grp_id'] == grp_id
+        n_ruptures[grp_id] = ok.sum()
         # there are 4 bytes per float
-        size[grp_id] += (len(ebr.indices) * ebr.multiplicity *
-                         len(rlzs_by_grp_id[grp_id]) * n_imts) * 4
+        size[grp_id] = int((num_sites[ok] * multiplicity[ok]).sum()) * (
+            len(rlzs_by_grp_id[grp_id]) * n_imts) * 4
     [(grp_id, maxsize)] = size.most_common(1)
     return dict(n_imts=n_imts, size=maxsize, n_ruptures=n_ruptures[grp_id],
                 n_rlzs=len(rlzs_by_grp_id[grp_id]),
@@ -673,6 +676,37 @@ def view_task_info(token, dstore):
     return rst_table(data)
 
 
+@view.add('profile')
+def view_profile(token, dstore):
+    """
+    Display the functions with the largest internal time in the profiled
+    tasks, by summing the statistics of all the tasks of the same kind.
+    The tasks are profiled only if the environment variable OQ_PROFILE
+    is set (see :func:`openquake.commonlib.parallel.oq_profile`)::
+
+      $ OQ_PROFILE=10 oq run job.ini
+      $ oq show profile
+      $ oq show profile:classical
+    """
+    if 'performance_profile' not in dstore:
+        return 'Not available'
+    args = token.split(':')[1:]  # called as profile:task_name
+    tables = []
+    for task in args or sorted(dstore['performance_profile']):
+        array = dstore['performance_profile/' + task].value
+        funcs, inv = numpy.unique(array['func'], return_inverse=True)
+        ncalls = numpy.bincount(inv, array['ncalls'])
+        tottime = numpy.bincount(inv, array['tottime'])
+        cumtime = numpy.bincount(inv, array['cumtime'])
+        data = [(decode(funcs[i]), int(ncalls[i]), tottime[i], cumtime[i])
+                for i in tottime.argsort()[::-1][:20]]
+        ntasks = len(numpy.unique(array['taskno']))
+        tables.append('%s (%d profiled tasks)\n%s' % (
+            task, ntasks, rst_table(
+                data, header=['function', 'ncalls', 'tottime', 'cumtime'])))
+    return '\n\n'.join(tables)
+
+
 @view.add('task_durations')
 def view_task_durations(token, dstore):
     """
@@ -25,7 +25,8 @@ from openquake.server import dbserver as dbs
 @sap.Script
 def dbserver(cmd):
     """
-    start/stop/restart the database server, or return its status
+    start/stop/restart the database server, or return its status and
+    statistics about the latency of the actions
     """
     if valid.boolean(config.get('dbserver', 'multi_user')):
         sys.exit('oq dbserver only works in single user mode')
@@ -33,6 +34,14 @@ def dbserver(cmd):
     status = dbs.get_status()
     if cmd == 'status':
         print('dbserver ' + status)
+    elif cmd == 'stats':
+        if status == 'running':
+            stats = logs.dbcmd('stats')
+            print('queue depth: %(pending)s, max: %(max_pending)s' % stats)
+            for rec in stats['latency']:
+                print('%-24s calls=%-6d mean=%.4fs max=%.4fs' % rec)
+        else:
+            print('dbserver ' + status)
     elif cmd == 'stop':
         if status == 'running':
             logs.dbcmd('stop')
@@ -51,4 +60,4 @@ def dbserver(cmd):
         dbs.run_server()
 
 dbserver.arg('cmd', 'dbserver command',
-             choices='start stop status restart'.split())
+             choices='start stop status stats restart'.split())
@@ -21,11 +21,10 @@ import collections
 import itertools
 import operator
 import logging
-import copy
 
 import numpy
 
-from openquake.baselib.general import get_array, group_array, AccumDict
+from openquake.baselib.general import get_array, group_array
 from openquake.hazardlib.imt import from_string
 from openquake.hazardlib.calc import filters
 from openquake.hazardlib.probability_map import ProbabilityMap
@@ -50,23 +49,118 @@ SourceRuptureSites = collections.namedtuple(
     'source rupture sites')
 
 
-# used in classical and event_based calculators
-def combine_pmaps(rlzs_assoc, results):
+def _dense(pmap, sids):
+    # convert a ProbabilityMap into an array of shape (N, L, G), with zeros
+    # for the sites missing in the map
+    array = numpy.zeros((len(sids), pmap.shape_y, pmap.shape_z))
+    keys = numpy.array(sorted(pmap), numpy.uint32)
+    if len(keys):
+        array[numpy.searchsorted(sids, keys)] = [
+            pmap[sid].array for sid in keys]
+    return array
+
+
+def quantile_curves(curves, quantile, weights=None):
+    """
+    Vectorized version of :func:`openquake.hazardlib.stats.quantile_curve`.
+
+    :param curves: an array of R curves of shape (R, ...)
+    :param quantile: the quantile value
+    :param weights: the weights of the curves (or None)
+    :returns: the quantile curves, an array of shape (...)
     """
-    :param rlzs_assoc: a :class:`openquake.commonlib.source.RlzsAssoc` instance
-    :param results: dictionary src_group_id -> probability map
-    :returns: a dictionary rlz -> aggregate probability map
+    R = len(curves)
+    if R == 1:
+        return curves[0]
+    data = numpy.sort(curves, axis=0)
+    if weights is None:
+        # same as the mstats.mquantiles algorithm used in hazardlib
+        aleph = R * quantile + 0.4 + quantile * 0.2
+        k = int(numpy.floor(numpy.clip(aleph, 1, R - 1)))
+        gamma = numpy.clip(aleph - k, 0, 1)
+        return (1. - gamma) * data[k - 1] + gamma * data[k]
+    # interpolate on the cumulative weights of the sorted curves, as
+    # numpy.interp(quantile, cum_weights, sorted_poes) for each point
+    shape = curves.shape[1:]
+    data = data.reshape(R, -1)
+    order = numpy.argsort(curves.reshape(R, -1), axis=0)
+    cum = numpy.cumsum(numpy.asarray(weights, F64)[order], axis=0)
+    j = numpy.clip((cum < quantile).sum(axis=0), 1, R - 1)
+    cols = numpy.arange(data.shape[1])
+    x0, x1 = cum[j - 1, cols], cum[j, cols]
+    y0, y1 = data[j - 1, cols], data[j, cols]
+    dx = numpy.where(x1 > x0, x1 - x0, 1.)
+    frac = numpy.clip((quantile - x0) / dx, 0, 1)
+    return (y0 + frac * (y1 - y0)).reshape(shape)
+
+
+class HazardStats(object):
     """
-    acc = AccumDict()
-    for grp_id in results:
-        for i, gsim in enumerate(rlzs_assoc.gsims_by_grp_id[grp_id]):
-            pmap = results[grp_id].extract(i)
-            for rlz in rlzs_assoc.rlzs_assoc[grp_id, gsim]:
-                if rlz in acc:
-                    acc[rlz] |= pmap
-                else:
-                    acc[rlz] = copy.copy(pmap)
-    return acc
+    Compute the mean and quantile hazard curves incrementally: the curves
+    of each realization are generated from the (grp_id, gsim) contributions
+    and immediately accumulated, so that the curves of all realizations
+    are never in memory at the same time. The quantiles are exact, since
+    they are computed on blocks of sites small enough to keep the buffer
+    of the realization curves under `maxbytes`.
+
+    :param quantiles: a list of quantiles
+    :param weights: the weights of the realizations (None for sampling)
+    :param maxbytes: the maximum size of the buffer for the quantiles
+    """
+    def __init__(self, quantiles, weights=None, maxbytes=100 * 1024 ** 2):
+        self.quantiles = quantiles
+        self.weights = None if weights is None else numpy.array(
+            [float(w) for w in weights])
+        self.maxbytes = maxbytes
+        self.names = ['mean'] + ['quantile-%s' % q for q in quantiles]
+
+    def compute(self, rlzs_assoc, pmap_by_grp, sids, individual_curves=False):
+        """
+        :param rlzs_assoc: a :class:`openquake.commonlib.source.RlzsAssoc`
+        :param pmap_by_grp: dictionary src_group_id -> probability map
+        :param sids: the ordered site IDs
+        :param individual_curves: if True, return also the realizations
+        :returns: a dictionary kind -> array of shape (N, L)
+        """
+        rlzs = rlzs_assoc.realizations
+        R, N = len(rlzs), len(sids)
+        rlzi = {rlz: i for i, rlz in enumerate(rlzs)}
+        arrays = {grp_id: _dense(pmap, sids)
+                  for grp_id, pmap in pmap_by_grp.items()}
+        L = next(iter(pmap_by_grp.values())).shape_y
+        contribs = [[] for _ in rlzs]  # (grp_id, gsim index) per realization
+        for grp_id in arrays:
+            for g, gsim in enumerate(rlzs_assoc.gsims_by_grp_id[grp_id]):
+                for rlz in rlzs_assoc.rlzs_assoc[grp_id, gsim]:
+                    contribs[rlzi[rlz]].append((grp_id, g))
+        weights = (numpy.ones(R) / R if self.weights is None
+                   else self.weights)
+        out = {name: numpy.zeros((N, L)) for name in self.names}
+        if individual_curves:
+            for rlz in rlzs:
+                out['rlz-%03d' % rlz.ordinal] = numpy.zeros((N, L))
+        size = (max(1, self.maxbytes // (R * L * 8)) if self.quantiles
+                else N)
+        for start in range(0, N, size):
+            slc = slice(start, start + size)
+            n = len(sids[slc])
+            if self.quantiles:
+                buf = numpy.zeros((R, n, L))
+            for i, rlz in enumerate(rlzs):
+                noexceed = numpy.ones((n, L))
+                for grp_id, g in contribs[i]:
+                    noexceed *= 1. - arrays[grp_id][slc, :, g]
+                curve = 1. - noexceed
+                out['mean'][slc] += weights[i] * curve
+                if self.quantiles:
+                    buf[i] = curve
+                if individual_curves:
+                    out['rlz-%03d' % rlz.ordinal][slc] = curve
+            for q in self.quantiles:
+                out['quantile-%s' % q][slc] = quantile_curves(
+                    buf, q, self.weights)
+        out['mean'] /= weights.sum()
+        return out
 
 # ######################### hazard maps ################################### #
 
@@ -108,31 +202,41 @@ def compute_hazard_maps(curves, imls, poes):
     if L != len(imls):
         raise ValueError('The curves have %d levels, %d were passed' %
                          (L, len(imls)))
-    result = []
-    imls = numpy.log(numpy.array(imls[::-1]))
-    for curve in curves:
-        # the hazard curve, having replaced the too small poes with EPSILON
-        curve_cutoff = [max(poe, EPSILON) for poe in curve[::-1]]
-        hmap_val = []
-        for poe in poes:
-            # special case when the interpolation poe is bigger than the
-            # maximum, i.e the iml must be smaller than the minumum
-            if poe > curve_cutoff[-1]:  # the greatest poes in the curve
-                # extrapolate the iml to zero as per
-                # https://bugs.launchpad.net/oq-engine/+bug/1292093
-                # a consequence is that if all poes are zero any poe > 0
-                # is big and the hmap goes automatically to zero
-                hmap_val.append(0)
-            else:
-                # exp-log interpolation, to reduce numerical errors
-                # see https://bugs.launchpad.net/oq-engine/+bug/1252770
-                val = numpy.exp(
-                    numpy.interp(
-                        numpy.log(poe), numpy.log(curve_cutoff), imls))
-                hmap_val.append(val)
-
-        result.append(hmap_val)
-    return numpy.array(result)
+    # exp-log interpolation, to reduce numerical errors
+    # see https://bugs.launchpad.net/oq-engine/+bug/1252770
+    imls = numpy.log(numpy.array(imls[::-1], F64))
+    # the hazard curves, having replaced the too small poes with EPSILON;
+    # the PoEs are reversed so that they are increasing along the rows
+    logcurves = numpy.log(numpy.maximum(
+        numpy.array(curves[:, ::-1], F64), EPSILON))  # shape (N, L)
+    logpoes = numpy.log(poes)[numpy.newaxis, :]  # shape (1, P)
+    N, P = len(curves), len(poes)
+    if L == 1:
+        result = numpy.exp(numpy.repeat(imls, N * P).reshape(N, P))
+    else:
+        # index of the last PoE in each curve not above the given poe,
+        # computed level by level to keep the memory occupation O(N x P)
+        idx = numpy.zeros((N, P), numpy.int64)
+        for l in range(L):
+            idx += logcurves[:, l:l + 1] <= logpoes
+        idx = numpy.clip(idx - 1, 0, L - 2)
+        rows = numpy.arange(N)[:, numpy.newaxis]
+        x0, x1 = logcurves[rows, idx], logcurves[rows, idx + 1]
+        dx = x1 - x0
+        # same semantics as numpy.interp: the values outside the curve are
+        # clamped to the extremes
+        frac = numpy.where(
+            dx > 0, numpy.clip((logpoes - x0) / numpy.where(dx > 0, dx, 1),
+                               0, 1), logpoes >= x1)
+        result = numpy.exp(imls[idx] + frac * (imls[idx + 1] - imls[idx]))
+    # special case when the interpolation poe is bigger than the
+    # maximum, i.e the iml must be smaller than the minumum;
+    # extrapolate the iml to zero as per
+    # https://bugs.launchpad.net/oq-engine/+bug/1292093
+    # a consequence is that if all poes are zero any poe > 0
+    # is big and the hmap goes automatically to zero
+    result[logpoes > logcurves[:, -1:]] = 0
+    return result
 
 
 # #########################  GMF->curves #################################### #
@@ -175,6 +279,42 @@ def _gmvs_to_haz_curve(gmvs, imls, invest_time, duration):
     return poes
 
 
+def gmvs_to_counts(gmfa, sids, imtls):
+    """
+    Count the ground motion values exceeding the intensity measure levels,
+    for all sites and IMTs at once.
+
+    :param gmfa: an array of dtype gmv_dt with fields sid, imti, gmv
+    :param sids: N ordered site IDs
+    :param imtls: a DictArray with I intensity measure types and L levels
+    :returns: an array of shape (N, L) with the number of exceedances
+    """
+    N = len(sids)
+    counts = numpy.zeros((N, len(imtls.array)), U32)
+    sidx = numpy.searchsorted(sids, gmfa['sid'])
+    for imti, imt in enumerate(imtls):
+        ok = gmfa['imti'] == imti
+        idx, gmvs = sidx[ok], gmfa['gmv'][ok]
+        start = imtls.slicedic[imt].start
+        for l, iml in enumerate(imtls[imt]):
+            counts[:, start + l] = numpy.bincount(
+                idx[gmvs >= iml], minlength=N)
+    return counts
+
+
+def counts_to_poes(counts, invest_time, duration):
+    """
+    Convert the number of exceedances into probabilities of exceedance,
+    with the same formula used in :func:`_gmvs_to_haz_curve`.
+
+    :param counts: an array of exceedance counts
+    :param float invest_time: investigation time, in years
+    :param float duration: investigation time times the number of SES
+    :returns: an array of PoEs with the same shape as `counts`
+    """
+    return 1 - numpy.exp(- (invest_time / duration) * counts)
+
+
 # ################## utilities for classical calculators ################ #
 
 def get_imts_periods(imtls):
@@ -193,6 +333,23 @@ def get_imts_periods(imtls):
     return [str(imt) for imt in imts], [imt[1] or 0.0 for imt in imts]
 
 
+def make_hmap_array(curves, imtls, poes):
+    """
+    Compute the hazard maps associated to the passed hazard curves.
+
+    :param curves: an array of shape (N, L) with the hazard curves
+    :param imtls: I intensity measure types and levels
+    :param poes: P PoEs where to compute the maps
+    :returns: an array of shape (N, I * P)
+    """
+    I, P = len(imtls), len(poes)
+    hmap = numpy.zeros((len(curves), I * P))
+    for i, imt in enumerate(imtls):
+        hmap[:, i * P:(i + 1) * P] = compute_hazard_maps(
+            curves[:, imtls.slicedic[imt]], imtls[imt], poes)
+    return hmap
+
+
 def make_hmap(pmap, imtls, poes):
     """
     Compute the hazard maps associated to the passed probability map.
@@ -204,14 +361,12 @@ def make_hmap(pmap, imtls, poes):
     """
     I, P = len(imtls), len(poes)
     hmap = ProbabilityMap.build(I * P, 1, pmap)
-    for i, imt in enumerate(imtls):
-        curves = numpy.array([pmap[sid].array[imtls.slicedic[imt], 0]
-                              for sid in pmap.sids])
-        data = compute_hazard_maps(curves, imtls[imt], poes)  # array N x P
-        for sid, value in zip(pmap.sids, data):
-            array = hmap[sid].array
-            for j, val in enumerate(value):
-                array[i * P + j] = val
+    if not len(pmap):
+        return hmap
+    sids = sorted(pmap)
+    curves = numpy.array([pmap[sid].array[:, 0] for sid in sids])
+    for sid, value in zip(sids, make_hmap_array(curves, imtls, poes)):
+        hmap[sid].array[:, 0] = value
     return hmap
 
 
@@ -232,14 +387,15 @@ def make_uhs(pmap, imtls, poes, nsites):
         an composite array containing nsites uniform hazard maps
     """
     P = len(poes)
-    array = make_hmap(pmap, imtls, poes).array  # size (N, I x P, 1)
+    curves = numpy.array([pmap[sid].array[:, 0] for sid in sorted(pmap)])
+    array = make_hmap_array(curves, imtls, poes)  # size (N, I x P)
     imts, _ = get_imts_periods(imtls)
     imts_dt = numpy.dtype([(str(imt), F64) for imt in imts])
     uhs_dt = numpy.dtype([(str(poe), imts_dt) for poe in poes])
     uhs = numpy.zeros(nsites, uhs_dt)
     for j, poe in enumerate(map(str, poes)):
         for i, imt in enumerate(imts):
-            uhs[poe][imt] = array[:, i * P + j, 0]
+            uhs[poe][imt] = array[:, i * P + j]
     return uhs
 
 
@@ -111,12 +111,12 @@ def export_ses_xml(ekey, dstore):
     :param ekey: export key, i.e. a pair (datastore key, fmt)
     :param dstore: datastore object
     """
+    from openquake.calculators.event_based import get_ruptures
     fmt = ekey[-1]
     oq = dstore['oqparam']
     mesh = get_mesh(dstore['sitecol'])
     ruptures = []
-    for serial in dstore['sescollection']:
-        sr = dstore['sescollection/' + serial]
+    for sr in get_ruptures(dstore):
         ruptures.extend(sr.export(mesh))
     ses_coll = SESCollection(
         groupby(ruptures, operator.attrgetter('ses_idx')),
@@ -356,6 +356,25 @@ def hazard_curve_name(dstore, ekey, kind, rlzs_assoc):
     return fname
 
 
+def get_hmap(dstore, kind, hcurves=None):
+    """
+    :param dstore: a datastore
+    :param kind: a string 'rlz-XXX', 'mean' or 'quantile-XXX'
+    :param hcurves: the hazard curves of the given kind, if already read
+    :returns: the hazard maps as a ProbabilityMap of shape (N, I * P, 1)
+
+    The maps saved by the classical calculator are used if present,
+    otherwise they are computed from the hazard curves.
+    """
+    key = 'hmaps/' + kind
+    if key in dstore:
+        return dstore[key]
+    if hcurves is None:
+        hcurves = dstore['hcurves/' + kind]
+    oq = dstore['oqparam']
+    return calc.make_hmap(hcurves, oq.imtls, oq.poes)
+
+
 def _comment(rlzs_assoc, kind, investigation_time):
     rlz = rlzs_assoc.get_rlz(kind)
     if not rlz:
@@ -395,7 +414,7 @@ def export_hcurves_csv(ekey, dstore):
                 comment=comment)
             fnames.append(fname)
         elif key == 'hmaps':
-            hmap = calc.make_hmap(hcurves, oq.imtls, oq.poes)
+            hmap = get_hmap(dstore, kind, hcurves)
             fnames.extend(
                 export_hazard_csv(ekey, fname, sitemesh, hmap, pdic, comment))
         else:
@@ -522,9 +541,7 @@ def export_hmaps_xml_json(ekey, dstore):
     pdic = DictArray({imt: oq.poes for imt in oq.imtls})
     nsites = len(sitemesh)
     for kind in dstore['hcurves']:
-        hcurves = dstore['hcurves/' + kind]
-        hmaps = calc.make_hmap(
-            hcurves, oq.imtls, oq.poes).convert(pdic, nsites)
+        hmaps = get_hmap(dstore, kind).convert(pdic, nsites)
         if kind.startswith('rlz-'):
             rlz = rlzs_assoc.realizations[int(kind[4:])]
             smlt_path = '_'.join(rlz.sm_lt_path)
@@ -592,8 +609,7 @@ def export_hmaps_hdf5(ekey, dstore):
     fname = dstore.export_path('%s.%s' % ekey)
     with hdf5.File(fname, 'w') as f:
         for dskey in dstore['hcurves']:
-            hcurves = dstore['hcurves/%s' % dskey]
-            hmap = calc.make_hmap(hcurves, oq.imtls, oq.poes)
+            hmap = get_hmap(dstore, dskey)
             f['hmaps/%s' % dskey] = convert_to_array(hmap, mesh, pdic)
     return [fname]
 
@@ -728,6 +744,7 @@ def export_gmf_txt(key, dest, sitecol, imts, ruptures, rlz,
 
 
 def _calc_gmfs(dstore, serial, eid):
+    from openquake.calculators.event_based import get_ruptures
     oq = dstore['oqparam']
     min_iml = calc.fix_minimum_intensity(oq.minimum_intensity, oq.imtls)
     csm_info = dstore['csm_info']
@@ -735,7 +752,9 @@ def _calc_gmfs(dstore, serial, eid):
     rlzs = rlzs_assoc.realizations
     sitecol = dstore['sitecol'].complete
     N = len(sitecol.complete)
-    rup = dstore['sescollection/' + serial]
+    serials = dstore['sescollection']['serial']
+    [idx] = numpy.where(serials == int(serial))[0]
+    [rup] = get_ruptures(dstore, slice(idx, idx + 1))
     correl_model = oq.get_correl_model()
     realizations = rlzs_assoc.get_rlzs_by_grp_id()[rup.grp_id]
     gmf_dt = numpy.dtype([('%03d' % rlz.ordinal, F64) for rlz in realizations])
@@ -743,7 +762,7 @@ def _calc_gmfs(dstore, serial, eid):
         for sg in sm.src_groups:
             if sg.id == rup.grp_id:
                 break
-    gsims = [dic[sg.trt] for dic in rlzs_assoc.gsim_by_trt]
+    gsims = rlzs_assoc.get_gsims(sg.trt)
     getter = GmfGetter(gsims, [rup], sitecol,
                        oq.imtls, min_iml, oq.truncation_level,
                        correl_model, rlzs_assoc.samples[sg.id])
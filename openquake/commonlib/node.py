@@ -583,7 +583,8 @@ def context(fname, node):
 class ValidatingXmlParser(object):
     """
     Validating XML Parser based on Expat. It has two methods `.parse_file`
-    and `.parse_bytes` returning a validated :class:`Node` object.
+    and `.parse_bytes` returning a validated :class:`Node` object and a
+    method `.iterparse` yielding validated nodes with a given tag.
 
     :param validators: a dictionary of validation functions
     :param stop: the tag where to stop the parsing (if any)
@@ -591,6 +592,8 @@ class ValidatingXmlParser(object):
     class Exit(Exception):
         """Raised when the parsing is stopped before the end on purpose"""
 
+    bufsize = 1024 * 1024  # bytes read at once by .iterparse
+
     def __init__(self, validators, stop=None):
         self.validators = validators
         self.stop = stop
@@ -603,6 +606,8 @@ class ValidatingXmlParser(object):
         self.p.CharacterDataHandler = self._char_data
         self._ancestors = []
         self._root = None
+        self._tag = None  # tag of the nodes to yield in .iterparse
+        self._completed = []
         try:
             yield
         except ExpatError as err:
@@ -645,6 +650,40 @@ class ValidatingXmlParser(object):
                     self.p.ParseFile(f)
         return self._root
 
+    def iterparse(self, file_or_fname, tag):
+        """
+        Parse a file or a filename incrementally, yielding the validated
+        nodes with the given tag as soon as they are complete. Such nodes
+        are not attached to their parents, so the full tree is never kept
+        in memory; at the end `.root` contains the rest of the tree.
+        """
+        with self._context():
+            self._tag = tag
+            if hasattr(file_or_fname, 'read'):
+                self.filename = getattr(
+                    file_or_fname, 'name', file_or_fname.__class__.__name__)
+                f = file_or_fname
+            else:
+                self.filename = file_or_fname
+                f = open(file_or_fname, 'rb')
+            try:
+                while True:
+                    data = f.read(self.bufsize)
+                    self.p.Parse(data, not data)
+                    for node in self._completed:
+                        yield node
+                    del self._completed[:]
+                    if not data:
+                        break
+            finally:
+                if f is not file_or_fname:
+                    f.close()
+
+    @property
+    def root(self):
+        """The last root node parsed"""
+        return self._root
+
     def _start_element(self, name, attrs):
         self._ancestors.append(
             Node('{' + name, attrs, lineno=self.p.CurrentLineNumber))
@@ -658,7 +697,9 @@ class ValidatingXmlParser(object):
         with context(self.filename, node):
             self._root = self._literalnode(node)
         del self._ancestors[-1]
-        if self._ancestors:
+        if self._tag and striptag(node.tag) == self._tag:
+            self._completed.append(node)  # not attached to the parent
+        elif self._ancestors:
             self._ancestors[-1].append(self._root)
 
     def _char_data(self, data):
@@ -23,18 +23,23 @@ from __future__ import print_function
 import os
 import sys
 import time
+import shutil
 import socket
+import uuid
 import inspect
 import logging
 import operator
 import traceback
 import functools
+import cProfile
+import pstats
 import multiprocessing.dummy
-from concurrent.futures import as_completed, ProcessPoolExecutor, Future
+from concurrent.futures import (
+    as_completed, wait, FIRST_COMPLETED, ProcessPoolExecutor, Future)
 import numpy
 
 from openquake.baselib import hdf5
-from openquake.baselib.python3compat import pickle
+from openquake.baselib.python3compat import pickle, encode
 from openquake.baselib.performance import Monitor, virtual_memory
 from openquake.baselib.general import (
     block_splitter, split_in_blocks, AccumDict, humansize)
@@ -58,6 +63,60 @@ elif OQ_DISTRIBUTE == 'ipython':
     import ipyparallel as ipp
 
 
+PROFILE_TOP = 50  # number of functions per task stored in the datastore
+profile_dt = numpy.dtype(
+    [('taskno', numpy.uint32), ('func', (bytes, 128)),
+     ('ncalls', numpy.uint32), ('tottime', numpy.float32),
+     ('cumtime', numpy.float32)])
+
+
+def oq_profile(task_no):
+    """
+    Return True if the task with the given number must be profiled,
+    according to the variable OQ_PROFILE: if undefined or 0 no task is
+    profiled, if 1 (or any non-numeric value) all tasks are profiled,
+    if N > 1 one task every N is profiled.
+    """
+    every = os.environ.get('OQ_PROFILE', '0')
+    try:
+        every = int(every)
+    except ValueError:
+        every = 1
+    return every > 0 and (task_no - 1) % every == 0
+
+
+def get_profile_array(profiler, task_no=0, top=PROFILE_TOP):
+    """
+    :param profiler: a cProfile.Profile instance, already run
+    :param task_no: the number of the profiled task
+    :param top: the number of functions to keep
+    :returns: an array of dtype profile_dt with the functions having the
+              largest internal time
+    """
+    stats = pstats.Stats(profiler).stats
+    items = sorted(stats.items(), key=lambda item: item[1][2],
+                   reverse=True)[:top]
+    array = numpy.zeros(len(items), profile_dt)
+    for i, ((fname, line, func), (cc, nc, tt, ct, _)) in enumerate(items):
+        name = '%s:%d(%s)' % (os.path.basename(fname), line, func)
+        array[i] = (task_no, encode(name), nc, tt, ct)
+    return array
+
+
+def _call(func, args, profiler=None):
+    # call the function, possibly under the profiler
+    if profiler:
+        profiler.enable()
+    try:
+        got = func(*args)
+        if inspect.isgenerator(got):
+            got = list(got)
+    finally:
+        if profiler:
+            profiler.disable()
+    return got
+
+
 def oq_distribute():
     """
     Return the current value of the variable OQ_DISTRIBUTE; if undefined,
@@ -101,6 +160,7 @@ def safely_call(func, args, pickle=False):
     with Monitor('total ' + func.__name__, measuremem=True) as child:
         if pickle:  # measure the unpickling time too
             args = [a.unpickle() for a in args]
+        args = [a.attach() if isinstance(a, Shared) else a for a in args]
         if args and isinstance(args[-1], Monitor):
             mon = args[-1]
             mon.children.append(child)  # child is a child of mon
@@ -109,15 +169,19 @@ def safely_call(func, args, pickle=False):
             mon = child
         check_mem_usage(mon)  # check if too much memory is used
         mon.flush = NoFlush(mon, func.__name__)
+        # the profiling is enabled by the controller, see oq_profile
+        profiler = cProfile.Profile() if getattr(
+            mon, 'profile', False) else None
         try:
-            got = func(*args)
-            if inspect.isgenerator(got):
-                got = list(got)
+            got = _call(func, args, profiler)
             res = got, None, mon
         except:
             etype, exc, tb = sys.exc_info()
             tb_str = ''.join(traceback.format_tb(tb))
             res = ('\n%s%s: %s' % (tb_str, etype.__name__, exc), etype, mon)
+        if profiler:
+            mon.profile_data = get_profile_array(
+                profiler, getattr(mon, 'task_no', 0))
 
         # NB: flush must not be called in the workers - they must not
         # have access to the datastore - so we remove it
@@ -201,6 +265,130 @@ def pickle_sequence(objects):
     return out
 
 
+class Shared(object):
+    """
+    A lightweight handle to a large object which has been stored in a file
+    once per calculation. The handle is sent to the tasks in place of the
+    object: the workers load the object the first time they need it and
+    keep it in a per-process cache. Numpy arrays are memory-mapped, so
+    that the workers on the same machine share the same pages; objects
+    with a `__toshare__` method are stored as an array plus the pickled
+    arguments of their `from_array` constructor, so that they are rebuilt
+    around the memory-mapped array.
+
+    :param path: the path of the file containing the object
+    :param clsname: the class name of the object
+    :param nbytes: the size of the file
+    :param cls: the class to rebuild the object, if any
+    """
+    cache = {}  # path -> object, populated in the workers
+
+    def __init__(self, path, clsname, nbytes, cls=None):
+        self.path = path
+        self.clsname = clsname
+        self.nbytes = nbytes
+        self.cls = cls
+
+    def attach(self):
+        """
+        :returns: the underlying object, reading it only the first time
+        """
+        try:
+            return self.cache[self.path]
+        except KeyError:
+            pass
+        dirname = os.path.dirname(self.path)
+        for path in list(self.cache):  # objects of a previous calculation
+            if os.path.dirname(path) != dirname:
+                del self.cache[path]
+        if self.path.endswith('.npy'):
+            obj = numpy.load(self.path, mmap_mode='r')
+            if self.cls is not None:  # rebuild the wrapper around the mmap
+                with open(self.path[:-4] + '.pik', 'rb') as f:
+                    args = pickle.load(f)
+                obj = self.cls.from_array(obj, *args)
+        else:
+            with open(self.path, 'rb') as f:
+                obj = pickle.load(f)
+        self.cache[self.path] = obj
+        return obj
+
+    def __repr__(self):
+        return '<Shared %s %s>' % (self.clsname, humansize(self.nbytes))
+
+
+class SharedRegistry(object):
+    """
+    A registry of objects shared between the tasks of a calculation.
+    Sharing works only when the tasks run on the same machine of the
+    controller, i.e. when OQ_DISTRIBUTE is "futures"; otherwise the objects
+    are returned unchanged and sent to the workers as usual.
+    The names of the files contain a token unique to the registry, so that
+    the workers never serve an object of a previous registry from
+    their cache, even if the directory is reused.
+
+    :param dirname: the directory where the shared objects are stored
+    """
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.token = uuid.uuid4().hex
+        self.handles = {}  # id(obj) -> Shared instance
+        self.objects = []  # keep the objects alive, so that ids are unique
+
+    @property
+    def nbytes(self):
+        """The total size of the shared objects"""
+        return sum(h.nbytes for h in self.handles.values())
+
+    def share(self, obj):
+        """
+        :param obj: a large object, the same for all tasks
+        :returns: a Shared instance or the object itself
+        """
+        if oq_distribute() != 'futures':
+            return obj
+        try:
+            return self.handles[id(obj)]
+        except KeyError:
+            pass
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        path = os.path.join(
+            self.dirname, '%s-%d' % (self.token, len(self.handles)))
+        cls = None
+        if hasattr(obj, '__toshare__'):
+            # store the array and the arguments to rebuild the object
+            cls = obj.__class__
+            array, args = obj.__toshare__()
+            with open(path + '.pik', 'wb') as f:
+                pickle.dump(args, f, pickle.HIGHEST_PROTOCOL)
+            nbytes = os.path.getsize(path + '.pik')
+            path += '.npy'
+            numpy.save(path, array)
+        elif isinstance(obj, numpy.ndarray) and not obj.dtype.hasobject:
+            path += '.npy'
+            numpy.save(path, obj)
+            nbytes = 0
+        else:
+            path += '.pik'
+            with open(path, 'wb') as f:
+                pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+            nbytes = 0
+        handle = Shared(path, obj.__class__.__name__,
+                        nbytes + os.path.getsize(path), cls)
+        logging.debug('Sharing %s', handle)
+        self.handles[id(obj)] = handle
+        self.objects.append(obj)
+        return handle
+
+    def clear(self):
+        """Remove the shared objects from the file system"""
+        if os.path.exists(self.dirname):
+            shutil.rmtree(self.dirname)
+        self.handles.clear()
+        del self.objects[:]
+
+
 class IterResult(object):
     """
     :param futures:
@@ -227,6 +415,8 @@ class IterResult(object):
             self.progress = progress
         self.sent = 0  # set in TaskManager.submit_all
         self.received = []
+        self.queue_depths = []  # populated only in bounded mode
+        self.reduce_lags = []  # populated only in bounded mode
         if self.num_tasks:
             self.log_percent = self._log_percent()
             next(self.log_percent)
@@ -275,6 +465,10 @@ class IterResult(object):
             tup = (mon.task_no, mon.weight, duration)
             data = numpy.array([tup], self.task_data_dt)
             hdf5.extend3(mon.hdf5path, 'task_info/' + self.name, data)
+        profile_data = vars(mon).pop('profile_data', None)
+        if profile_data is not None and mon.hdf5path:
+            hdf5.extend3(mon.hdf5path, 'performance_profile/' + self.name,
+                         profile_data)
         mon.flush()
 
     def reduce(self, agg=operator.add, acc=None):
@@ -292,9 +486,13 @@ class IterResult(object):
         """
         res = object.__new__(cls)
         res.received = []
+        res.queue_depths = []
+        res.reduce_lags = []
         res.sent = 0
         for iresult in iresults:
             res.received.extend(iresult.received)
+            res.queue_depths.extend(iresult.queue_depths)
+            res.reduce_lags.extend(iresult.reduce_lags)
             res.sent += iresult.sent
             name = iresult.name.split('#', 1)[0]
             if hasattr(res, 'name'):
@@ -318,6 +516,7 @@ class TaskManager(object):
     """
     executor = executor
     task_ids = []
+    max_inflight = 0  # set from openquake.cfg; 0 means no limit
 
     @classmethod
     def restart(cls):
@@ -420,6 +619,44 @@ class TaskManager(object):
             return self.executor.submit(
                 safely_call, self.task_func, piks, True)
 
+    def _iterbounded(self, ir):
+        # submit the tasks lazily, keeping at most .max_inflight tasks
+        # running, and yield the futures in order of completion
+        allargs = iter(self.task_args)
+        inflight = set()
+        task_no = 0
+        while True:
+            for args in allargs:
+                task_no += 1
+                self._set_task_info(args, task_no)
+                check_mem_usage()  # log a warning if too much memory is used
+                piks = pickle_sequence(args)
+                self.sent += {arg: len(p)
+                              for arg, p in zip(self.argnames, piks)}
+                fut = self._submit(piks)
+                fut.add_done_callback(_set_done_time)
+                inflight.add(fut)
+                if len(inflight) >= self.max_inflight:
+                    break
+            if not inflight:
+                break
+            ir.queue_depths.append(len(inflight))
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                # the done callback may not have run yet
+                now = time.time()
+                ir.reduce_lags.append(now - getattr(fut, 'done_time', now))
+                yield fut
+        ir.sent = self.sent
+        if not task_no:
+            self.progress('No %s tasks were submitted', self.name)
+        elif self.sent:
+            self.progress('Sent %s of data in %d task(s)',
+                          humansize(sum(self.sent.values())), task_no)
+            self.progress('Max %d task(s) in flight, reduce lag %.2fs '
+                          '(mean), %.2fs (max)', max(ir.queue_depths),
+                          numpy.mean(ir.reduce_lags), max(ir.reduce_lags))
+
     def _iterfutures(self):
         # compatibility wrapper for different concurrency frameworks
 
@@ -480,17 +717,21 @@ class TaskManager(object):
         if nargs == 1:
             [args] = self.task_args
             self.progress('Executing a single task in process')
+            if isinstance(args[-1], Monitor):
+                args[-1].profile = oq_profile(1)
             return IterResult([safely_call(self.task_func, args)], self.name)
+        if self.max_inflight and self.distribute in ('futures', 'ipython'):
+            self.progress('Submitting %s "%s" tasks, at most %d at a time',
+                          nargs, self.name, self.max_inflight)
+            ir = IterResult(None, self.name, nargs or None, self.progress)
+            ir.futures = self._iterbounded(ir)
+            return ir
         task_no = 0
         for args in self.task_args:
             task_no += 1
             if task_no == 1:  # first time
                 self.progress('Submitting %s "%s" tasks', nargs, self.name)
-            if isinstance(args[-1], Monitor):  # add incremental task number
-                args[-1].task_no = task_no
-                weight = getattr(args[0], 'weight', None)
-                if weight:
-                    args[-1].weight = weight
+            self._set_task_info(args, task_no)
             self.submit(*args)
         if not task_no:
             self.progress('No %s tasks were submitted', self.name)
@@ -502,10 +743,23 @@ class TaskManager(object):
                           ir.num_tasks)
         return ir
 
+    def _set_task_info(self, args, task_no):
+        if isinstance(args[-1], Monitor):  # add incremental task number
+            args[-1].task_no = task_no
+            args[-1].profile = oq_profile(task_no)
+            weight = getattr(args[0], 'weight', None)
+            if weight:
+                args[-1].weight = weight
+
     def __iter__(self):
         return iter(self.submit_all())
 
 
+def _set_done_time(fut):
+    # used as a done callback to measure the reduce lag
+    fut.done_time = time.time()
+
+
 # convenient aliases
 starmap = TaskManager.starmap
 apply = TaskManager.apply
@@ -28,7 +28,7 @@ import collections
 import numpy
 from shapely import wkt, geometry
 
-from openquake.baselib.general import groupby, AccumDict, writetmp
+from openquake.baselib.general import AccumDict, writetmp
 from openquake.baselib.python3compat import configparser, encode
 from openquake.baselib import hdf5
 from openquake.hazardlib import geo, site, imt
@@ -36,7 +36,7 @@ from openquake.hazardlib.calc.hazard_curve import zero_curves
 from openquake.risklib import riskmodels, riskinput, valid
 from openquake.commonlib import datastore
 from openquake.commonlib.oqvalidation import OqParam
-from openquake.commonlib.node import Node, context
+from openquake.commonlib.node import Node, context, ValidatingXmlParser
 from openquake.commonlib import nrml, logictree, InvalidFile
 from openquake.commonlib.riskmodels import get_risk_models
 from openquake.commonlib import source, sourceconverter
@@ -45,7 +45,13 @@ from openquake.commonlib import source, sourceconverter
 NORMALIZATION_FACTOR = 1E-2
 MAX_SITE_MODEL_DISTANCE = 5  # km, given by Graeme Weatherill
 
+U32 = numpy.uint32
 F32 = numpy.float32
+F64 = numpy.float64
+ASSET_BLOCK_SIZE = 100000  # number of assets converted at once in an array
+CSV_FIELDS = ('id', 'lon', 'lat', 'taxonomy', 'number', 'area')
+CSV_PREFIXES = ('deductible-', 'insurance_limit-', 'retrofitted-',
+                'occupants_')
 
 
 class DuplicatedPoint(Exception):
@@ -374,6 +380,9 @@ def get_source_models(oqparam, gsim_lt, source_model_lt, in_memory=True):
         oqparam.width_of_mfd_bin,
         oqparam.area_source_discretization)
     parser = source.SourceModelParser(converter)
+    lt_file = oqparam.inputs.get('source_model_logic_tree')
+    # the content of the logic tree determines the uncertainties applied
+    lt_checksum = source.checksum(lt_file) if lt_file and parser.cache else ''
 
     # consider only the effective realizations
     rlzs = logictree.get_effective_rlzs(source_model_lt)
@@ -387,7 +396,8 @@ def get_source_models(oqparam, gsim_lt, source_model_lt, in_memory=True):
         if in_memory:
             apply_unc = source_model_lt.make_apply_uncertainties(smpath)
             try:
-                src_groups = parser.parse_src_groups(fname, apply_unc)
+                src_groups = parser.parse_src_groups(
+                    fname, apply_unc, lt_checksum + ':' + '_'.join(smpath))
             except ValueError as e:
                 if str(e) in ('Surface does not conform with Aki & '
                               'Richards convention',
@@ -602,18 +612,19 @@ class DuplicatedID(Exception):
     """
 
 
-def _get_exposure(fname, ok_cost_types, stop=None):
+def _get_exposure(fname, ok_cost_types, stream_assets=True):
     """
     :param fname:
         path of the XML file containing the exposure
     :param ok_cost_types:
         a set of cost types (as strings)
-    :param stop:
-        node at which to stop parsing (or None)
+    :param stream_assets:
+        if False, read only the metadata and return an empty list of assets
     :returns:
-        a pair (Exposure instance, list of asset nodes)
+        a triple (Exposure instance, iterator over the asset nodes,
+        CostCalculator instance)
     """
-    [exposure] = nrml.read(fname, stop=stop)
+    [exposure] = nrml.read(fname, stop='assets')
     description = exposure.description
     try:
         conversions = exposure.conversions
@@ -661,7 +672,86 @@ def _get_exposure(fname, ok_cost_types, stop=None):
         cc.cost_types[name] = ct['type']  # aggregated, per_asset, per_area
         cc.area_types[name] = exp.area['type']
         cc.units[name] = ct['unit']
-    return exp, exposure.assets, cc
+    assets = _gen_asset_nodes(fname) if stream_assets else []
+    return exp, assets, cc
+
+
+def _gen_asset_nodes(fname):
+    # yield the asset nodes of the exposure without keeping the full tree
+    # in memory; if the <assets> node contains the names of CSV files,
+    # yield the assets stored in such files
+    vparser = ValidatingXmlParser(nrml.validators)
+    for asset in vparser.iterparse(fname, 'asset'):
+        yield asset
+    [exposure] = vparser.root
+    try:
+        csvnames = (~exposure.assets or '').split()
+    except NameError:  # no <assets> node
+        csvnames = []
+    dirname = os.path.dirname(fname)
+    for csvname in csvnames:
+        for asset in _gen_csv_asset_nodes(os.path.join(dirname, csvname)):
+            yield asset
+
+
+def _gen_csv_asset_nodes(fname):
+    # yield an asset node for each row of a CSV file with fields id, lon,
+    # lat, taxonomy, number, area, <cost_type>, deductible-<cost_type>,
+    # insurance_limit-<cost_type>, retrofitted-<cost_type>, occupants_<period>;
+    # the values are validated as in the XML exposure
+    validators = nrml.validators
+    extra = {'deductible-': 'deductible',
+             'insurance_limit-': 'insuranceLimit',
+             'retrofitted-': 'retrofitted'}
+    with open(fname) as f:
+        reader = csv.reader(f)
+        header = [field.strip() for field in next(reader)]
+        cost_types = [field for field in header if field not in CSV_FIELDS
+                      and not field.startswith(CSV_PREFIXES)]
+        periods = [field[10:] for field in header
+                   if field.startswith('occupants_')]
+        for lineno, row in enumerate(reader, 2):
+            if not row:  # skip empty lines
+                continue
+            asset = Node('asset', lineno=lineno)
+            with context(fname, asset):
+                if len(row) != len(header):
+                    raise ValueError('Expected %d fields, got %d' %
+                                     (len(header), len(row)))
+                dic = {field: value.strip()
+                       for field, value in zip(header, row)}
+                asset['id'] = validators['asset.id'](dic['id'])
+                asset['taxonomy'] = dic['taxonomy']
+                if dic.get('number'):
+                    asset['number'] = validators['number'](dic['number'])
+                if dic.get('area'):
+                    asset['area'] = valid.positivefloat(dic['area'])
+                asset.append(Node('location', dict(
+                    lon=validators['lon'](dic['lon']),
+                    lat=validators['lat'](dic['lat']))))
+                costs = Node('costs')
+                for cost_type in cost_types:
+                    if not dic[cost_type]:
+                        continue
+                    cost = Node('cost', dict(
+                        type=cost_type,
+                        value=validators['value'](dic[cost_type])))
+                    for prefix, name in extra.items():
+                        value = dic.get(prefix + cost_type)
+                        if value:
+                            cost[name] = validators[name](value)
+                    costs.append(cost)
+                asset.append(costs)
+                occupancies = Node('occupancies')
+                for period in periods:
+                    value = dic['occupants_' + period]
+                    if value:
+                        occupancies.append(Node('occupancy', dict(
+                            period=period,
+                            occupants=validators['occupants'](value))))
+                if occupancies.nodes:
+                    asset.append(occupancies)
+            yield asset
 
 
 def get_cost_calculator(oqparam):
@@ -670,15 +760,18 @@ def get_cost_calculator(oqparam):
     """
     return _get_exposure(oqparam.inputs['exposure'],
                          set(oqparam.all_cost_types),
-                         stop='assets')[-1]
+                         stream_assets=False)[-1]
 
 
 def get_exposure(oqparam):
     """
-    Read the full exposure in memory and build a list of
-    :class:`openquake.risklib.riskmodels.Asset` instances.
-    If you don't want to keep everything in memory, use
-    get_exposure_lazy instead (for experts only).
+    Read the exposure and build an
+    :class:`openquake.risklib.riskinput.AssetCollection` storing the
+    assets in a composite array, without instantiating Asset objects.
+    The XML file is parsed incrementally and the assets are converted
+    in blocks of ASSET_BLOCK_SIZE; the <assets> node can also contain
+    the names of CSV files with the assets, which are validated in the
+    same way.
 
     :param oqparam:
         an :class:`openquake.commonlib.oqvalidation.OqParam` instance
@@ -696,12 +789,25 @@ def get_exposure(oqparam):
     relevant_cost_types = all_cost_types - set(['occupants'])
     asset_refs = set()
     ignore_missing_costs = set(oqparam.ignore_missing_costs)
-
+    the_occupants = 'occupants_%s' % oqparam.time_event
+    cost_types = sorted(relevant_cost_types)
+    insured_types = cost_types if oqparam.insured_losses else []
+    asset_dt = numpy.dtype(
+        [('idx', U32), ('lon', F64), ('lat', F64), ('site_id', U32),
+         ('taxonomy_id', U32), ('number', F32), ('area', F32)] +
+        [(str('value-' + ct), F64) for ct in cost_types] +
+        [('occupants', F64)] +
+        [(str('deductible-' + ct), F64) for ct in insured_types] +
+        [(str('insurance_limit-' + ct), F64) for ct in insured_types])
+    taxonomy_ids = {}  # taxonomy -> provisional taxonomy ID
+    retrofitteds = AccumDict(accum=[])  # cost type -> [(ordinal, value)]
+    has_occupants = False
+    blocks, rows = [], []
+    num_assets = 0
     for idx, asset in enumerate(assets_node):
         values = {}
         deductibles = {}
         insurance_limits = {}
-        retrofitteds = {}
         with context(fname, asset):
             asset_id = asset['id'].encode('utf8')
             if asset_id in asset_refs:
@@ -743,7 +849,8 @@ def get_exposure(oqparam):
                     values[cost_type] = cost['value']
                     retrovalue = cost.attrib.get('retrofitted')
                     if retrovalue is not None:
-                        retrofitteds[cost_type] = retrovalue
+                        retrofitteds[cost_type].append(
+                            (num_assets, retrovalue))
                     if oqparam.insured_losses:
                         deductibles[cost_type] = cost['deductible']
                         insurance_limits[cost_type] = cost['insuranceLimit']
@@ -754,8 +861,6 @@ def get_exposure(oqparam):
             logging.warn(
                 'Ignoring asset %s, missing cost type(s): %s',
                 asset_id, ', '.join(missing))
-            for cost_type in missing:
-                values[cost_type] = None
         elif missing and 'damage' not in oqparam.calculation_mode:
             # missing the costs is okay for damage calculators
             with context(fname, asset):
@@ -771,25 +876,58 @@ def get_exposure(oqparam):
                 tot_occupants += values[occupants]
         if occupancies:  # store average occupants
             values['occupants_None'] = tot_occupants / len(occupancies)
+        if the_occupants in values:
+            has_occupants = True
         area = float(asset.attrib.get('area', 1))
-        ass = riskmodels.Asset(
-            idx, taxonomy, number, location, values, area,
-            deductibles, insurance_limits, retrofitteds, cc)
-        exposure.assets.append(ass)
-        exposure.taxonomies.add(taxonomy)
+        taxonomy_id = taxonomy_ids.setdefault(taxonomy, len(taxonomy_ids))
+        rows.append(
+            (idx, location[0], location[1], 0, taxonomy_id, number, area) +
+            tuple(values.get(ct, numpy.nan) for ct in cost_types) +
+            (values.get(the_occupants, numpy.nan),) +
+            tuple(deductibles.get(ct, numpy.nan) for ct in insured_types) +
+            tuple(insurance_limits.get(ct, numpy.nan)
+                  for ct in insured_types))
+        num_assets += 1
+        if len(rows) == ASSET_BLOCK_SIZE:  # convert into a compact array
+            blocks.append(numpy.array(rows, asset_dt))
+            rows = []
+    blocks.append(numpy.array(rows, asset_dt))
     if region:
         logging.info('Read %d assets within the region_constraint '
                      'and discarded %d assets outside the region',
-                     len(exposure.assets), out_of_region)
-        if len(exposure.assets) == 0:
+                     num_assets, out_of_region)
+        if num_assets == 0:
             raise RuntimeError('Could not find any asset within the region!')
     else:
-        logging.info('Read %d assets', len(exposure.assets))
+        logging.info('Read %d assets', num_assets)
 
     # sanity check
-    values = any(len(ass.values) + ass.number for ass in exposure.assets)
-    assert values, 'Could not find any value??'
-    return exposure
+    assert num_assets, 'Could not find any value??'
+
+    # build the final array, with the occupants only if present in the
+    # exposure and with the retrofitted costs only if some asset has them
+    array = numpy.concatenate(blocks)
+    dt = numpy.dtype(
+        [(name, asset_dt.fields[name][0]) for name in asset_dt.names
+         if name != 'occupants' or has_occupants] +
+        [(str('retrofitted-' + ct), F64) for ct in sorted(retrofitteds)])
+    assets = numpy.zeros(num_assets, dt)
+    for name in dt.names:
+        if name.startswith('retrofitted-'):
+            assets[name] = numpy.nan
+            ordinals, retros = zip(*retrofitteds[name[12:]])
+            assets[name][list(ordinals)] = retros
+        else:
+            assets[name] = array[name]
+    taxonomies = sorted(taxonomy_ids)
+    taxonomy_index = numpy.zeros(len(taxonomies), U32)
+    for i, taxonomy in enumerate(taxonomies):
+        taxonomy_index[taxonomy_ids[taxonomy]] = i
+    assets['taxonomy_id'] = taxonomy_index[array['taxonomy_id']]
+    exposure.taxonomies.update(taxonomies)
+    return exposure._replace(assets=riskinput.AssetCollection.from_array(
+        assets, taxonomies, cc, oqparam.time_event,
+        hdf5.array_of_vstr(sorted(exposure.time_events))))
 
 
 Exposure = collections.namedtuple(
@@ -806,14 +944,19 @@ def get_sitecol_assets(oqparam, exposure):
         two sequences of the same length: the site collection and an
         array with the assets per each site, collected by taxonomy
     """
-    assets_by_loc = groupby(exposure.assets, key=lambda a: a.location)
-    lons, lats = zip(*sorted(assets_by_loc))
-    mesh = geo.Mesh(numpy.array(lons), numpy.array(lats))
+    assetcol = exposure.assets
+    lonlats = numpy.zeros(len(assetcol), [('lon', F64), ('lat', F64)])
+    lonlats['lon'] = assetcol.array['lon']
+    lonlats['lat'] = assetcol.array['lat']
+    locations, inv = numpy.unique(lonlats, return_inverse=True)
+    mesh = geo.Mesh(locations['lon'], locations['lat'])
     sitecol = get_site_collection(oqparam, mesh)
-    assets_by_site = []
-    for lonlat in zip(sitecol.lons, sitecol.lats):
-        assets = assets_by_loc[lonlat]
-        assets_by_site.append(sorted(assets, key=operator.attrgetter('id')))
+    # the assets are already ordered by ID, so a stable sort is enough
+    order = numpy.argsort(inv, kind='mergesort')
+    bounds = numpy.searchsorted(inv[order], numpy.arange(len(locations) + 1))
+    assets_by_site = [
+        [assetcol[o] for o in order[start:stop]]
+        for start, stop in zip(bounds[:-1], bounds[1:])]
     return sitecol, numpy.array(assets_by_site)
 
 
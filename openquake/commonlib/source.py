@@ -17,28 +17,34 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
+import os
 import re
 import copy
 import math
+import hashlib
 import logging
 import operator
+import tempfile
 import collections
 import random
 
 import numpy
 
 from openquake.baselib import hdf5
-from openquake.baselib.python3compat import decode
+from openquake import hazardlib
+from openquake.baselib.python3compat import decode, pickle
 from openquake.baselib.general import groupby, group_array
-from openquake.commonlib import logictree, sourceconverter
-from openquake.commonlib import nrml, node
+from openquake.commonlib import logictree, sourceconverter, datastore
+from openquake.commonlib import nrml, node, __version__
 
 MAXWEIGHT = 200  # tuned by M. Simionato
 MAX_INT = 2 ** 31 - 1
 U16 = numpy.uint16
 U32 = numpy.uint32
+I16 = numpy.int16
 I32 = numpy.int32
 F32 = numpy.float32
+F64 = numpy.float64
 
 
 class LtRealization(object):
@@ -75,7 +81,8 @@ class LtRealization(object):
         return repr(self) != repr(other)
 
     def __hash__(self):
-        return hash(repr(self))
+        # the ordinal is part of the repr, so this is consistent with __eq__
+        return hash(self.ordinal)
 
 
 class SourceModel(object):
@@ -119,25 +126,163 @@ def capitalize(words):
     return ' '.join(w.capitalize() for w in words.split(' '))
 
 
+def checksum(fname, blocksize=1024 * 1024):
+    """
+    :returns: the SHA1 hexdigest of the content of the given file
+    """
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+FILENAME = re.compile(br'filename\s*=\s*["\']([^"\']+)["\']')
+
+
+def referenced_files(fname):
+    """
+    :returns: the full pathnames of the files referenced by the `filename`
+              attributes in the given source model file, like the UCERF
+              .hdf5 files
+    """
+    dirname = os.path.dirname(fname)
+    fnames = []
+    with open(fname, 'rb') as f:
+        for line in f:
+            for ref in FILENAME.findall(line):
+                fnames.append(os.path.join(dirname, decode(ref)))
+    return fnames
+
+
+class SourceCache(object):
+    """
+    A persistent cache of pickled objects, stored in a directory with a file
+    per key. When the total size exceeds `maxsize` bytes the least
+    recently used files are removed.
+
+    :param dirname: the directory where the cache is stored
+    :param maxsize: the maximum size of the cache in bytes
+    """
+    def __init__(self, dirname, maxsize):
+        self.dirname = dirname
+        self.maxsize = maxsize
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key + '.pik')
+
+    def get(self, key):
+        """
+        :returns: the object stored with the given key, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                obj = pickle.load(f)
+        except (IOError, OSError):  # missing file
+            return None
+        except Exception as exc:  # corrupted file
+            logging.warn('Discarding %s: %s', path, exc)
+            os.remove(path)
+            return None
+        os.utime(path, None)  # mark as recently used
+        return obj
+
+    def set(self, key, obj):
+        """
+        Store the given object and remove the least recently used ones
+        if the cache is too big.
+        """
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        # write to a temporary file first, to avoid partially written files
+        fd, tmp = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used files exceeding the maximum size
+        """
+        stats = []
+        for fname in os.listdir(self.dirname):
+            if fname.endswith('.pik'):
+                path = os.path.join(self.dirname, fname)
+                stats.append((os.path.getmtime(path),
+                              os.path.getsize(path), path))
+        totsize = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if totsize <= self.maxsize:
+                break
+            os.remove(path)
+            totsize -= size
+            logging.info('Removed %s from the source cache', path)
+
+
 class SourceModelParser(object):
     """
-    A source model parser featuring a cache.
+    A source model parser featuring a cache. If the class attribute
+    `cache_size` is positive, the converted groups are also stored in a
+    persistent :class:`SourceCache` under the datadir, so that a
+    subsequent run with the same files and parameters does not parse
+    them again.
 
     :param converter:
         :class:`openquake.commonlib.source.SourceConverter` instance
     """
+    cache_dir = os.path.join(datastore.DATADIR, 'source_cache')
+    cache_size = 0  # maximum size in bytes of the persistent cache
+
     def __init__(self, converter):
         self.converter = converter
         self.groups = {}  # cache fname -> groups
         self.fname_hits = collections.Counter()  # fname -> number of calls
+        self.checksums = {}  # cache fname -> checksums of the files
+        self.cache = (SourceCache(self.cache_dir, self.cache_size)
+                      if self.cache_size else None)
 
-    def parse_src_groups(self, fname, apply_uncertainties=None):
+    def get_key(self, fname, lt_key=''):
+        """
+        :param fname:
+            the full pathname of the source model file
+        :param lt_key:
+            a string identifying the uncertainties applied to the sources
+        :returns:
+            a string depending on the content of the file and of the files
+            it references, on the versions of the engine and of hazardlib,
+            on the parameters of the converter and on the uncertainties
+        """
+        conv = self.converter
+        params = (__version__, hazardlib.__version__, conv.tom.time_span,
+                  conv.rupture_mesh_spacing, conv.complex_fault_mesh_spacing,
+                  conv.width_of_mfd_bin, conv.area_source_discretization,
+                  lt_key)
+        if fname not in self.checksums:
+            self.checksums[fname] = ':'.join([checksum(fname)] + [
+                checksum(ref) for ref in referenced_files(fname)
+                if os.path.exists(ref)])
+        return hashlib.sha1(
+            (self.checksums[fname] + repr(params)).encode('utf8')).hexdigest()
+
+    def parse_src_groups(self, fname, apply_uncertainties=None, lt_key=''):
         """
         :param fname:
             the full pathname of the source model file
         :param apply_uncertainties:
             a function modifying the sources (or None)
+        :param lt_key:
+            a string identifying the uncertainties, used in the key of
+            the persistent cache
         """
+        self.fname_hits[fname] += 1
+        if self.cache:
+            key = self.get_key(fname, lt_key)
+            groups = self.cache.get(key)
+            if groups is not None:
+                logging.info('Read %s from the source cache', fname)
+                return groups
         try:
             groups = self.groups[fname]
         except KeyError:
@@ -149,7 +294,8 @@ class SourceModelParser(object):
                 if apply_uncertainties:
                     apply_uncertainties(src)
                     src.num_ruptures = src.count_ruptures()
-        self.fname_hits[fname] += 1
+        if self.cache:
+            self.cache.set(key, groups)
         return groups
 
     def parse_groups(self, fname):
@@ -169,10 +315,19 @@ class RlzsAssoc(collections.Mapping):
     but only via the method :meth:
     `openquake.commonlib.source.CompositeSourceModel.get_rlzs_assoc`.
 
+    The association is stored in a few integer arrays, which are also the
+    form in which it is pickled and saved (see `__toh5__`); the realization
+    objects and the dictionaries are views built from the arrays the first
+    time they are needed.
+
+    :attr rlz_array: array of R records of dtype `rlz_dt`
+    :attr trt_gsims: dictionary {trt: distinct gsims}
+    :attr gsim_idx: array of shape (R, T) with indices into trt_gsims
+    :attr grp_array: array of records of dtype `grp_dt` with the range of
+                     realizations of each source group
     :attr realizations: list of :class:`LtRealization` objects
-    :attr gsim_by_trt: list of dictionaries {trt: gsim}
     :attr rlzs_assoc: dictionary {src_group_id, gsim: rlzs}
-    :attr rlzs_by_smodel: list of lists of realizations
+    :attr rlzs_by_smodel: dictionary {sm_id: realizations}
 
     For instance, for the non-trivial logic tree in
     :mod:`openquake.qa_tests_data.classical.case_15`, which has 4 tectonic
@@ -191,46 +346,150 @@ class RlzsAssoc(collections.Mapping):
     def __init__(self, csm_info):
         self.seed = csm_info.seed
         self.num_samples = csm_info.num_samples
-        self.rlzs_assoc = collections.defaultdict(list)
-        self.gsim_by_trt = []  # rlz.ordinal -> {trt: gsim}
-        self.rlzs_by_smodel = {sm.ordinal: [] for sm in csm_info.source_models}
-        self.gsims_by_grp_id = {}
-        self.sm_ids = {}
-        self.samples = {}
-        for sm in csm_info.source_models:
-            for sg in sm.src_groups:
-                self.sm_ids[sg.id] = sm.ordinal
-                self.samples[sg.id] = sm.samples
+        self.trt_gsims = collections.OrderedDict()  # trt -> distinct gsims
+        self.sm_paths = {sm.ordinal: tuple(sm.path)
+                         for sm in csm_info.source_models}
+        self.gsim_rlzs = []  # distinct GSIM logic tree realizations
+        self.rlz_array = numpy.zeros(0, rlz_dt)
+        self.gsim_idx = numpy.zeros((0, 0), I16)
+        self.grp_array = numpy.array(
+            [(sg.id, -1, sm.ordinal, sm.samples, 0, 0)
+             for sm in csm_info.source_models for sg in sm.src_groups],
+            grp_dt)
+        self._rows = {}  # sm_id -> realization rows, before _init
+        self._grp_trt = {}  # grp_id -> trt, before _init
+        self._set_dicts()
+
+    def _set_dicts(self):
+        # small dictionaries grp_id -> sm_id and grp_id -> samples
+        self.sm_ids = {int(g['grp_id']): int(g['sm_id'])
+                       for g in self.grp_array}
+        self.samples = {int(g['grp_id']): int(g['samples'])
+                        for g in self.grp_array}
+        self._realizations = None
+        self._rlzs_by_smodel = None
+        self._rlzs_assoc = None
+        self._rlzs_by_grp_id = None
+        self._gsims_by_grp_id = None
+        self._gsim_by_trt = None
 
     def _init(self):
         """
-        Finalize the initialization of the RlzsAssoc object by setting
-        the (reduced) weights of the realizations and the attribute
-        gsims_by_grp_id.
+        Finalize the initialization of the RlzsAssoc object by building
+        the arrays from the realizations added by `_add_realizations` and
+        by setting the (reduced) weights of the realizations.
         """
+        trts = list(self.trt_gsims)
+        gsim_rlz_idx = {}  # gsim_rlz key -> index in self.gsim_rlzs
+        records, gsim_rows, ranges = [], [], {}
+        for sm_id in sorted(self._rows):
+            start = len(records)
+            for ordinal, gsim_rlz, weight, sampleid, row in self._rows[sm_id]:
+                key = (gsim_rlz.lt_path, gsim_rlz.lt_uid, gsim_rlz.ordinal)
+                if key not in gsim_rlz_idx:
+                    gsim_rlz_idx[key] = len(self.gsim_rlzs)
+                    self.gsim_rlzs.append(gsim_rlz)
+                records.append(
+                    (ordinal, sm_id, gsim_rlz_idx[key], weight, sampleid))
+                gsim_rows.append([row.get(trt, -1) for trt in trts])
+            ranges[sm_id] = start, len(records)
+        self.rlz_array = numpy.array(records, rlz_dt)
+        self.gsim_idx = numpy.array(gsim_rows, I16)
+        for grp in self.grp_array:
+            trt = self._grp_trt.get(grp['grp_id'])
+            if trt is not None:  # the group is associated to realizations
+                grp['trti'] = trts.index(trt)
+                grp['start'], grp['stop'] = ranges[grp['sm_id']]
+        self._rows.clear()
+        self._grp_trt.clear()
+        self._set_dicts()
+
+        weights = self.rlz_array['weight']
         if self.num_samples:
-            assert len(self.realizations) == self.num_samples, (
-                len(self.realizations), self.num_samples)
-            for rlz in self.realizations:
-                rlz.weight = 1. / self.num_samples
+            assert len(weights) == self.num_samples, (
+                len(weights), self.num_samples)
+            weights[:] = 1. / self.num_samples
         else:
-            tot_weight = sum(rlz.weight for rlz in self.realizations)
+            tot_weight = weights.sum()
             if tot_weight == 0:
                 raise ValueError('All realizations have zero weight??')
             elif abs(tot_weight - 1) > 1E-8:
                 # this may happen for rounding errors or because of the
                 # logic tree reduction; we ensure the sum of the weights is 1
-                for rlz in self.realizations:
-                    rlz.weight = rlz.weight / tot_weight
-
-        self.gsims_by_grp_id = groupby(
-            self.rlzs_assoc, operator.itemgetter(0),
-            lambda group: sorted(gsim for grp_id, gsim in group))
+                weights /= tot_weight
 
     @property
     def realizations(self):
-        """Flat list with all the realizations"""
-        return sum(self.rlzs_by_smodel.values(), [])
+        """Flat list with all the realizations (cached)"""
+        if self._realizations is None:
+            self._realizations = [
+                LtRealization(int(rec['ordinal']),
+                              self.sm_paths[rec['sm_id']],
+                              self.gsim_rlzs[rec['gsim_rlz']],
+                              float(rec['weight']), int(rec['sampleid']))
+                for rec in self.rlz_array]
+        return self._realizations
+
+    @property
+    def rlzs_by_smodel(self):
+        """Dictionary sm_id -> realizations of the source model (cached)"""
+        if self._rlzs_by_smodel is None:
+            self._rlzs_by_smodel = {sm_id: [] for sm_id in self.sm_paths}
+            for rlz, sm_id in zip(self.realizations,
+                                  self.rlz_array['sm_id']):
+                self._rlzs_by_smodel[sm_id].append(rlz)
+        return self._rlzs_by_smodel
+
+    @property
+    def rlzs_assoc(self):
+        """Dictionary (grp_id, gsim) -> realizations (cached)"""
+        if self._rlzs_assoc is None:
+            trts = list(self.trt_gsims)
+            rlzs = self.realizations
+            self._rlzs_assoc = collections.defaultdict(list)
+            for grp in self.grp_array[self.grp_array['trti'] >= 0]:
+                grp_id, t = int(grp['grp_id']), grp['trti']
+                gsims = self.trt_gsims[trts[t]]
+                for r in range(grp['start'], grp['stop']):
+                    gsim = gsims[self.gsim_idx[r, t]]
+                    self._rlzs_assoc[grp_id, gsim].append(rlzs[r])
+        return self._rlzs_assoc
+
+    @property
+    def gsims_by_grp_id(self):
+        """Dictionary grp_id -> sorted gsims (cached)"""
+        if self._gsims_by_grp_id is None:
+            self._gsims_by_grp_id = groupby(
+                self.rlzs_assoc, operator.itemgetter(0),
+                lambda group: sorted(gsim for grp_id, gsim in group))
+        return self._gsims_by_grp_id
+
+    @property
+    def gsim_by_trt(self):
+        """
+        List of dictionaries {trt: gsim}, one per realization (cached);
+        use :meth:`get_gsims` to extract the GSIMs of a single TRT.
+        """
+        if self._gsim_by_trt is None:
+            trts = list(self.trt_gsims)
+            self._gsim_by_trt = [
+                {trt: self.trt_gsims[trt][i] for trt, i in zip(trts, row)
+                 if i >= 0} for row in self.gsim_idx]
+        return self._gsim_by_trt
+
+    def get_gsims(self, trt):
+        """
+        :param trt: a tectonic region type
+        :returns: the list of GSIMs associated to each realization
+        """
+        gsims = self.trt_gsims[trt]
+        t = list(self.trt_gsims).index(trt)
+        idx = self.gsim_idx[:, t]
+        missing = (idx < 0).nonzero()[0]
+        if len(missing):  # -1 means that the TRT is not in the realization
+            raise KeyError('%s is missing in the realization(s) %s' %
+                           (trt, ' '.join(map(str, missing))))
+        return [gsims[i] for i in idx]
 
     def get_rlz(self, rlzstr):
         """
@@ -243,29 +502,43 @@ class RlzsAssoc(collections.Mapping):
 
     def get_rlzs_by_grp_id(self):
         """
-        Returns a dictionary grp_id > [sorted rlzs]
+        Returns a dictionary grp_id > [sorted rlzs]. The realizations of
+        a source group are a slice of the flat list, computed only once,
+        but a fresh copy is returned, so that the callers cannot change
+        the cache.
         """
-        rlzs_by_grp_id = collections.defaultdict(set)
-        for (grp_id, gsim), rlzs in self.rlzs_assoc.items():
-            rlzs_by_grp_id[grp_id].update(rlzs)
-        return {grp_id: sorted(rlzs)
-                for grp_id, rlzs in rlzs_by_grp_id.items()}
+        if self._rlzs_by_grp_id is None:
+            rlzs = self.realizations
+            self._rlzs_by_grp_id = {
+                int(grp['grp_id']): tuple(
+                    sorted(rlzs[grp['start']:grp['stop']]))
+                for grp in self.grp_array
+                if grp['trti'] >= 0 and grp['stop'] > grp['start']}
+        return {grp_id: list(rlzs)
+                for grp_id, rlzs in self._rlzs_by_grp_id.items()}
 
     def _add_realizations(self, idx, lt_model, gsim_lt, gsim_rlzs):
         trts = gsim_lt.tectonic_region_types
-        rlzs = []
+        rows = []
         for i, gsim_rlz in enumerate(gsim_rlzs):
             weight = float(lt_model.weight) * float(gsim_rlz.weight)
-            rlz = LtRealization(idx[i], lt_model.path, gsim_rlz, weight, i)
-            self.gsim_by_trt.append(
-                dict(zip(gsim_lt.all_trts, gsim_rlz.value)))
-            for src_group in lt_model.src_groups:
-                if src_group.trt in trts:
-                    # ignore the associations to discarded TRTs
-                    gs = gsim_lt.get_gsim_by_trt(gsim_rlz, src_group.trt)
-                    self.rlzs_assoc[src_group.id, gs].append(rlz)
-            rlzs.append(rlz)
-        self.rlzs_by_smodel[lt_model.ordinal] = rlzs
+            row = {}
+            for trt, gsim in zip(gsim_lt.all_trts, gsim_rlz.value):
+                gsims = self.trt_gsims.setdefault(trt, [])
+                try:
+                    row[trt] = gsims.index(gsim)
+                except ValueError:
+                    row[trt] = len(gsims)
+                    gsims.append(gsim)
+            rows.append((idx[i], gsim_rlz, weight, i, row))
+        self._rows[lt_model.ordinal] = rows
+        for src_group in lt_model.src_groups:
+            if src_group.trt in trts:
+                # ignore the associations to discarded TRTs; '*' means
+                # a single TRT, as in GsimLogicTree.get_gsim_by_trt
+                self._grp_trt[src_group.id] = (
+                    gsim_lt.all_trts[0] if src_group.trt == '*'
+                    else src_group.trt)
 
     def extract(self, rlz_indices, csm_info):
         """
@@ -289,6 +562,37 @@ class RlzsAssoc(collections.Mapping):
         assoc._init()
         return assoc
 
+    def __toh5__(self):
+        # the realizations and the associations are integer arrays; the
+        # small tables of GSIMs and paths are pickled, like the ruptures
+        # in the rupture_blobs dataset
+        tables = (self.trt_gsims, self.sm_paths, self.gsim_rlzs)
+        blob = numpy.frombuffer(
+            pickle.dumps(tables, pickle.HIGHEST_PROTOCOL), numpy.uint8)
+        return (dict(rlz_array=self.rlz_array, gsim_idx=self.gsim_idx,
+                     grp_array=self.grp_array, tables=blob),
+                dict(seed=self.seed, num_samples=self.num_samples))
+
+    def __fromh5__(self, dic, attrs):
+        # NB: [()] reads both h5py datasets and numpy arrays
+        self.rlz_array = dic['rlz_array'][()]
+        self.gsim_idx = dic['gsim_idx'][()]
+        self.grp_array = dic['grp_array'][()]
+        self.trt_gsims, self.sm_paths, self.gsim_rlzs = pickle.loads(
+            dic['tables'][()].tobytes())
+        self.seed = attrs['seed']
+        self.num_samples = attrs['num_samples']
+        self._rows = {}
+        self._grp_trt = {}
+        self._set_dicts()
+
+    def __getstate__(self):
+        # the workers receive the arrays, not a graph of LtRealizations
+        return self.__toh5__()
+
+    def __setstate__(self, state):
+        self.__fromh5__(*state)
+
     def __iter__(self):
         return iter(self.rlzs_assoc)
 
@@ -312,6 +616,25 @@ class RlzsAssoc(collections.Mapping):
 
 LENGTH = 256
 
+rlz_dt = numpy.dtype([
+    ('ordinal', U32),
+    ('sm_id', U16),
+    ('gsim_rlz', U32),
+    ('weight', F64),
+    ('sampleid', U32),
+])
+
+# the realizations of a source group are the slice start:stop of the
+# flat list; trti is -1 for the groups without realizations
+grp_dt = numpy.dtype([
+    ('grp_id', U32),
+    ('trti', I16),
+    ('sm_id', U16),
+    ('samples', U32),
+    ('start', U32),
+    ('stop', U32),
+])
+
 source_model_dt = numpy.dtype([
     ('name', hdf5.vstr),
     ('weight', F32),
@@ -462,7 +785,7 @@ class CompositionInfo(object):
                 logging.warn('No realizations for %s, %s',
                              b'_'.join(smodel.path), smodel.name)
         # NB: realizations could be filtered away by logic tree reduction
-        if assoc.realizations:
+        if assoc._rows:
             assoc._init()
         return assoc
 
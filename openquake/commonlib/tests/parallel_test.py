@@ -17,6 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import mock
+import tempfile
 import unittest
 import numpy
 from openquake.commonlib import parallel
@@ -37,6 +38,11 @@ def get_len(data, monitor):
     return result
 
 
+def count_chars(data, monitor):
+    with monitor:
+        return {'n': len(data)}
+
+
 class TaskManagerTestCase(unittest.TestCase):
     monitor = parallel.Monitor()
 
@@ -74,6 +80,48 @@ class TaskManagerTestCase(unittest.TestCase):
         parallel.TaskManager.restart()
         self.assertEqual(res, {'a': {'n': 10}, 'c': {'n': 15}, 'b': {'n': 20}})
 
+    def test_max_inflight(self):
+        allargs = ((numpy.arange(n),) for n in range(1, 6))  # a generator
+        with mock.patch.object(parallel.TaskManager, 'max_inflight', 2), \
+                mock.patch.dict('os.environ', OQ_DISTRIBUTE='futures'):
+            ir = parallel.starmap(get_length, allargs).submit_all()
+            res = ir.reduce()
+        self.assertEqual(res, {'n': 15})
+        self.assertLessEqual(max(ir.queue_depths), 2)
+        self.assertEqual(len(ir.reduce_lags), 5)
+
+        # the bounded mode information is kept when summing the results
+        tot = parallel.IterResult.sum([ir, ir])
+        self.assertLessEqual(max(tot.queue_depths), 2)
+        self.assertEqual(len(tot.reduce_lags), 10)
+
+    def test_shared(self):
+        registry = parallel.SharedRegistry(tempfile.mkdtemp())
+        eps = numpy.arange(6, dtype=numpy.float32).reshape(2, 3)
+        with mock.patch.dict('os.environ', OQ_DISTRIBUTE='futures'):
+            handle = registry.share(eps)
+            self.assertIs(registry.share(eps), handle)  # shared only once
+            res = parallel.starmap(
+                get_length, [(handle,), (handle,)]).reduce()
+        self.assertEqual(res, {'n': 4})
+        self.assertGreater(registry.nbytes, eps.nbytes)
+        numpy.testing.assert_equal(handle.attach(), eps)
+        registry.clear()
+
+    def test_shared_no_stale_cache(self):
+        # a new registry in the same directory must not be served the
+        # objects of the previous one from the cache of the workers
+        dirname = tempfile.mkdtemp()
+        with mock.patch.dict('os.environ', OQ_DISTRIBUTE='futures'):
+            old = parallel.SharedRegistry(dirname)
+            numpy.testing.assert_equal(
+                old.share(numpy.zeros(3)).attach(), numpy.zeros(3))
+            old.clear()
+            new = parallel.SharedRegistry(dirname)
+            numpy.testing.assert_equal(
+                new.share(numpy.ones(3)).attach(), numpy.ones(3))
+            new.clear()
+
     def test_no_flush(self):
         mon = parallel.Monitor('test')
         res = parallel.safely_call(get_len, ('ab', mon))
@@ -82,6 +130,25 @@ class TaskManagerTestCase(unittest.TestCase):
         self.assertEqual(res[1], RuntimeError)
         self.assertEqual(res[2].operation, mon.operation)
 
+    def test_profile(self):
+        mon = parallel.Monitor('test')
+        mon.profile = True
+        mon.task_no = 3
+        res = parallel.safely_call(count_chars, ('ab', mon))
+        self.assertEqual(res[0], {'n': 2})
+        profile = res[2].profile_data
+        self.assertEqual(profile.dtype, parallel.profile_dt)
+        self.assertEqual(set(profile['taskno']), {3})
+        self.assertTrue(any(b'count_chars' in func
+                            for func in profile['func']))
+
+    def test_oq_profile(self):
+        with mock.patch.dict('os.environ', OQ_PROFILE='3'):
+            self.assertEqual([parallel.oq_profile(no) for no in range(1, 6)],
+                             [True, False, False, True, False])
+        with mock.patch.dict('os.environ', OQ_PROFILE='0'):
+            self.assertFalse(parallel.oq_profile(1))
+
     if celery:
         def test_received(self):
             with mock.patch('os.environ', OQ_DISTRIBUTE='celery'):
@@ -24,6 +24,8 @@ import unittest
 import collections
 from io import BytesIO, StringIO
 
+import numpy
+
 from numpy.testing import assert_allclose
 
 from openquake.risklib import valid
@@ -308,7 +310,7 @@ class ExposureTestCase(unittest.TestCase):
 
     def test_get_exposure_metadata(self):
         exp, _assets, _cc = readinput._get_exposure(
-            self.exposure, ['structural'], stop='assets')
+            self.exposure, ['structural'], stream_assets=False)
         self.assertEqual(exp.description, 'Exposure model for buildings')
         self.assertTrue(exp.insurance_limit_is_absolute)
         self.assertTrue(exp.deductible_is_absolute)
@@ -411,6 +413,103 @@ POLYGON((68.0 31.5, 69.5 31.5, 69.5 25.5, 68.0 25.5, 68.0 31.5))'''
                       "aggregated|per_area|per_asset, line 7",
                       str(ctx.exception))
 
+    def test_exposure_csv(self):
+        assets_csv = general.writetmp('''\
+id,lon,lat,taxonomy,number,structural,occupants_day
+a1,81.2985,29.1098,RM,3000,1000,10
+a2,83.082298,27.9006,RC,,500,
+a3,85.747703,27.9015,W,2000,1000,20
+''')
+        exposure_xml = general.writetmp('''\
+<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns="http://openquake.org/xmlns/nrml/0.5">
+  <exposureModel id="ep" category="buildings">
+    <description>Exposure model for buildings</description>
+    <conversions>
+      <costTypes>
+        <costType name="structural" unit="USD" type="per_asset"/>
+      </costTypes>
+    </conversions>
+    <assets>%s</assets>
+  </exposureModel>
+</nrml>''' % os.path.basename(assets_csv))
+        oqparam = mock.Mock()
+        oqparam.base_path = '/'
+        oqparam.calculation_mode = 'scenario_risk'
+        oqparam.all_cost_types = ['structural']
+        oqparam.insured_losses = False
+        oqparam.inputs = {'exposure': exposure_xml}
+        oqparam.region_constraint = None
+        oqparam.time_event = 'day'
+        oqparam.ignore_missing_costs = []
+        exposure = readinput.get_exposure(oqparam)
+        self.assertEqual(exposure.asset_refs, [b'a1', b'a2', b'a3'])
+        self.assertEqual(exposure.time_events, set(['day']))
+        assetcol = exposure.assets
+        assert_allclose(assetcol.array['number'], [3000, 1, 2000])
+        assert_allclose(assetcol.get_costs('structural'),
+                        [3000000, 500, 2000000])
+        assert_allclose(assetcol.array['occupants'], [10, numpy.nan, 20])
+        self.assertEqual(list(assetcol.taxonomies), ['RC', 'RM', 'W'])
+
+        # duplicated asset IDs are detected as in the XML exposure
+        with open(assets_csv, 'a') as f:
+            f.write('a1,81.2985,29.1098,RM,3000,1000,10\n')
+        with self.assertRaises(readinput.DuplicatedID):
+            readinput.get_exposure(oqparam)
+
+    def test_assets_by_site_ordering(self):
+        rows = [('a%d' % i, lon, lat) for i, (lon, lat) in enumerate(
+            [(81.5, 29.1), (81.2, 29.3), (81.5, 29.1), (81.2, 29.0),
+             (81.2, 29.3), (81.5, 28.9), (81.2, 29.0)])]
+        assets_csv = general.writetmp(
+            'id,lon,lat,taxonomy,number,structural\n' + ''.join(
+                '%s,%s,%s,RM,1,1000\n' % row for row in reversed(rows)))
+        exposure_xml = general.writetmp('''\
+<?xml version='1.0' encoding='UTF-8'?>
+<nrml xmlns="http://openquake.org/xmlns/nrml/0.5">
+  <exposureModel id="ep" category="buildings">
+    <description>Exposure model for buildings</description>
+    <conversions>
+      <costTypes>
+        <costType name="structural" unit="USD" type="per_asset"/>
+      </costTypes>
+    </conversions>
+    <assets>%s</assets>
+  </exposureModel>
+</nrml>''' % os.path.basename(assets_csv))
+        oqparam = mock.Mock()
+        oqparam.base_path = '/'
+        oqparam.calculation_mode = 'scenario_risk'
+        oqparam.all_cost_types = ['structural']
+        oqparam.insured_losses = False
+        oqparam.inputs = {'exposure': exposure_xml}
+        oqparam.region_constraint = None
+        oqparam.time_event = None
+        oqparam.ignore_missing_costs = []
+        oqparam.reference_vs30_value = 760.
+        oqparam.reference_vs30_type = 'measured'
+        oqparam.reference_depth_to_1pt0km_per_sec = 100.
+        oqparam.reference_depth_to_2pt5km_per_sec = 5.
+        oqparam.reference_backarc = False
+        exposure = readinput.get_exposure(oqparam)
+        sitecol, assets_by_site = readinput.get_sitecol_assets(
+            oqparam, exposure)
+
+        # the ordering of the Asset-based exposure: the sites sorted by
+        # (lon, lat) and the assets of each site sorted by ID
+        refs = exposure.asset_refs
+        by_loc = collections.defaultdict(list)
+        for idx, (ref, lon, lat) in enumerate(reversed(rows)):
+            by_loc[lon, lat].append(idx)
+        expected = [[refs[idx] for idx in sorted(by_loc[lonlat])]
+                    for lonlat in sorted(by_loc)]
+        self.assertEqual(
+            [[refs[asset.id] for asset in assets]
+             for assets in assets_by_site], expected)
+        assert_allclose(sitecol.lons, [lon for lon, lat in sorted(by_loc)])
+        assert_allclose(sitecol.lats, [lat for lon, lat in sorted(by_loc)])
+
 
 class ReadCsvTestCase(unittest.TestCase):
     def test_get_mesh_csvdata_ok(self):
@@ -18,6 +18,9 @@
 
 import os
 import mock
+import pickle
+import shutil
+import tempfile
 import unittest
 from io import BytesIO
 
@@ -34,8 +37,10 @@ from openquake.hazardlib.tom import PoissonTOM
 from openquake.hazardlib.calc.filters import context
 from openquake.commonlib import tests, nrml_examples, readinput
 from openquake.commonlib import sourceconverter as s
-from openquake.commonlib.source import SourceModelParser, CompositionInfo
+from openquake.commonlib.source import (
+    SourceModelParser, SourceCache, CompositionInfo, referenced_files)
 from openquake.commonlib import nrml
+from openquake.commonlib.datastore import DataStore
 from openquake.baselib.general import assert_close
 
 # directory where the example files are
@@ -713,6 +718,73 @@ class SourceGroupTestCase(unittest.TestCase):
             ' effective rupture(s)>')
 
 
+class SourceCacheTestCase(unittest.TestCase):
+
+    def test_parse_from_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.multiple(SourceModelParser, cache_dir=cache_dir,
+                                 cache_size=10 ** 9):
+            converter = s.SourceConverter(
+                investigation_time=50.,
+                rupture_mesh_spacing=1,  # km
+                complex_fault_mesh_spacing=1,  # km
+                width_of_mfd_bin=1.,  # for Truncated GR MFDs
+                area_source_discretization=1.)
+            groups = SourceModelParser(converter).parse_src_groups(
+                MIXED_SRC_MODEL, lt_key='b1')
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            with mock.patch.object(SourceModelParser, 'parse_groups') as p:
+                cached = SourceModelParser(converter).parse_src_groups(
+                    MIXED_SRC_MODEL, lt_key='b1')
+            self.assertEqual(p.call_count, 0)  # read from the cache
+            self.assertEqual([len(g) for g in cached],
+                             [len(g) for g in groups])
+
+            # a different converter parameter invalidates the cache
+            converter.width_of_mfd_bin = .5
+            SourceModelParser(converter).parse_src_groups(
+                MIXED_SRC_MODEL, lt_key='b1')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        shutil.rmtree(cache_dir)
+
+    def test_key_depends_on_referenced_files(self):
+        cache_dir = tempfile.mkdtemp()
+        fname = os.path.join(cache_dir, 'source_model.xml')
+        with open(fname, 'w') as f:
+            f.write('<UCERFSource filename="model.hdf5"/>\n')
+        data = os.path.join(cache_dir, 'model.hdf5')
+        self.assertEqual(referenced_files(fname), [data])
+        with open(data, 'w') as f:
+            f.write('version 1')
+        parser = SourceModelParser(s.SourceConverter(50., 1))
+        key1 = parser.get_key(fname)
+        with open(data, 'w') as f:
+            f.write('version 2')
+        # the checksums are computed once per parser
+        with mock.patch('openquake.commonlib.source.checksum') as cks:
+            self.assertEqual(parser.get_key(fname, 'b1'),
+                             parser.get_key(fname, 'b1'))
+        self.assertFalse(cks.called)
+        self.assertEqual(parser.get_key(fname), key1)
+        parser = SourceModelParser(s.SourceConverter(50., 1))
+        key2 = parser.get_key(fname)
+        self.assertNotEqual(key2, key1)
+        with mock.patch('openquake.hazardlib.__version__', '0.0.0'):
+            self.assertNotEqual(parser.get_key(fname), key2)
+        shutil.rmtree(cache_dir)
+
+    def test_evict(self):
+        cache_dir = tempfile.mkdtemp()
+        cache = SourceCache(cache_dir, maxsize=0)
+        cache.set('a', list(range(10)))
+        self.assertEqual(os.listdir(cache_dir), [])  # too big, removed
+        cache.maxsize = 10 ** 6
+        cache.set('a', list(range(10)))
+        self.assertEqual(cache.get('a'), list(range(10)))
+        self.assertIsNone(cache.get('b'))
+        shutil.rmtree(cache_dir)
+
+
 class RuptureConverterTestCase(unittest.TestCase):
 
     def test_well_formed_ruptures(self):
@@ -831,6 +903,62 @@ Subduction Interface,b3,SadighEtAl1997(),w=1.0>''')
         # removing all src_groups
         self.assertEqual(csm.info.get_rlzs_assoc(lambda t: 0).realizations, [])
 
+    def test_pickle_rlzs_assoc(self):
+        oqparam = tests.get_oqparam('classical_job.ini')
+        oqparam.number_of_logic_tree_samples = 0
+        sitecol = readinput.get_site_collection(oqparam)
+        csm = readinput.get_composite_source_model(oqparam, sitecol)
+        assoc = csm.info.get_rlzs_assoc()
+        new = pickle.loads(pickle.dumps(assoc, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(str(new), str(assoc))
+        self.assertEqual([(rlz.ordinal, rlz.sm_lt_path, rlz.gsim_lt_path,
+                           rlz.weight) for rlz in new.realizations],
+                         [(rlz.ordinal, rlz.sm_lt_path, rlz.gsim_lt_path,
+                           rlz.weight) for rlz in assoc.realizations])
+        self.assertEqual(new.gsim_by_trt, assoc.gsim_by_trt)
+        self.assertEqual(new.get_gsims('Active Shallow Crust'),
+                         assoc.get_gsims('Active Shallow Crust'))
+        self.assertEqual(new.get_rlzs_by_grp_id(), assoc.get_rlzs_by_grp_id())
+        self.assertEqual(new.samples, assoc.samples)
+
+        # the cached associations cannot be changed by the callers
+        assoc.get_rlzs_by_grp_id()[0].append('fake')
+        self.assertEqual(new.get_rlzs_by_grp_id(), assoc.get_rlzs_by_grp_id())
+
+    def test_rlzs_assoc_toh5(self):
+        oqparam = tests.get_oqparam('classical_job.ini')
+        oqparam.number_of_logic_tree_samples = 0
+        sitecol = readinput.get_site_collection(oqparam)
+        csm = readinput.get_composite_source_model(oqparam, sitecol)
+        assoc = csm.info.get_rlzs_assoc()
+        # the gsim for each realization is computed only once
+        self.assertIs(assoc.gsim_by_trt, assoc.gsim_by_trt)
+        dstore = DataStore()
+        try:
+            dstore['rlzs_assoc'] = assoc
+            new = dstore['rlzs_assoc']
+            self.assertEqual(str(new), str(assoc))
+            numpy.testing.assert_equal(new.rlz_array, assoc.rlz_array)
+            numpy.testing.assert_equal(new.gsim_idx, assoc.gsim_idx)
+            numpy.testing.assert_equal(new.grp_array, assoc.grp_array)
+            self.assertEqual(new.gsim_by_trt, assoc.gsim_by_trt)
+            self.assertEqual(new.get_rlzs_by_grp_id(),
+                             assoc.get_rlzs_by_grp_id())
+        finally:
+            dstore.clear()
+
+    def test_missing_trt(self):
+        oqparam = tests.get_oqparam('classical_job.ini')
+        oqparam.number_of_logic_tree_samples = 0
+        sitecol = readinput.get_site_collection(oqparam)
+        csm = readinput.get_composite_source_model(oqparam, sitecol)
+        assoc = csm.info.get_rlzs_assoc()
+        assoc.gsim_idx[0, 0] = -1  # simulate a realization without TRT
+        trt = list(assoc.trt_gsims)[0]
+        with self.assertRaises(KeyError) as ctx:
+            assoc.get_gsims(trt)
+        self.assertIn('missing in the realization(s) 0', str(ctx.exception))
+
     def test_oversampling(self):
         from openquake.qa_tests_data.classical import case_17
         oq = readinput.get_oqparam(
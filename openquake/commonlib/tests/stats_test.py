@@ -24,7 +24,7 @@ import tempfile
 import numpy
 
 from openquake.risklib import scientific, riskmodels
-from openquake.commonlib import writers, tests
+from openquake.commonlib import writers, tests, calc
 
 aaae = numpy.testing.assert_array_almost_equal
 
@@ -110,3 +110,26 @@ class StatsTestCase(unittest.TestCase):
 
         # remove only if the test pass
         shutil.rmtree(tempdir)
+
+
+class QuantileCurvesTestCase(unittest.TestCase):
+
+    def test_weighted(self):
+        numpy.random.seed(42)
+        curves = numpy.random.random((7, 3, 4))
+        weights = numpy.random.random(7)
+        weights /= weights.sum()
+        for q in (0.15, 0.5, 0.85):
+            qcurves = calc.quantile_curves(curves, q, weights)
+            for i in range(3):
+                for j in range(4):
+                    poes = curves[:, i, j]
+                    order = numpy.argsort(poes)
+                    expected = numpy.interp(
+                        q, numpy.cumsum(weights[order]), poes[order])
+                    self.assertAlmostEqual(qcurves[i, j], expected)
+
+    def test_unweighted(self):
+        curves = numpy.array([[.1, .2], [.3, .1], [.2, .3]])
+        aaae(calc.quantile_curves(curves, 0.5), [.2, .2])
+        aaae(calc.quantile_curves(curves[:1], 0.5), [.1, .2])
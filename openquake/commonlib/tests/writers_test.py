@@ -100,6 +100,7 @@ xmlns="http://openquake.org/xmlns/nrml/0.4"
 ''')
 
 I32 = numpy.int32
+F32 = numpy.float32
 
 
 class WriteCsvTestCase(unittest.TestCase):
@@ -132,3 +133,15 @@ class WriteCsvTestCase(unittest.TestCase):
         self.assert_export(
             a, 'A~PGA:int32:3,A~PGV:int32:4,B~PGA:int32:3,B~PGV:int32:4,'
             'idx:int32\n1 2 3,4 5 6 7,1 2 4,3 5 6 7,8\n')
+
+    def test_floats(self):
+        dt = numpy.dtype([('lon', F32), ('lat', F32), ('tag', (bytes, 2)),
+                          ('loss', F32, (2, 2))])
+        a = numpy.array([(1, 2, b'ab', [[-0., .5], [1, 2]]),
+                         (3, 4, b'cd', [[0., -1], [3, -0.]])], dt)
+        self.assert_export(
+            a, 'lon,lat,tag:|S2,loss:float32:2:2\n'
+            '1.00000,2.00000,ab,0.000000E+00:5.000000E-01 '
+            '1.000000E+00:2.000000E+00\n'
+            '3.00000,4.00000,cd,0.000000E+00:-1.000000E+00 '
+            '3.000000E+00:0.000000E+00\n')
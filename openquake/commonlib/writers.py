@@ -30,6 +30,7 @@ from openquake.baselib.python3compat import unicode
 from openquake.commonlib import InvalidFile
 
 FIVEDIGITS = '%.5E'
+CHUNKSIZE = 100000  # number of records formatted at once by write_csv
 
 
 @contextmanager
@@ -355,6 +356,40 @@ def extract_from(data, fields):
     return data
 
 
+def _group(strings, size, sep):
+    # join the strings in groups of the given size
+    return [sep.join(strings[i:i + size])
+            for i in range(0, len(strings), size)]
+
+
+def _format_column(array, fields, fmt):
+    # vectorized version of scientificformat, returning a list of strings
+    # with the same formatting used for the single values
+    if fields == ['lon'] or fields == ['lat']:
+        return list(map('%.5f'.__mod__, array.tolist()))
+    flat = array.ravel()
+    kind = array.dtype.kind
+    if kind == 'S':
+        strings = [val.decode('utf8') for val in flat.tolist()]
+    elif kind == 'U':
+        strings = flat.tolist()
+    elif array.dtype in (numpy.float64, numpy.float32):
+        strings = list(map(fmt.__mod__, flat.tolist()))
+        for i in numpy.where(numpy.signbit(flat))[0]:
+            if set(strings[i]) <= zeroset:
+                # '-0.0000000E+00' is converted into '0.0000000E+00
+                strings[i] = strings[i].replace('-', '')
+    elif kind in 'biu':
+        strings = list(map(str, flat.tolist()))
+    else:  # generic case, slow
+        return [scientificformat(val, fmt) for val in array]
+    if array.ndim == 3:  # matrix-like values
+        strings = _group(strings, array.shape[2], ':')
+    if array.ndim >= 2:  # vector-like values
+        strings = _group(strings, array.shape[1], ' ')
+    return strings
+
+
 def write_csv(dest, data, sep=',', fmt='%.6E', header=None, comment=None):
     """
     :param dest: destination filename or io.StringIO instance
@@ -390,15 +425,11 @@ def write_csv(dest, data, sep=',', fmt='%.6E', header=None, comment=None):
     if autoheader:
         all_fields = [col.split(':', 1)[0].split('~')
                       for col in autoheader]
-        for record in data:
-            row = []
-            for fields in all_fields:
-                val = extract_from(record, fields)
-                if fields == ['lon'] or fields == ['lat']:
-                    row.append('%.5f' % val)
-                else:
-                    row.append(scientificformat(val, fmt))
-            dest.write(sep.join(row) + u'\n')
+        for start in range(0, len(data), CHUNKSIZE):
+            chunk = data[start:start + CHUNKSIZE]
+            columns = [_format_column(extract_from(chunk, fields), fields, fmt)
+                       for fields in all_fields]
+            dest.write(u'\n'.join(map(sep.join, zip(*columns))) + u'\n')
     else:
         for row in data:
             dest.write(sep.join(scientificformat(col, fmt)
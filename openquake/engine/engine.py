@@ -85,6 +85,7 @@ def expose_outputs(dstore):
     # calculators, as requested by Vitor
     calcmode = oq.calculation_mode
     dskeys = set(dstore) & exportable  # exportable datastore keys
+    dskeys.discard('hmaps')  # stored by the classical calculator
     if oq.uniform_hazard_spectra:
         dskeys.add('uhs')  # export them
     if oq.hazard_maps:
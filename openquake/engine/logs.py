@@ -23,6 +23,8 @@ Set up some system-wide loggers
 
 import os.path
 import logging
+import threading
+import traceback
 from datetime import datetime
 from contextlib import contextmanager
 from multiprocessing.connection import Client
@@ -39,6 +41,9 @@ LOG_FORMAT = ('[%(asctime)s job #%(job_id)s %(hostname)s '
 
 LOG = logging.getLogger()
 
+# one persistent connection to the DbServer per thread and process
+_local = threading.local()
+
 
 def dbcmd(action, *args):
     """
@@ -47,18 +52,10 @@ def dbcmd(action, *args):
     :param action: database action to perform
     :param args: arguments
     """
-    try:
-        client = Client(config.DBS_ADDRESS, authkey=config.DBS_AUTHKEY)
-    except:
-        raise RuntimeError('Cannot connect on %s:%s' % config.DBS_ADDRESS)
-    try:
-        client.send((action,) + args)
-        res, etype = client.recv()
-    finally:
-        client.close()
-    if etype:
-        raise etype(res)
-    return res
+    client = getattr(_local, 'client', None)
+    if client is None or client.pid != os.getpid():  # not inherited by fork
+        client = _local.client = DbClient()
+    return client(action, *args)
 
 
 def touch_log_file(log_file):
@@ -117,19 +114,129 @@ class LogFileHandler(logging.FileHandler):
         super(LogFileHandler, self).emit(record)
 
 
+class DbClient(object):
+    """
+    A persistent connection to the database server, opened lazily and
+    reopened if the server closed it.
+    """
+    def __init__(self, address=None, authkey=None):
+        self.address = address or config.DBS_ADDRESS
+        self.authkey = authkey or config.DBS_AUTHKEY
+        self.pid = os.getpid()
+        self.conn = None
+
+    def __call__(self, action, *args):
+        """
+        Send a command to the database server and return the result.
+
+        :param action: database action to perform
+        :param args: arguments
+        """
+        for attempt in (1, 2):
+            if self.conn is None:
+                try:
+                    self.conn = Client(self.address, authkey=self.authkey)
+                except:
+                    raise RuntimeError(
+                        'Cannot connect on %s:%s' % self.address)
+            try:
+                self.conn.send((action,) + args)
+                res, etype = self.conn.recv()
+                break
+            except (EOFError, IOError):  # the server closed the connection
+                self.close()
+                if attempt == 2:
+                    raise
+        if etype:
+            raise etype(res)
+        return res
+
+    def close(self):
+        """Close the connection, if open"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
 class LogDatabaseHandler(logging.Handler):
     """
-    Log stream handler
+    Log handler storing the records in the database. The records are
+    buffered and sent in batches on a persistent connection: the buffer is
+    flushed when it contains `bufsize` records, every `flush_interval`
+    seconds by a background thread, when an error is logged and when the
+    handler is closed. The connection, the buffer and the thread are not
+    inherited by fork: a child process gets new ones the first time it
+    uses the handler.
     """
+    bufsize = 100
+    flush_interval = 1  # seconds
+
     def __init__(self, job_id):
         super(LogDatabaseHandler, self).__init__()
         self.job_id = job_id
+        self._start()
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.buffer = []
+        self.dbclient = DbClient()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _check_pid(self):
+        # reset the state of the handler in a forked process, since the
+        # records in the buffer and the connection belong to the parent
+        if self.pid != os.getpid():
+            self._start()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:  # cannot log here, print on stderr
+                traceback.print_exc()
 
     def emit(self, record):  # pylint: disable=E0202
+        self._check_pid()
         if record.levelno >= logging.INFO:
-            dbcmd('log', self.job_id, datetime.utcnow(), record.levelname,
-                  '%s/%s' % (record.processName, record.process),
-                  record.getMessage())
+            # NB: emit is called with the handler lock acquired
+            self.buffer.append(
+                (self.job_id, datetime.utcnow(), record.levelname,
+                 '%s/%s' % (record.processName, record.process),
+                 record.getMessage()))
+            if (len(self.buffer) >= self.bufsize or
+                    record.levelno >= logging.ERROR):
+                try:
+                    self.flush()
+                except Exception:
+                    self.handleError(record)
+
+    def flush(self):
+        """
+        Send the buffered records to the database server
+        """
+        self.acquire()
+        try:
+            self._check_pid()
+            records, self.buffer = self.buffer, []
+            if records:
+                self.dbclient('log_many', records)
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        Stop the background thread, flush the buffer and close the connection
+        """
+        self.stopped.set()
+        self.flusher.join()
+        try:
+            self.flush()
+        finally:
+            self.dbclient.close()
+            super(LogDatabaseHandler, self).close()
 
 
 @contextmanager
@@ -163,3 +270,5 @@ def handle(job_id, log_level='info', log_file=None):
             logging.root.warn('The log file %s is empty!?' % log_file)
         for handler in handlers:
             logging.root.removeHandler(handler)
+            if isinstance(handler, LogDatabaseHandler):
+                handler.close()  # flush the records still in the buffer
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2016 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import logging
+import unittest
+from openquake.engine import logs
+
+
+def make_record(msg, level=logging.INFO):
+    return logging.LogRecord('test', level, __file__, 0, msg, (), None)
+
+
+class LogDatabaseHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('openquake.engine.logs.DbClient',
+                             side_effect=lambda: mock.Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = logs.LogDatabaseHandler(job_id=1)
+        self.handler.bufsize = 3
+
+    def tearDown(self):
+        if not self.handler.stopped.is_set():
+            self.handler.close()
+
+    def sent(self):
+        # the messages sent to the DbServer, batch by batch
+        return [[rec[-1] for rec in args[1]]
+                for args, kw in self.handler.dbclient.call_args_list]
+
+    def test_batching(self):
+        for i in range(7):
+            self.handler.handle(make_record('msg %d' % i))
+        self.handler.handle(make_record('debug', logging.DEBUG))  # ignored
+        self.assertEqual(self.sent(), [['msg 0', 'msg 1', 'msg 2'],
+                                       ['msg 3', 'msg 4', 'msg 5']])
+        self.handler.flush()
+        self.assertEqual(self.sent()[-1], ['msg 6'])
+        self.handler.flush()  # nothing to send
+        self.assertEqual(len(self.sent()), 3)
+
+    def test_error_is_sent_immediately(self):
+        self.handler.handle(make_record('info'))
+        self.handler.handle(make_record('error', logging.ERROR))
+        self.assertEqual(self.sent(), [['info', 'error']])
+        args = self.handler.dbclient.call_args[0]
+        self.assertEqual(args[0], 'log_many')
+        job_id, timestamp, level, process, message = args[1][1]
+        self.assertEqual((job_id, level), (1, 'ERROR'))
+
+    def test_fork(self):
+        self.handler.handle(make_record('parent'))
+        parent_client = self.handler.dbclient
+        # the thread of the parent does not exist in a forked process
+        self.handler.stopped.set()
+        self.handler.flusher.join()
+        with mock.patch('os.getpid', return_value=-1):  # in the child
+            self.handler.handle(make_record('child', logging.ERROR))
+            child_client = self.handler.dbclient
+            self.handler.close()
+        # the child does not reuse the buffer and the connection
+        self.assertIsNot(child_client, parent_client)
+        self.assertEqual(child_client.call_args[0][1][0][-1], 'child')
+        self.assertEqual(len(child_client.call_args[0][1]), 1)
+        self.assertFalse(parent_client.called)
@@ -17,7 +17,7 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 from openquake.baselib.performance import Monitor
-from openquake.commonlib import parallel
+from openquake.commonlib import parallel, source
 from openquake.engine import config
 
 SOFT_MEM_LIMIT = int(config.get('memory', 'soft_mem_limit'))
@@ -26,6 +26,12 @@ HARD_MEM_LIMIT = int(config.get('memory', 'hard_mem_limit'))
 parallel.check_mem_usage.__defaults__ = (
     Monitor(), SOFT_MEM_LIMIT, HARD_MEM_LIMIT)
 
+parallel.TaskManager.max_inflight = int(
+    config.get('distribution', 'max_tasks_inflight') or 0)
+
+source.SourceModelParser.cache_size = int(
+    config.get('hazard', 'source_cache_size') or 0) * 1024 ** 2
+
 
 def confirm(prompt):
     """
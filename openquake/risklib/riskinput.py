@@ -98,6 +98,85 @@ def combine(rlzs_assoc, results, agg=agg_prob):
     return ad
 
 
+class AssetView(object):
+    """
+    A lightweight view over a row of an :class:`AssetCollection`, exposing
+    the same interface of :class:`openquake.risklib.riskmodels.Asset`
+    without copying the underlying data. When pickled it is converted
+    into a regular Asset object, so that the collection is not sent over.
+
+    :param assetcol: an :class:`AssetCollection` instance
+    :param ordinal: the index of the asset in the collection
+    """
+    __slots__ = ('assetcol', 'ordinal')
+
+    def __init__(self, assetcol, ordinal):
+        self.assetcol = assetcol
+        self.ordinal = ordinal
+
+    @property
+    def id(self):
+        return self.assetcol.array['idx'][self.ordinal]
+
+    @property
+    def taxonomy(self):
+        assetcol = self.assetcol
+        return assetcol.taxonomies[
+            assetcol.array['taxonomy_id'][self.ordinal]]
+
+    @property
+    def number(self):
+        return self.assetcol.array['number'][self.ordinal]
+
+    @property
+    def area(self):
+        return self.assetcol.array['area'][self.ordinal]
+
+    @property
+    def location(self):
+        array = self.assetcol.array
+        return array['lon'][self.ordinal], array['lat'][self.ordinal]
+
+    def value(self, loss_type, time_event=None):
+        """
+        :returns: the total asset value for `loss_type`
+        """
+        return self.assetcol.get_costs(loss_type, self.ordinal)
+
+    def deductible(self, loss_type):
+        """
+        :returns: the deductible fraction of the asset cost for `loss_type`
+        """
+        return self.assetcol.get_costs(loss_type, self.ordinal, 'deductible')
+
+    def insurance_limit(self, loss_type):
+        """
+        :returns: the limit fraction of the asset cost for `loss_type`
+        """
+        return self.assetcol.get_costs(
+            loss_type, self.ordinal, 'insurance_limit')
+
+    def retrofitted(self, loss_type, time_event=None):
+        """
+        :returns: the asset retrofitted value for `loss_type`
+        """
+        return self.assetcol.get_costs(loss_type, self.ordinal, 'retrofitted')
+
+    def __reduce__(self):
+        # pickle as a detached Asset, without the underlying collection
+        a = self.assetcol.get_asset(self.ordinal)
+        return riskmodels.Asset, (
+            a.id, a.taxonomy, a.number, a.location, a.values, a.area,
+            a.deductibles, a.insurance_limits, a.retrofitteds, a.calc,
+            a.ordinal)
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+    def __repr__(self):
+        return '<Asset %s>' % self.id
+
+
 class AssetCollection(object):
     D, I, R = len('deductible-'), len('insurance_limit-'), len('retrofitted-')
 
@@ -108,6 +187,31 @@ class AssetCollection(object):
         self.time_events = hdf5.array_of_vstr(time_events)
         self.array, self.taxonomies = self.build_asset_collection(
             assets_by_site, time_event)
+        self._set_fields()
+
+    @classmethod
+    def from_array(cls, array, taxonomies, cost_calculator, time_event,
+                   time_events=''):
+        """
+        Build an AssetCollection directly from a composite array of assets,
+        without instantiating Asset objects.
+
+        :param array: a composite array with the fields of the collection
+        :param taxonomies: the sorted list of taxonomies
+        :param cost_calculator: a CostCalculator instance
+        :param time_event: a time event string (or None)
+        :param time_events: the time events in the exposure
+        """
+        self = object.__new__(cls)
+        self.cc = cost_calculator
+        self.time_event = time_event
+        self.time_events = hdf5.array_of_vstr(time_events)
+        self.array = array
+        self.taxonomies = numpy.array(taxonomies, hdf5.vstr)
+        self._set_fields()
+        return self
+
+    def _set_fields(self):
         fields = self.array.dtype.names
         self.loss_types = sorted(
             f[6:] for f in fields if f.startswith('value-'))
@@ -115,39 +219,81 @@ class AssetCollection(object):
         self.i_lim = [n for n in fields if n.startswith('insurance_limit-')]
         self.retro = [n for n in fields if n.startswith('retrofitted-')]
 
-    def assets_by_site(self):
+    def get_costs(self, loss_type, ordinals=slice(None), kind='value'):
+        """
+        Vectorized version of the cost calculator.
+
+        :param loss_type: a loss type string
+        :param ordinals: an ordinal or a sequence of ordinals (default all)
+        :param kind: 'value', 'deductible', 'insurance_limit', 'retrofitted'
+        :returns: the costs of the assets for the given loss type
+        """
+        array = self.array[ordinals]
+        if loss_type == 'occupants':
+            return array['occupants']
+        cost = array[kind + '-' + loss_type]
+        cost_type = self.cc.cost_types[loss_type]
+        if cost_type == 'per_asset':
+            cost = cost * array['number']
+        elif cost_type == 'per_area':
+            cost = cost * array['area']
+            if self.cc.area_types[loss_type] == 'per_asset':
+                cost = cost * array['number']
+        if ((kind == 'deductible' and self.cc.deduct_abs) or
+                (kind == 'insurance_limit' and self.cc.limit_abs)):
+            # convert to relative value
+            return cost / self.get_costs(loss_type, ordinals)
+        return cost
+
+    def get_asset(self, ordinal):
         """
+        :param ordinal: the index of an asset in the collection
+        :returns: a detached :class:`openquake.risklib.riskmodels.Asset`
+        """
+        a = self.array[ordinal]
+        values = {lt: a['value-' + lt] for lt in self.loss_types}
+        if 'occupants' in self.array.dtype.names:
+            values['occupants_' + str(self.time_event)] = a['occupants']
+        return riskmodels.Asset(
+                a['idx'],
+                self.taxonomies[a['taxonomy_id']],
+                number=a['number'],
+                location=(a['lon'], a['lat']),
+                values=values,
+                area=a['area'],
+                deductibles={lt[self.D:]: a[lt] for lt in self.deduc},
+                insurance_limits={lt[self.I:]: a[lt] for lt in self.i_lim},
+                retrofitteds={lt[self.R:]: a[lt] for lt in self.retro},
+                calc=self.cc, ordinal=ordinal)
+
+    def assets_by_site(self, num_sites=None):
+        """
+        :param num_sites:
+            if given, return a list for each site ID in range(num_sites),
+            possibly empty; otherwise return only the non-empty lists
         :returns: numpy array of lists with the assets by each site
         """
-        assetcol = self.array
-        site_ids = sorted(set(assetcol['site_id']))
-        assets_by_site = [[] for sid in site_ids]
-        index = dict(zip(site_ids, range(len(site_ids))))
-        for i, ass in enumerate(assetcol):
-            assets_by_site[index[ass['site_id']]].append(self[i])
+        site_ids = self.array['site_id']
+        order = numpy.argsort(site_ids, kind='mergesort')
+        if num_sites is None:
+            sids = numpy.unique(site_ids)
+        else:
+            sids = numpy.arange(num_sites)
+        sorted_ids = site_ids[order]
+        starts = numpy.searchsorted(sorted_ids, sids, 'left')
+        stops = numpy.searchsorted(sorted_ids, sids, 'right')
+        assets_by_site = [
+            [AssetView(self, int(o)) for o in order[start:stop]]
+            for start, stop in zip(starts, stops)]
         return numpy.array(assets_by_site)
 
     def __iter__(self):
         for i in range(len(self)):
-            yield self[i]
+            yield AssetView(self, i)
 
     def __getitem__(self, indices):
-        if isinstance(indices, int):  # single asset
-            a = self.array[indices]
-            values = {lt: a['value-' + lt] for lt in self.loss_types}
-            if 'occupants' in self.array.dtype.names:
-                values['occupants_' + str(self.time_event)] = a['occupants']
-            return riskmodels.Asset(
-                    a['idx'],
-                    self.taxonomies[a['taxonomy_id']],
-                    number=a['number'],
-                    location=(a['lon'], a['lat']),
-                    values=values,
-                    area=a['area'],
-                    deductibles={lt[self.D:]: a[lt] for lt in self.deduc},
-                    insurance_limits={lt[self.I:]: a[lt] for lt in self.i_lim},
-                    retrofitteds={lt[self.R:]: a[lt] for lt in self.retro},
-                    calc=self.cc, ordinal=indices)
+        if isinstance(indices, (int, numpy.integer)):  # single asset
+            return AssetView(self, int(indices))
         new = object.__new__(self.__class__)
         new.time_event = self.time_event
         new.array = self.array[indices]
@@ -168,6 +314,11 @@ class AssetCollection(object):
         return dict(array=self.array, taxonomies=self.taxonomies,
                     cost_calculator=self.cc), attrs
 
+    def __toshare__(self):
+        # the array is memory-mapped by the workers, see parallel.Shared
+        return self.array, (self.taxonomies, self.cc, self.time_event,
+                            self.time_events)
+
     def __fromh5__(self, dic, attrs):
         vars(self).update(attrs)
         self.array = dic['array'].value
@@ -187,6 +338,8 @@ class AssetCollection(object):
                 break
         else:  # no break
             raise ValueError('There are no assets!')
+        if isinstance(first_asset, AssetView):
+            return AssetCollection._build_from_views(assets_by_site)
         candidate_loss_types = list(first_asset.values)
         loss_types = []
         the_occupants = 'occupants_%s' % time_event
@@ -250,6 +403,37 @@ class AssetCollection(object):
                     record[field] = value
         return assetcol, numpy.array(sorted_taxonomies, hdf5.vstr)
 
+    @staticmethod
+    def _build_from_views(assets_by_site):
+        # build the collection by gathering the rows of the parent collection
+        parent = None
+        ordinals, sids = [], []
+        for sid, assets in enumerate(assets_by_site):
+            for asset in sorted(assets, key=operator.attrgetter('id')):
+                if parent is None:
+                    parent = asset.assetcol
+                assert asset.assetcol is parent, 'Mixed asset collections'
+                ordinals.append(asset.ordinal)
+                sids.append(sid)
+        rows = parent.array[ordinals]
+        names = rows.dtype.names
+        asset_dt = numpy.dtype(
+            [('idx', U32), ('lon', F32), ('lat', F32), ('site_id', U32),
+             ('taxonomy_id', U32), ('number', F32), ('area', F32)] + [
+                 (name, float) for name in names
+                 if name.startswith(('value-', 'occupants', 'deductible-',
+                                     'insurance_limit-', 'retrofitted-'))])
+        assetcol = numpy.zeros(len(rows), asset_dt)
+        for name in asset_dt.names:
+            if name != 'site_id':
+                assetcol[name] = rows[name]
+        assetcol['site_id'] = sids
+        # keep only the taxonomies of the selected assets
+        taxonomy_ids = numpy.unique(rows['taxonomy_id'])
+        assetcol['taxonomy_id'] = numpy.searchsorted(
+            taxonomy_ids, rows['taxonomy_id'])
+        return assetcol, parent.taxonomies[taxonomy_ids]
+
 
 class CompositeRiskModel(collections.Mapping):
     """
@@ -478,13 +662,17 @@ class CompositeRiskModel(collections.Mapping):
         for rlz in rlzs:
             with mon_hazard:
                 hazard = hazard_getter(rlz)
+            if isinstance(hazard, GmfArray):  # event based, columnar GMFs
+                gethaz = hazard.get
+            else:
+                gethaz = lambda i, imt: hazard[i].get(imt, ())
             for taxonomy in sorted(taxonomies):
                 riskmodel = self[taxonomy]
                 for lt in self.loss_types:
                     imt = riskmodel.risk_functions[lt].imt
                     with mon_risk:
                         for i, assets, epsgetter in dic[taxonomy]:
-                            haz = hazard[i].get(imt, ())
+                            haz = gethaz(i, imt)
                             if len(haz):
                                 out = riskmodel(lt, assets, haz, epsgetter)
                                 if out:  # can be None in scenario_risk
@@ -516,13 +704,63 @@ class PoeGetter(object):
                 for haz in self.hazard_by_site]
 
 
-class GmfGetter(object):
+gmv_dt = numpy.dtype([('sid', U32), ('eid', U32), ('imti', U8), ('gmv', F32)])
+
+
+class GmfArray(object):
     """
-    Callable returning a list of N dictionaries imt -> array(gmv, eid).
-    when called on a realization.
+    A sequence of N dictionaries imt -> array(gmv, eid), one per site,
+    backed by a single column-oriented array of ground motion values
+    sorted by site and IMT.
+
+    :param array: an array of dtype gmv_dt sorted by (sid, imti)
+    :param sids: the ordered site IDs
+    :param imts: a list of intensity measure type strings
     """
-    dt = numpy.dtype([('gmv', F32), ('eid', U32)])
+    def __init__(self, array, sids, imts):
+        self.array = array
+        self.sids = sids
+        self.imts = imts
+        self.imti = {imt: imti for imti, imt in enumerate(imts)}
+        I = len(imts)
+        keys = numpy.searchsorted(sids, array['sid']) * I + array['imti']
+        # the slice for the site index i and the IMT index m is
+        # array[bounds[i * I + m]:bounds[i * I + m + 1]]
+        self.bounds = numpy.searchsorted(keys, numpy.arange(len(sids) * I + 1))
+
+    def get(self, i, imt):
+        """
+        :param i: a site index
+        :param imt: an intensity measure type string
+        :returns: the slice of the array for the given site and IMT
+        """
+        I = len(self.imts)
+        start, stop = self.bounds[i * I + self.imti[imt]:
+                                  i * I + self.imti[imt] + 2]
+        return self.array[start:stop]
+
+    def __getitem__(self, i):
+        I = len(self.imts)
+        dic = {}
+        for imti, imt in enumerate(self.imts):
+            start, stop = self.bounds[i * I + imti: i * I + imti + 2]
+            if stop > start:
+                dic[imt] = self.array[start:stop]
+        return dic
+
+    def __iter__(self):
+        for i in range(len(self.sids)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.sids)
 
+
+class GmfGetter(object):
+    """
+    Callable returning a :class:`GmfArray`, i.e. a sequence of N
+    dictionaries imt -> array(gmv, eid), when called on a realization.
+    """
     def __init__(self, gsims, ebruptures, sitecol, imts, min_iml,
                  truncation_level, correlation_model, samples):
         self.gsims = gsims
@@ -533,42 +771,51 @@ class GmfGetter(object):
         self.samples = samples
         self.sids = sitecol.sids
         self.computers = []
+        self.site_masks = []  # which sites of the rupture are in self.sids
         for ebr in ebruptures:
             sites = site.FilteredSiteCollection(ebr.indices, sitecol.complete)
             computer = calc.gmf.GmfComputer(
                 ebr, sites, imts, set(gsims),
                 truncation_level, correlation_model)
             self.computers.append(computer)
+            self.site_masks.append(numpy.in1d(sites.sids, self.sids))
         self.gmfbytes = 0
 
-    def __call__(self, rlz):
+    def get_gmfa(self, rlz):
+        """
+        :param rlz: a realization
+        :returns: an array of dtype gmv_dt sorted by site and IMT,
+                  containing only the values above the minimum intensity
+        """
         gsim = self.gsims[rlz.ordinal]
-        gmfdict = collections.defaultdict(dict)
-        for computer in self.computers:
+        min_iml = numpy.array(self.min_iml).reshape(-1, 1, 1)
+        arrays = []
+        for computer, site_mask in zip(self.computers, self.site_masks):
             rup = computer.rupture
             if self.samples > 1:
                 eids = get_array(rup.events, sample=rlz.sampleid)['eid']
             else:
                 eids = rup.events['eid']
             array = computer.compute(gsim, len(eids))  # (i, n, e)
-            for imti, imt in enumerate(self.imts):
-                min_gmv = self.min_iml[imti]
-                for eid, gmf in zip(eids, array[imti].T):
-                    for sid, gmv in zip(computer.sites.sids, gmf):
-                        if gmv > min_gmv:
-                            dic = gmfdict[sid]
-                            if imt in dic:
-                                dic[imt].append((gmv, eid))
-                            else:
-                                dic[imt] = [(gmv, eid)]
-        dicts = []  # a list of dictionaries imt -> array(gmv, eid)
-        for sid in self.sids:
-            dic = gmfdict[sid]
-            for imt in dic:
-                dic[imt] = arr = numpy.array(dic[imt], self.dt)
-                self.gmfbytes += arr.nbytes
-            dicts.append(dic)
-        return dicts
+            ok = (array > min_iml) & site_mask.reshape(1, -1, 1)
+            imtis, sidxs, eidxs = ok.nonzero()
+            gmfa = numpy.zeros(len(imtis), gmv_dt)
+            gmfa['sid'] = computer.sites.sids[sidxs]
+            gmfa['eid'] = eids[eidxs]
+            gmfa['imti'] = imtis
+            gmfa['gmv'] = array[imtis, sidxs, eidxs]
+            arrays.append(gmfa)
+        if not arrays:
+            return numpy.zeros(0, gmv_dt)
+        gmfa = numpy.concatenate(arrays)
+        # lexsort is stable, so the events of each site and IMT
+        # are kept in the order of the ruptures
+        return gmfa[numpy.lexsort((gmfa['imti'], gmfa['sid']))]
+
+    def __call__(self, rlz):
+        gmfa = self.get_gmfa(rlz)
+        self.gmfbytes += gmfa.nbytes
+        return GmfArray(gmfa, self.sids, self.imts)
 
 
 class RiskInput(object):
@@ -701,8 +948,7 @@ class RiskInputFromRuptures(object):
     :param trunc_level: truncation level for the GSIMs
     :param correl_model: correlation model for the GSIMs
     :param min_iml: an array with the minimum intensity per IMT
-    :params epsilons: a matrix of epsilons (or None)
-    :param eids: an array of event IDs (or None)
+    :param epsilons: a matrix of epsilons (or None)
     """
     def __init__(self, trt, imts, sitecol, ses_ruptures,
                  trunc_level, correl_model, min_iml, epsilons=None):
@@ -721,7 +967,7 @@ class RiskInputFromRuptures(object):
 
     def epsilon_getter(self, asset_ordinals):
         """
-        :param asset_ordina: ordinal of the asset
+        :param asset_ordinals: ordinals of the assets
         :returns: a closure returning an array of epsilons from the event IDs
         """
         if not hasattr(self, 'eps'):
@@ -741,7 +987,7 @@ class RiskInputFromRuptures(object):
             lists of N hazard dictionaries imt -> rlz -> Gmvs
         """
         grp_id = self.ses_ruptures[0].grp_id
-        gsims = [dic[self.trt] for dic in rlzs_assoc.gsim_by_trt]
+        gsims = rlzs_assoc.get_gsims(self.trt)
         gg = GmfGetter(gsims, self.ses_ruptures, self.sitecol,
                        self.imts, self.min_iml, self.trunc_level,
                        self.correl_model, rlzs_assoc.samples[grp_id])
@@ -225,6 +225,9 @@ def get_values(loss_type, assets, time_event=None):
         a numpy array with the values for the given assets, depending on the
         loss_type.
     """
+    assetcol = getattr(assets[0], 'assetcol', None) if len(assets) else None
+    if assetcol is not None:  # views over an AssetCollection
+        return assetcol.get_costs(loss_type, [a.ordinal for a in assets])
     return numpy.array([a.value(loss_type, time_event) for a in assets])
 
 
@@ -545,13 +548,14 @@ class EventBasedReduced(RiskModel):
         """
         vf = self.risk_functions[loss_type]
         gmvs, eids = gmvs_eids['gmv'], gmvs_eids['eid']
-        alosses = numpy.zeros(len(assets))
+        # the interpolation is the same for all the assets on the site
+        ratios, _covs, idxs = vf.interpolate(gmvs)
+        values = get_values(loss_type, assets, self.time_event)
+        # the loss matrix is the outer product values x ratios, so its row
+        # and column sums can be computed without building it
+        alosses = values * ratios.sum()
         elosses = numpy.zeros(len(gmvs))
-        for i, asset in enumerate(assets):
-            ratios, _covs, idxs = vf.interpolate(gmvs)
-            losses = ratios * asset.value(loss_type, self.time_event)
-            alosses[i] = losses.sum()
-            elosses[idxs] += losses
+        elosses[idxs] += ratios * values.sum()
         return scientific.Output(
             assets, loss_type, alosses=alosses, elosses=elosses, eids=eids)
 
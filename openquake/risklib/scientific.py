@@ -37,6 +37,7 @@ from openquake.baselib.python3compat import with_metaclass
 
 F32 = numpy.float32
 U32 = numpy.uint32
+U64 = numpy.uint64
 
 
 def build_dtypes(curve_resolution, conditional_loss_poes, insured=False):
@@ -811,20 +812,85 @@ def make_epsilons(matrix, seed, correlation):
     Given a matrix N * R returns a matrix of the same shape N * R
     obtained by applying the multivariate_normal distribution to
     N points and R samples, by starting from the given seed and
-    correlation.
+    correlation. Since all the assets have the same correlation
+    the epsilons are built as sqrt(rho) * Z_common + sqrt(1 - rho) * Z_i,
+    without building the N * N covariance matrix.
+
+    >>> eps = make_epsilons(numpy.zeros((3, 2)), 42, .5)
+    >>> eps.shape
+    (3, 2)
     """
     if seed is not None:
         numpy.random.seed(seed)
     asset_count = len(matrix)
     samples = len(matrix[0])
-    if not correlation:  # avoid building the covariance matrix
-        return numpy.random.normal(size=(samples, asset_count)).transpose()
-    means_vector = numpy.zeros(asset_count)
-    covariance_matrix = (
-        numpy.ones((asset_count, asset_count)) * correlation +
-        numpy.diag(numpy.ones(asset_count)) * (1 - correlation))
-    return numpy.random.multivariate_normal(
-        means_vector, covariance_matrix, samples).transpose()
+    eps = numpy.random.normal(size=(samples, asset_count)).transpose()
+    if not correlation:
+        return eps
+    # a normal variable common to all assets for each sample
+    common = numpy.random.normal(size=samples)
+    eps *= numpy.sqrt(1 - correlation)
+    eps += numpy.sqrt(correlation) * common
+    return eps
+
+
+# constants of the splitmix64 generator
+GOLDEN = U64(0x9e3779b97f4a7c15)
+MIX1 = U64(0xbf58476d1ce4e5b9)
+MIX2 = U64(0x94d049bb133111eb)
+COMMON = U64(0xffffffffffffffff)  # pseudo-ordinal of the common term
+
+
+def _mix64(x):
+    # splitmix64 finalizer: a bijection of the uint64 integers scrambling
+    # the bits; x must be an array since numpy warns about the overflow of
+    # scalars, while for arrays the multiplication is silently modulo 2**64
+    x = x ^ (x >> U64(30))
+    x = x * MIX1
+    x = x ^ (x >> U64(27))
+    x = x * MIX2
+    return x ^ (x >> U64(31))
+
+
+def _normals(seed, ordinal, eids):
+    # standard normals depending only on the seed, the ordinal and the
+    # event IDs, obtained with the Box-Muller transform of two uniforms
+    key = _mix64(numpy.array([seed], U64) ^ _mix64(
+        numpy.array([ordinal], U64) + GOLDEN))
+    counter = numpy.array(eids, U64) * U64(2)
+    bits1 = _mix64(key ^ _mix64(counter))
+    bits2 = _mix64(key ^ _mix64(counter + U64(1)))
+    u1 = ((bits1 >> U64(11)) + U64(1)) * 2. ** -53  # in (0, 1]
+    u2 = (bits2 >> U64(11)) * 2. ** -53  # in [0, 1)
+    return numpy.sqrt(-2. * numpy.log(u1)) * numpy.cos(2. * numpy.pi * u2)
+
+
+def get_epsilons(seed, aid, eids, correlation=0):
+    """
+    Counter-based generator of epsilons: the epsilons are a deterministic
+    function of the seed, the asset ordinal and the event IDs, so they can
+    be generated where they are needed, independently from the way the
+    assets and the events are split in tasks. With a nonzero correlation
+    rho the epsilons are built as sqrt(rho) * Z_common + sqrt(1 - rho) * Z_i,
+    where Z_common depends only on the seed and the event ID.
+
+    :param seed: the master seed
+    :param aid: the asset ordinal
+    :param eids: an array of event IDs
+    :param correlation: the asset correlation coefficient
+    :returns: an array of epsilons of the same length as eids
+
+    >>> eps = get_epsilons(42, 1, [0, 1, 2])
+    >>> eps.shape
+    (3,)
+    >>> (get_epsilons(42, 1, [2]) == eps[2:]).all()
+    True
+    """
+    eps = _normals(seed, aid, eids)
+    if correlation:
+        eps *= numpy.sqrt(1 - correlation)
+        eps += numpy.sqrt(correlation) * _normals(seed, COMMON, eids)
+    return eps
 
 
 @DISTRIBUTIONS.add('LN')
@@ -963,11 +1029,18 @@ class CurveBuilder(object):
         :param loss_matrix:
             a matrix of loss ratios of size N x E, N = #assets, E = #events
         """
+        loss_matrix = numpy.asarray(loss_matrix)
         counts = self.get_counts(len(loss_matrix), {})
-        for i, loss_ratios in enumerate(loss_matrix):
-            # build the counts for each asset
-            counts[i, :] = numpy.array([(loss_ratios >= ratio).sum()
-                                        for ratio in self.ratios])
+        if loss_matrix.size == 0:
+            return counts
+        # sort the losses of each asset once and bisect; the NaNs are
+        # sorted at the end and must not be counted
+        sorted_losses = numpy.sort(loss_matrix, axis=1)
+        num_valid = loss_matrix.shape[1] - numpy.isnan(loss_matrix).sum(
+            axis=1)
+        for i, losses in enumerate(sorted_losses):
+            counts[i, :] = num_valid[i] - numpy.searchsorted(
+                losses, self.ratios, side='left')
         return counts
 
     def build_poes(self, N, count_dicts, ses_ratio):
@@ -1074,10 +1147,11 @@ def event_based(loss_values, ses_ratio, curve_resolution):
     """
     reference_losses = numpy.linspace(
         0, numpy.max(loss_values), curve_resolution)
-    # counts how many loss_values are bigger than the reference loss
-    counts = [(loss_values > loss).sum() for loss in reference_losses]
-    # NB: (loss_values > loss).sum() is MUCH more efficient than
-    # sum(loss_values > loss). Incredibly more efficient in memory.
+    # counts how many loss_values are bigger than the reference loss,
+    # by sorting them once and bisecting
+    values = numpy.sort(loss_values, axis=None)
+    counts = len(values) - numpy.searchsorted(
+        values, reference_losses, side='right')
     return numpy.array(
         [reference_losses, build_poes(counts, 1. / ses_ratio)])
 
@@ -1391,7 +1465,7 @@ def exposure_statistics(
     :param map_poes:
         a numpy array with P poes used to compute loss maps
     :param weights:
-        a list of N weights used to compute mean/quantile weighted statistics
+        a list of R weights used to compute mean/quantile weighted statistics
     :param quantiles:
         the quantile levels used to compute quantile results
 
@@ -1402,29 +1476,29 @@ def exposure_statistics(
             3. a numpy array with Q x N quantile loss curves
             4. a numpy array with Q x P quantile map values
     """
-    curve_resolution = len(loss_curves[0][0])
-    map_nr = len(map_poes)
-
-    # Collect per-asset statistic along the last dimension of the
-    # following arrays
-    mean_curves = numpy.zeros((0, 2, curve_resolution))
-    mean_maps = numpy.zeros((map_nr, 0))
-    quantile_curves = numpy.zeros((len(quantiles), 0, 2, curve_resolution))
-    quantile_maps = numpy.zeros((len(quantiles), map_nr, 0))
-
-    for loss_ratios, curves_poes in loss_curves:
-        _mean_curve, _mean_maps, _quantile_curves, _quantile_maps = (
-            asset_statistics(
-                loss_ratios, curves_poes, quantiles, weights, map_poes))
-
-        mean_curves = numpy.vstack(
-            (mean_curves, _mean_curve[numpy.newaxis, :]))
-        mean_maps = numpy.hstack((mean_maps, _mean_maps[:, numpy.newaxis]))
-
-        quantile_curves = numpy.hstack(
-            (quantile_curves, _quantile_curves[:, numpy.newaxis]))
-        quantile_maps = numpy.dstack(
-            (quantile_maps, _quantile_maps[:, :, numpy.newaxis]))
+    N = len(loss_curves)
+    R = len(weights)
+    C = len(loss_curves[0][0])
+    Q = len(quantiles)
+    losses = numpy.array([loss_ratios for loss_ratios, _ in loss_curves])
+    # the poes of all the assets as a 2D array R x (N * C), so that the
+    # statistics are computed along the realizations for all assets at once
+    all_poes = numpy.array(
+        [curves_poes for _, curves_poes in loss_curves]).transpose(
+            1, 0, 2).reshape(R, N * C)
+
+    mean_curves = numpy.zeros((N, 2, C))
+    mean_curves[:, 0] = losses
+    mean_curves[:, 1] = mean_curve(all_poes, weights).reshape(N, C)
+    mean_maps = loss_map_matrix(map_poes, mean_curves)
+
+    quantile_curves = numpy.zeros((Q, N, 2, C))
+    quantile_curves[:, :, 0] = losses
+    quantile_curves[:, :, 1] = quantile_matrix(
+        all_poes, quantiles, weights).reshape(Q, N, C)
+    quantile_maps = numpy.zeros((Q, len(map_poes), N))
+    for q in range(Q):
+        quantile_maps[q] = loss_map_matrix(map_poes, quantile_curves[q])
 
     return (mean_curves, mean_maps, quantile_curves, quantile_maps)
 
@@ -1680,34 +1754,20 @@ class StatsBuilder(object):
             maps = []
         for i in range(self.insured_losses + 1):  # insured index
             ins = '_ins' if i else ''
-            curves_by_stat = self._loss_curves(
-                stats.assets, stats.mean_curves[i],
+            mq_curves = _combine_mq(
+                stats.mean_curves[i], stats.quantile_curves[i])  # Q1, N, 2, C
+            curves['losses' + ins] = mq_curves[:, :, 0]
+            curves['poes' + ins] = mq_curves[:, :, 1]
+            curves['avg' + ins] = _combine_mq(
                 stats.mean_average_losses[i],
-                stats.quantile_curves[i],
-                stats.quantile_average_losses[i])
-            for aid, pairs in enumerate(curves_by_stat):
-                for s, (losses_poes, avg) in enumerate(pairs):
-                    curves['losses' + ins][s, aid] = losses_poes[0]
-                    curves['poes' + ins][s, aid] = losses_poes[1]
-                    curves['avg' + ins][s, aid] = avg
-
+                stats.quantile_average_losses[i])  # Q1, N
             if self.conditional_loss_poes:
                 mq = _combine_mq(stats.mean_maps[i], stats.quantile_maps[i])
-                for aid, maps_ in enumerate(mq):
-                    for name, map_ in zip(poenames, maps_):
-                        maps[name + ins][aid] = map_
+                # NB: the insured maps are empty, so they stay zero
+                for name, map_ in zip(poenames, mq.transpose(1, 0, 2)):
+                    maps[name + ins] = map_  # shape (Q1, N)
         return curves, maps
 
-    def _loss_curves(self, assets, mean, mean_averages,
-                     quantile, quantile_averages):
-        mq_curves = _combine_mq(mean, quantile)  # shape (Q1, N, 2, C)
-        mq_avgs = _combine_mq(mean_averages, quantile_averages)  # (Q1, N)
-        acc = []
-        for mq_curve, mq_avg in zip(
-                mq_curves.transpose(1, 0, 2, 3), mq_avgs.T):
-            acc.append(zip(mq_curve, mq_avg))
-        return acc  # (N, Q1) triples
-
 
 def _combine_mq(mean, quantile):
     # combine mean and quantile into a single array of length Q + 1
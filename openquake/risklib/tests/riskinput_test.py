@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2016 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import pickle
+import tempfile
+import unittest
+import numpy
+from numpy.testing import assert_allclose
+
+from openquake.risklib import riskinput, riskmodels
+from openquake.commonlib import parallel
+
+LOSS_TYPES = ['business_interruption', 'contents', 'nonstructural',
+              'structural']
+
+
+def make_cost_calculator(deduct_abs, limit_abs):
+    # the four cases of the CostCalculator: aggregated, per_asset,
+    # per_area with aggregated area, per_area with per_asset area
+    return riskmodels.CostCalculator(
+        cost_types=dict(business_interruption='aggregated',
+                        contents='per_area', nonstructural='per_area',
+                        structural='per_asset'),
+        area_types=dict(business_interruption='aggregated',
+                        contents='per_asset', nonstructural='aggregated',
+                        structural='aggregated'),
+        units=dict(business_interruption='EUR', contents='EUR',
+                   nonstructural='EUR', structural='EUR'),
+        deduct_abs=deduct_abs, limit_abs=limit_abs)
+
+
+def make_assets_by_site(cc):
+    # 5 assets on 3 sites, given in a scrambled order of IDs
+    assets_by_site = [[], [], []]
+    for i, (sid, aid) in enumerate([(2, 4), (0, 3), (2, 1), (0, 0), (1, 2)]):
+        values = {lt: 100. * (aid + 1) + 10 * j
+                  for j, lt in enumerate(LOSS_TYPES)}
+        values['occupants_day'] = 10. * (aid + 1)
+        values['occupants_night'] = 20. * (aid + 1)
+        asset = riskmodels.Asset(
+            aid, 'RC' if aid % 2 else 'RM', number=aid + 1.5,
+            location=(10. + sid, 45.), values=values, area=2. * aid + 0.5,
+            deductibles={lt: 0.1 * values[lt] if cc.deduct_abs else 0.1
+                         for lt in LOSS_TYPES},
+            insurance_limits={lt: 0.8 * values[lt] if cc.limit_abs else 0.8
+                              for lt in LOSS_TYPES},
+            retrofitteds={lt: 0.5 * values[lt] for lt in LOSS_TYPES},
+            calc=cc)
+        assets_by_site[sid].append(asset)
+    return assets_by_site
+
+
+class AssetCollectionTestCase(unittest.TestCase):
+
+    def check_costs(self, deduct_abs, limit_abs):
+        cc = make_cost_calculator(deduct_abs, limit_abs)
+        assets_by_site = make_assets_by_site(cc)
+        assetcol = riskinput.AssetCollection(assets_by_site, cc, 'day')
+        assets = sorted((a for assets in assets_by_site for a in assets),
+                        key=lambda a: a.ordinal)
+        for lt in LOSS_TYPES:
+            assert_allclose(assetcol.get_costs(lt),
+                            [a.value(lt) for a in assets])
+            assert_allclose(assetcol.get_costs(lt, kind='deductible'),
+                            [a.deductible(lt) for a in assets])
+            assert_allclose(assetcol.get_costs(lt, kind='insurance_limit'),
+                            [a.insurance_limit(lt) for a in assets])
+            assert_allclose(assetcol.get_costs(lt, kind='retrofitted'),
+                            [a.retrofitted(lt) for a in assets])
+            for a in assets:  # the views give the same values of the assets
+                view = assetcol[a.ordinal]
+                assert_allclose(view.value(lt), a.value(lt))
+                assert_allclose(view.deductible(lt), a.deductible(lt))
+                assert_allclose(view.insurance_limit(lt),
+                                a.insurance_limit(lt))
+                assert_allclose(view.retrofitted(lt), a.retrofitted(lt))
+        assert_allclose(assetcol.get_costs('occupants'),
+                        [a.value('occupants', 'day') for a in assets])
+        assert_allclose(assetcol.get_costs('structural', [3, 1]),
+                        [assets[3].value('structural'),
+                         assets[1].value('structural')])
+
+    def test_absolute_deductibles_and_limits(self):
+        self.check_costs(deduct_abs=True, limit_abs=True)
+
+    def test_relative_deductibles_and_limits(self):
+        self.check_costs(deduct_abs=False, limit_abs=False)
+
+    def test_mixed_deductibles_and_limits(self):
+        self.check_costs(deduct_abs=True, limit_abs=False)
+
+    def test_pickle_view(self):
+        cc = make_cost_calculator(True, True)
+        assetcol = riskinput.AssetCollection(
+            make_assets_by_site(cc), cc, 'day')
+        for view in assetcol:
+            asset = pickle.loads(pickle.dumps(view, pickle.HIGHEST_PROTOCOL))
+            self.assertIsInstance(asset, riskmodels.Asset)
+            self.assertEqual(asset.id, view.id)
+            self.assertEqual(asset.taxonomy, view.taxonomy)
+            self.assertEqual(asset.ordinal, view.ordinal)
+            self.assertEqual(asset.number, view.number)
+            self.assertEqual(asset.area, view.area)
+            self.assertEqual(asset.location, view.location)
+            for lt in LOSS_TYPES:
+                assert_allclose(asset.value(lt), view.value(lt))
+                assert_allclose(asset.deductible(lt), view.deductible(lt))
+                assert_allclose(asset.insurance_limit(lt),
+                                view.insurance_limit(lt))
+                assert_allclose(asset.retrofitted(lt), view.retrofitted(lt))
+            self.assertEqual(asset.value('occupants', 'day'),
+                             view.value('occupants', 'day'))
+
+    def test_assets_by_site(self):
+        cc = make_cost_calculator(True, True)
+        assetcol = riskinput.AssetCollection(
+            make_assets_by_site(cc), cc, 'day')
+        # the ordinals are assigned by site and then by asset ID
+        self.assertEqual(list(assetcol.array['idx']), [0, 3, 2, 1, 4])
+
+        # the algorithm of the Asset-based collection: the sites with
+        # assets in increasing order, the assets in order of ordinal
+        site_ids = sorted(set(assetcol.array['site_id']))
+        expected = [[] for sid in site_ids]
+        for i, rec in enumerate(assetcol.array):
+            expected[site_ids.index(rec['site_id'])].append(i)
+        got = [[a.ordinal for a in assets]
+               for assets in assetcol.assets_by_site()]
+        self.assertEqual(got, expected)
+
+        # with a given number of sites the empty sites are kept
+        sub = assetcol.assets_by_site(5)
+        self.assertEqual([[a.id for a in assets] for assets in sub],
+                         [[0, 3], [2], [1, 4], [], []])
+
+    def test_build_from_views(self):
+        cc = make_cost_calculator(True, True)
+        assets_by_site = make_assets_by_site(cc)
+        assetcol = riskinput.AssetCollection(assets_by_site, cc, 'day')
+        views = assetcol.assets_by_site()
+
+        # the collection built from the views is the same built from the
+        # Asset objects, apart from the order of the fields
+        new = riskinput.AssetCollection(views, cc, 'day')
+        self.assertEqual(list(new.taxonomies), list(assetcol.taxonomies))
+        for name in assetcol.array.dtype.names:
+            assert_allclose(new.array[name], assetcol.array[name])
+
+        # only the second site: the unused taxonomies are discarded
+        new = riskinput.AssetCollection([views[1]], cc, 'day')
+        self.assertEqual(list(new.taxonomies), ['RM'])
+        self.assertEqual(list(new.array['idx']), [2])
+        assert_allclose(new.get_costs('structural'),
+                        [views[1][0].value('structural')])
+
+        # views of different collections cannot be mixed
+        other = riskinput.AssetCollection(assets_by_site, cc, 'day')
+        with self.assertRaises(AssertionError):
+            riskinput.AssetCollection(
+                [views[0], other.assets_by_site()[1]], cc, 'day')
+
+    def test_share(self):
+        cc = make_cost_calculator(True, True)
+        assetcol = riskinput.AssetCollection(
+            make_assets_by_site(cc), cc, 'day')
+        registry = parallel.SharedRegistry(tempfile.mkdtemp())
+        with mock.patch.dict('os.environ', OQ_DISTRIBUTE='futures'):
+            handle = registry.share(assetcol)
+        self.assertTrue(handle.path.endswith('.npy'))
+        # the collection is rebuilt around the memory-mapped array
+        new = handle.attach()
+        self.assertIsInstance(new, riskinput.AssetCollection)
+        self.assertIsInstance(new.array, numpy.memmap)
+        self.assertEqual(list(new.taxonomies), list(assetcol.taxonomies))
+        self.assertEqual(new.time_event, 'day')
+        for lt in LOSS_TYPES:
+            assert_allclose(new.get_costs(lt), assetcol.get_costs(lt))
+        assert_allclose(new.get_costs('occupants'),
+                        assetcol.get_costs('occupants'))
+        registry.clear()
@@ -21,6 +21,7 @@ import mock
 import pickle
 
 import numpy
+from scipy import stats
 from openquake.risklib import utils, scientific
 
 aaae = numpy.testing.assert_array_almost_equal
@@ -388,7 +389,59 @@ class LogNormalDistributionTestCase(unittest.TestCase):
         samples = self.dist.sample(numpy.array([0., 0., .1, .1]),
                                    numpy.array([0., .1, 0., .1]),
                                    None, slice(None)).reshape(-1)
-        numpy.testing.assert_allclose([0., 0., 0.1, 0.10228396], samples)
+        numpy.testing.assert_allclose([0., 0., 0.1, 0.09087967], samples)
+
+
+class GetEpsilonsTestCase(unittest.TestCase):
+
+    def test_independent_from_splitting(self):
+        eids = numpy.arange(100)
+        eps = scientific.get_epsilons(42, 7, eids)
+        numpy.testing.assert_equal(
+            numpy.concatenate([scientific.get_epsilons(42, 7, eids[:30]),
+                               scientific.get_epsilons(42, 7, eids[30:])]),
+            eps)
+        self.assertFalse(
+            (scientific.get_epsilons(43, 7, eids) == eps).any())
+
+    def test_correlation(self):
+        eids = numpy.arange(10000)
+        epsilons = [scientific.get_epsilons(17, aid, eids, .37)
+                    for aid in range(5)]
+        for eps1, eps2 in utils.pairwise(epsilons):
+            numpy.testing.assert_allclose(
+                numpy.corrcoef(eps1, eps2)[0, 1], .37, atol=.05)
+        numpy.testing.assert_allclose(numpy.std(epsilons), 1, atol=.02)
+
+    def test_consistent_with_make_epsilons(self):
+        # the counter-based epsilons have the same distribution of the
+        # epsilons previously generated in the controller
+        eids = numpy.arange(2000)
+        old = scientific.make_epsilons(numpy.zeros((5, 2000)), 42, 0)
+        new = numpy.array([scientific.get_epsilons(42, aid, eids)
+                           for aid in range(5)])
+        pvalue = stats.ks_2samp(old.flatten(), new.flatten())[1]
+        self.assertGreater(pvalue, .01)
+        quantiles = [.01, .1, .25, .5, .75, .9, .99]
+        numpy.testing.assert_allclose(
+            numpy.percentile(new, [q * 100 for q in quantiles]),
+            stats.norm.ppf(quantiles), atol=.1)
+
+    def test_consistent_losses(self):
+        # the loss ratios sampled with the old and new epsilons are
+        # statistically the same
+        vf = scientific.VulnerabilityFunction(
+            'v1', 'PGA', [.1, .5, 1.], [.05, .2, .5], [.3, .4, .5], 'LN')
+        eids = numpy.arange(20000)
+        gmvs = numpy.linspace(.1, 1., 20000)
+        old = scientific.make_epsilons(numpy.zeros((1, 20000)), 42, 0)[0]
+        new = scientific.get_epsilons(42, 0, eids)
+        old_ratios, new_ratios = vf(gmvs, old), vf(gmvs, new)
+        numpy.testing.assert_allclose(
+            new_ratios.mean(), old_ratios.mean(), rtol=.02)
+        numpy.testing.assert_allclose(
+            numpy.percentile(new_ratios, [50, 90, 99]),
+            numpy.percentile(old_ratios, [50, 90, 99]), rtol=.05)
 
 
 class VulnerabilityLossRatioStepsTestCase(unittest.TestCase):
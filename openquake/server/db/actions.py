@@ -304,6 +304,27 @@ def log(db, job_id, timestamp, level, process, message):
        'VALUES (?X)', (job_id, timestamp, level, process, message))
 
 
+def log_many(db, records):
+    """
+    Write several log records in the database, in a single transaction.
+
+    :param db:
+        a :class:`openquake.server.dbapi.Db` instance
+    :param records:
+        a list of tuples (job_id, timestamp, level, process, message)
+    """
+    if not records:
+        return
+    db('BEGIN')
+    try:
+        db.insert('log', 'job_id timestamp level process message'.split(),
+                  records)
+    except:
+        db('ROLLBACK')
+        raise
+    db('COMMIT')
+
+
 def get_log(db, job_id):
     """
     Extract the logs as a big string
@@ -22,9 +22,10 @@ import socket
 import sqlite3
 import os.path
 import logging
+import threading
 import subprocess
-from multiprocessing.connection import Listener
-from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ThreadPoolExecutor
 
 from openquake.baselib import sap
 from openquake.commonlib.parallel import safely_call
@@ -34,24 +35,101 @@ from openquake.server.db import actions
 from openquake.server import dbapi
 from openquake.server.settings import DATABASE
 
-executor = ProcessPoolExecutor(1)  # there is a single db process
+# actions which do not write on the database; they can run concurrently
+# in the reader threads, since SQLite in WAL mode allows readers to proceed
+# while the writer is committing
+READ_ACTIONS = set('''
+calc_info check_outdated find get_calc_id get_calcs get_dbpath get_job
+get_job_id get_log get_log_size get_log_slice get_longest_jobs get_output
+get_outputs get_result get_results get_traceback list_calculations
+list_outputs version_db what_if_I_upgrade'''.split())
+
+
+def connect(dbpath):
+    """
+    :param dbpath: path to the SQLite database
+    :returns: a connection in autocommit mode honoring the foreign keys
+    """
+    conn = sqlite3.connect(dbpath, isolation_level=None,
+                           detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute('PRAGMA foreign_keys = ON')  # honor ON DELETE CASCADE
+    return conn
 
 
 class DbServer(object):
     """
-    A server collecting the received commands into a queue
+    A server dispatching the received commands to a pool of reader threads
+    (for the actions in READ_ACTIONS) or to a single writer thread (for
+    all the other actions). Each thread has its own database connection.
+
+    :param db: a :class:`openquake.server.dbapi.Db` instance
+    :param address: pair (hostname, port)
+    :param authkey: authentication key
+    :param num_readers: number of reader threads
     """
-    def __init__(self, db, address, authkey):
+    def __init__(self, db, address, authkey, num_readers=4):
         self.db = db
         self.address = address
         self.authkey = authkey
+        self.executor = dict(reader=ThreadPoolExecutor(num_readers),
+                             writer=ThreadPoolExecutor(1))
+        self.lock = threading.Lock()
+        self.pending = dict(reader=0, writer=0)  # queue depth
+        self.max_pending = dict(reader=0, writer=0)
+        self.latency = {}  # action -> [calls, total time, max time]
+
+    def execute(self, cmd, args):
+        """
+        Run an action in the reader pool or in the writer thread and
+        record its latency, including the time spent in the queue.
+
+        :param cmd: the name of a function in the actions module
+        :param args: the arguments of the action, except the db
+        :returns: a pair (result, exception class or None)
+        """
+        kind = 'reader' if cmd in READ_ACTIONS else 'writer'
+        func = getattr(actions, cmd)
+        with self.lock:
+            self.pending[kind] += 1
+            self.max_pending[kind] = max(
+                self.max_pending[kind], self.pending[kind])
+        t0 = time.time()
+        try:
+            res, etype, _mon = self.executor[kind].submit(
+                safely_call, func, (self.db, ) + args).result()
+        finally:
+            dt = time.time() - t0
+            with self.lock:
+                self.pending[kind] -= 1
+                stats = self.latency.setdefault(cmd, [0, 0., 0.])
+                stats[0] += 1
+                stats[1] += dt
+                stats[2] = max(stats[2], dt)
+        return res, etype
+
+    def get_stats(self):
+        """
+        :returns:
+            a dictionary with the current and maximum queue depth of the
+            reader and writer threads and a list of tuples
+            (action, calls, mean time, max time) sorted by total time
+        """
+        with self.lock:
+            latency = sorted(
+                ((cmd, n, tot / n, mx) for cmd, (n, tot, mx)
+                 in self.latency.items()),
+                key=lambda rec: rec[1] * rec[2], reverse=True)
+            return dict(pending=dict(self.pending),
+                        max_pending=dict(self.max_pending),
+                        latency=latency)
 
     def loop(self):
         listener = Listener(self.address, backlog=5, authkey=self.authkey)
         logging.warn('DB server started with %s, listening on %s:%d...',
                      sys.executable, *self.address)
+        self.running = True
         try:
-            while True:
+            while self.running:
                 try:
                     conn = listener.accept()
                 except KeyboardInterrupt:
@@ -60,26 +138,53 @@ class DbServer(object):
                     # unauthenticated connection, for instance by a port
                     # scanner such as the one in manage.py
                     continue
-                cmd_ = conn.recv()  # a tuple (name, arg1, ... argN)
+                # each connection is served by a thread, so that a client
+                # can send several commands on the same connection
+                thread = threading.Thread(target=self.serve, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            listener.close()
+
+    def serve(self, conn):
+        """
+        Execute the commands received on the given connection, until the
+        client closes it.
+
+        :param conn: a multiprocessing.connection.Connection instance
+        """
+        try:
+            while True:
+                try:
+                    cmd_ = conn.recv()  # a tuple (name, arg1, ... argN)
+                except (EOFError, IOError):  # closed by the client
+                    break
                 cmd, args = cmd_[0], cmd_[1:]
                 logging.debug('Got ' + str(cmd_))
                 if cmd == 'stop':
                     conn.send((None, None))
-                    conn.close()
+                    self.stop()
                     break
-                func = getattr(actions, cmd)
-                fut = executor.submit(safely_call, func, (self.db, ) + args)
-
-                def sendback(fut, conn=conn):
-                    res, etype, _mon = fut.result()
-                    if etype:
-                        logging.error(res)
-                    # send back the result and the exception class
-                    conn.send((res, etype))
-                    conn.close()
-                fut.add_done_callback(sendback)
+                elif cmd == 'stats':
+                    conn.send((self.get_stats(), None))
+                    continue
+                res, etype = self.execute(cmd, args)
+                if etype:
+                    logging.error(res)
+                # send back the result and the exception class
+                conn.send((res, etype))
         finally:
-            listener.close()
+            conn.close()
+
+    def stop(self):
+        """
+        Stop the main loop, by waking it up with a dummy connection
+        """
+        self.running = False
+        for cmd, n, mean, mx in self.get_stats()['latency']:
+            logging.info('%s: %d calls, mean=%.4fs, max=%.4fs',
+                         cmd, n, mean, mx)
+        Client(self.address, authkey=self.authkey).close()
 
 
 def get_status(address=None):
@@ -138,16 +243,17 @@ def run_server(dbpathport=None, logfile=DATABASE['LOG'], loglevel='WARN'):
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    # create and upgrade the db if needed
-    db = dbapi.Db(sqlite3.connect, DATABASE['NAME'], isolation_level=None,
-                  detect_types=sqlite3.PARSE_DECLTYPES)
-    db('PRAGMA foreign_keys = ON')  # honor ON DELETE CASCADE
+    # create and upgrade the db if needed; the WAL journal mode is
+    # persistent, so it is enough to set it once
+    db = dbapi.Db(connect, DATABASE['NAME'])
+    db('PRAGMA journal_mode = WAL')
     actions.upgrade_db(db)
     db.conn.close()
 
     # configure logging and start the server
     logging.basicConfig(level=getattr(logging, loglevel), filename=logfile)
-    DbServer(db, addr, config.DBS_AUTHKEY).loop()
+    num_readers = int(config.get('dbserver', 'num_readers') or 4)
+    DbServer(db, addr, config.DBS_AUTHKEY, num_readers).loop()
 
 run_server.arg('dbpathport', 'dbpath:port')
 run_server.arg('logfile', 'log file')
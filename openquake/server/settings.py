@@ -149,6 +149,11 @@ LOGGING = {
 
 FILE_UPLOAD_MAX_MEMORY_SIZE = 1
 
+# directory and maximum size in MB of the cache of the exported outputs
+EXPORT_CACHE_DIR = os.path.join(
+    os.path.dirname(DATABASE['NAME']), 'export_cache')
+EXPORT_CACHE_SIZE = 1024
+
 # Enable this setting if used as backend for the OpenQuake Platform
 # DEFAULT_USER = 'platform'
 
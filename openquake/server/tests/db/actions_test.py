@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2016 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import unittest
+import tempfile
+from datetime import datetime
+
+from openquake.server.dbapi import Db
+from openquake.server.db import actions
+
+
+class LogManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.tmpfile = tempfile.mkstemp()
+        os.close(fd)
+        self.db = Db(sqlite3.connect, self.tmpfile, isolation_level=None,
+                     detect_types=sqlite3.PARSE_DECLTYPES)
+        actions.upgrade_db(self.db)
+
+    def tearDown(self):
+        self.db.conn.close()
+        os.remove(self.tmpfile)
+
+    def messages(self, job_id):
+        return [rec.message for rec in self.db(
+            'SELECT message FROM log WHERE job_id=?x ORDER BY id', job_id)]
+
+    def test_log_many(self):
+        now = datetime.utcnow()
+        actions.log_many(self.db, [
+            (1, now, 'INFO', 'MainProcess/1', 'first'),
+            (1, now, 'WARNING', 'MainProcess/1', 'second'),
+            (2, now, 'INFO', 'Process-1/2', 'other job')])
+        actions.log_many(self.db, [])  # nothing to do
+        self.assertEqual(self.messages(1), ['first', 'second'])
+        self.assertEqual(self.messages(2), ['other job'])
+        lines = list(actions.get_log(self.db, 1))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].endswith('#1 WARNING] second'))
+
+    def test_rollback(self):
+        # the batch is written in a single transaction
+        now = datetime.utcnow()
+        with self.assertRaises(sqlite3.IntegrityError):
+            actions.log_many(self.db, [
+                (1, now, 'INFO', 'MainProcess/1', 'good'),
+                (1, now, 'INFO', 'MainProcess/1', None)])
+        self.assertEqual(self.messages(1), [])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2016 GEM Foundation
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mock
+import shutil
+import tempfile
+import unittest
+
+from openquake.server import utils
+
+
+def fake_export(output_key, calc_id, datadir, target):
+    # mimic core.export_from_db: several files are zipped in a hidden
+    # archive, a single file is returned as it is
+    ds_key, fmt = output_key
+    fnames = ['%s-%d.%s' % (ds_key, i, fmt)
+              for i in range(2 if ds_key == 'multi' else 1)]
+    for fname in fnames:
+        with open(os.path.join(target, fname), 'w') as f:
+            f.write('data')
+    if len(fnames) == 1:
+        return os.path.join(target, fnames[0])
+    archname = os.path.join(target, '.%s-%s.zip' % output_key)
+    with open(archname, 'w') as f:
+        f.write('zip')
+    return archname
+
+
+class GetExportedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        open(os.path.join(self.datadir, 'calc_1.hdf5'), 'w').close()
+        self.cachedir = os.path.join(self.datadir, 'cache')
+        settings = mock.Mock(EXPORT_CACHE_DIR=self.cachedir,
+                             EXPORT_CACHE_SIZE=100)
+        patchers = [mock.patch.object(utils, 'settings', settings),
+                    mock.patch.object(utils.core, 'export_from_db',
+                                      side_effect=fake_export)]
+        self.export = [p.start() for p in patchers][1]
+        for p in patchers:
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_single_file(self):
+        path = utils.get_exported(1, self.datadir, 'single', 'csv')
+        self.assertEqual(os.path.basename(path), 'single-0.csv')
+        self.assertTrue(path.startswith(self.cachedir))
+        self.assertTrue(os.path.exists(path))
+
+    def test_multi_file_and_cache_hit(self):
+        path = utils.get_exported(1, self.datadir, 'multi', 'csv')
+        self.assertEqual(os.path.basename(path), '.multi-csv.zip')
+        self.assertTrue(path.startswith(self.cachedir))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.export.call_count, 1)
+
+        # the second time the export is read from the cache
+        self.assertEqual(
+            utils.get_exported(1, self.datadir, 'multi', 'csv'), path)
+        self.assertEqual(self.export.call_count, 1)
+
+        # a different export type is a different entry
+        other = utils.get_exported(1, self.datadir, 'multi', 'xml')
+        self.assertEqual(os.path.basename(other), '.multi-xml.zip')
+        self.assertEqual(self.export.call_count, 2)
+
+        # no temporary directories are left in the cache
+        self.assertEqual(len(os.listdir(self.cachedir)), 2)
@@ -16,10 +16,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import re
+import shutil
 import getpass
+import hashlib
+import tempfile
+import threading
 
 from django.conf import settings
 from openquake.engine import __version__ as oqversion
+from openquake.engine.export import core
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_cache_lock = threading.Lock()
+
+# name of the file containing the path of an export, relative to its
+# directory in the cache
+EXPORTED = '.exported'
 
 
 def get_user_data(request):
@@ -57,3 +72,118 @@ def oq_server_context_processor(request):
     context['oq_engine_version'] = oqversion
 
     return context
+
+
+def get_exported(job_id, datadir, ds_key, export_type):
+    """
+    Export the given output in the cache directory, unless it has been
+    already exported. The cache is keyed by the calculation ID, the
+    datastore key, the export type and the modification time of the
+    datastore; when its size exceeds `settings.EXPORT_CACHE_SIZE` MB the
+    least recently used exports are removed.
+
+    :returns: the path of the exported file
+    """
+    hdf5path = os.path.join(datadir, 'calc_%s.hdf5' % job_id)
+    key = '%s %s %s %s' % (job_id, ds_key, export_type,
+                           os.path.getmtime(hdf5path))
+    cachedir = settings.EXPORT_CACHE_DIR
+    dirname = os.path.join(cachedir, hashlib.sha1(
+        key.encode('utf8')).hexdigest())
+    if not os.path.exists(dirname):
+        if not os.path.exists(cachedir):
+            core.makedirs(cachedir)
+        # export in a temporary directory and then rename it, so that
+        # concurrent requests never see a partial export
+        tmpdir = tempfile.mkdtemp(dir=cachedir, prefix='.tmp')
+        try:
+            exported = core.export_from_db(
+                (ds_key, export_type), job_id, datadir, tmpdir)
+            # multi-file exports return a zip archive next to the files:
+            # store the relative path of the returned file for the cache hits
+            with open(os.path.join(tmpdir, EXPORTED), 'w') as f:
+                f.write(os.path.relpath(exported, tmpdir))
+        except:
+            shutil.rmtree(tmpdir)
+            raise
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:  # exported by another request in the meantime
+            shutil.rmtree(tmpdir)
+        _evict(cachedir, settings.EXPORT_CACHE_SIZE * 1024 * 1024, dirname)
+    os.utime(dirname, None)  # the mtime is the time of the last access
+    with open(os.path.join(dirname, EXPORTED)) as f:
+        return os.path.join(dirname, f.read())
+
+
+def _evict(cachedir, maxsize, keep):
+    # remove the least recently used exports until the total size of
+    # the cache is below maxsize, except the directory `keep`
+    with _cache_lock:
+        entries = []
+        for name in os.listdir(cachedir):
+            path = os.path.join(cachedir, name)
+            if name.startswith('.tmp') or path == keep:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f))
+                           for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:  # removed by another thread
+                continue
+        total = sum(size for _, size, _ in entries) + sum(
+            os.path.getsize(os.path.join(keep, f)) for f in os.listdir(keep))
+        for _, size, path in sorted(entries):
+            if total <= maxsize:
+                break
+            # NB: a file being downloaded can be removed, since the
+            # open file handle stays valid
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def parse_range(header, size):
+    """
+    Parse a HTTP Range header with a single range.
+
+    :param header: the value of the header, like 'bytes=0-499'
+    :param size: the size of the file in bytes
+    :returns:
+        a pair (start, stop) or None if the range is not satisfiable
+        or not in the supported form
+
+    >>> parse_range('bytes=0-499', 1000)
+    (0, 500)
+    >>> parse_range('bytes=500-', 1000)
+    (500, 1000)
+    >>> parse_range('bytes=-100', 1000)
+    (900, 1000)
+    >>> parse_range('bytes=1000-', 1000)
+    """
+    mo = RANGE_RE.match(header.strip())
+    if not mo or mo.groups() == ('', ''):
+        return
+    first, last = mo.groups()
+    if not first:  # suffix range, i.e. the last bytes
+        start, stop = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        stop = min(int(last) + 1, size) if last else size
+    if start >= stop:
+        return
+    return start, stop
+
+
+def iter_file(fname, start, stop, chunksize=65536):
+    """
+    Yield the bytes of the given file between start and stop, in chunks.
+    """
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunksize, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
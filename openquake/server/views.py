@@ -48,7 +48,6 @@ from openquake.commonlib import nrml, readinput, oqvalidation
 from openquake.commonlib.parallel import TaskManager, safely_call
 from openquake.commonlib.export import export
 from openquake.engine import __version__ as oqversion
-from openquake.engine.export import core
 from openquake.engine import engine, logs
 from openquake.engine.export.core import DataStoreExportError
 from openquake.server import executor, utils, dbapi
@@ -506,31 +505,37 @@ def get_result(request, result_id):
     etype = request.GET.get('export_type')
     export_type = etype or DEFAULT_EXPORT_TYPE
 
-    tmpdir = tempfile.mkdtemp()
     try:
-        exported = core.export_from_db(
-            (ds_key, export_type), job_id, datadir, tmpdir)
+        exported = utils.get_exported(job_id, datadir, ds_key, export_type)
     except DataStoreExportError as exc:
         # TODO: there should be a better error page
         return HttpResponse(content='%s: %s' % (exc.__class__.__name__, exc),
                             content_type='text/plain', status=500)
-    if exported is None:
-        # Throw back a 404 if the exact export parameters are not supported
-        return HttpResponseNotFound(
-            'export_type=%s is not supported for %s' % (export_type, ds_key))
 
     content_type = EXPORT_CONTENT_TYPE_MAP.get(
         export_type, DEFAULT_CONTENT_TYPE)
-    try:
-        fname = 'output-%s-%s' % (result_id, os.path.basename(exported))
+    fname = 'output-%s-%s' % (result_id, os.path.basename(exported))
+    size = os.path.getsize(exported)
+    rng = request.META.get('HTTP_RANGE')
+    if rng:  # resume a download
+        start_stop = utils.parse_range(rng, size)
+        if start_stop is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        start, stop = start_stop
+        response = FileResponse(utils.iter_file(exported, start, stop),
+                                content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        response['Content-Length'] = stop - start
+    else:
         # 'b' is needed when running the WebUI on Windows
-        data = open(exported, 'rb').read()
-        response = HttpResponse(data, content_type=content_type)
-        response['Content-Length'] = len(data)
-        response['Content-Disposition'] = 'attachment; filename=%s' % fname
-        return response
-    finally:
-        shutil.rmtree(tmpdir)
+        response = FileResponse(open(exported, 'rb'),
+                                content_type=content_type)
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = 'attachment; filename=%s' % fname
+    return response
 
 
 @cross_domain_ajax